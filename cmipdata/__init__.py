@@ -9,7 +9,12 @@ import glob
 # __all__ = ["join_exp_slice", "zonmean", "loaddata", "match_exp", "remap_timelim", "remap_cmip_nc" ,"mload1d", "climatology", "areaint"]
 
 from .classes import *
+from .profiling import (enable_profiling, disable_profiling, profiling_enabled,
+                        clear_profile, profile_records, profile_summary,
+                        export_jsonl, export_chrome_trace)
 from .preprocessing_tools import *
+from .async_tools import *
+from .time_tools import decode_times, from_int_dates, clear_time_cache
 
 # Requires cdo python bindings and netcdf4
 try:
@@ -17,6 +22,30 @@ try:
 except ImportError:
     print('Could not import loading_tools. Check that the correct versions of cdo, numpy, and netCDF4 are installed.')
 
+# Requires cdo python bindings and netcdf4
+try:
+    from .derived_tools import derive
+except ImportError:
+    print('Could not import derived_tools. Check that the correct versions of cdo, numpy, and netCDF4 are installed.')
+
+# Requires cdo python bindings and netcdf4
+try:
+    from .stats_tools import ensemble_statistics, ensemble_percentiles
+except ImportError:
+    print('Could not import stats_tools. Check that the correct versions of cdo, numpy, and netCDF4 are installed.')
+
+# Requires netcdf4
+try:
+    from .validation_tools import *
+except ImportError:
+    print('Could not import validation_tools. Check that the correct versions of numpy and netCDF4 are installed.')
+
+# Requires numpy, netcdf4 and python >= 3.8
+try:
+    from .worker_tools import start_worker, WorkerClient
+except ImportError:
+    print('Could not import worker_tools. Check that the correct versions of numpy and netCDF4 are installed.')
+
 # Requires matplotlib
 try:
     from .plotting_tools import *
@@ -0,0 +1,278 @@
+"""async_tools
+======================
+
+The async_tools module of cmipdata provides awaitable versions of the
+file-by-file operators of :mod:`preprocessing_tools` and of
+:func:`loadfiles`, for use from applications running an asyncio event loop
+(e.g. a web service). The cdo commands are identical to the blocking
+operators, but are run as asyncio subprocesses so that the event loop is
+never blocked, and netCDF reads are offloaded to a thread (one at a time,
+as netCDF4 is not thread safe).
+
+The number of cdo processes running at once is limited by a semaphore
+(max_concurrent). If the awaiting task is cancelled, the running cdo
+processes are killed, any partially written output files are removed and
+the input ensemble is left untouched.
+
+  .. moduleauthor:: Neil Swart <neil.swart@ec.gc.ca>
+"""
+import asyncio
+import concurrent.futures
+import copy
+import functools
+import os
+import signal
+import sys
+import tempfile
+from . import classes as dc
+from . import preprocessing_tools as pt
+from . import profiling as prof
+
+
+async def run_cdo(cdostr, outfiles=(), semaphore=None):
+    """Run the shell command cdostr as an asyncio subprocess.
+
+    When profiling is enabled, the command is recorded under the name of its
+    cdo operator, with the CPU time and peak resident set size of the
+    command (rather than of the event loop's thread, which runs other tasks
+    meanwhile). These are measured by a small python process which runs the
+    command and waits for it with os.wait4.
+
+    Parameters
+    ----------
+    cdostr : str
+             The (cdo) command to run.
+    outfiles : list of str
+               Files written by cdostr. They are removed if the command is
+               cancelled or fails.
+    semaphore : asyncio.Semaphore
+                Optional semaphore limiting the number of concurrent commands.
+
+    Returns
+    -------
+    int : the exit status of the command.
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+    async with semaphore:
+        with prof.record('cdo', prof._operator(cdostr), outputs=outfiles) as rec:
+            usage = None
+            if rec is not None and hasattr(os, 'wait4'):
+                usage, writer = os.pipe()
+            try:
+                # start cdo in its own process group, so that the shell and all
+                # of its children can be killed together.
+                if usage is None:
+                    proc = await asyncio.create_subprocess_shell(cdostr,
+                                                                 start_new_session=True)
+                else:
+                    try:
+                        proc = await asyncio.create_subprocess_exec(
+                            sys.executable, '-c', prof._WAIT4, str(writer), cdostr,
+                            pass_fds=(writer,), start_new_session=True)
+                    finally:
+                        os.close(writer)
+                try:
+                    ex = await proc.wait()
+                except asyncio.CancelledError:
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    await asyncio.shield(proc.wait())
+                    _remove(outfiles)
+                    raise
+                measured = os.read(usage, 64).split() if usage is not None else None
+                if measured:
+                    rec['cpu_time'] = float(measured[0])
+                    rec['peak_rss'] = int(measured[1]) * prof._RSS_UNIT
+            finally:
+                if usage is not None:
+                    os.close(usage)
+            if rec is not None and ex != 0:
+                rec['outcome'] = 'exit status ' + str(ex)
+    if ex != 0:
+        _remove(outfiles)
+    return ex
+
+
+def _remove(files):
+    for f in files:
+        if os.path.isfile(f):
+            print('deleting ' + f)
+            os.remove(f)
+
+
+async def _aprocess(ensemble, build, delete, max_concurrent, dates=None):
+    """Run the command returned by build(f) for every file f in ensemble,
+    with at most max_concurrent commands at once, and return an updated copy
+    of ensemble. build returns a (cdostr, outfile) tuple, or None to drop the
+    file. The input files are only deleted once all commands have succeeded.
+    """
+    ens = copy.deepcopy(ensemble)
+    semaphore = asyncio.Semaphore(max_concurrent)
+    files = ens.objects('ncfile')
+    jobs = [build(f) for f in files]
+
+    async def skip():
+        return None
+
+    tasks = [run_cdo(job[0], [job[1]], semaphore) if job is not None else skip()
+             for job in jobs]
+    try:
+        results = await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        # gather has cancelled the children, which removed their own partial
+        # outputs. Also remove the complete outputs of this call.
+        _remove([job[1] for job in jobs if job is not None])
+        raise
+
+    for f, job, ex in zip(files, jobs, results):
+        var = f.parent
+        if job is not None and ex == 0:
+            if dates is None:
+                start_date, end_date = f.start_date, f.end_date
+            else:
+                start_date, end_date = dates
+            ncfile = dc.DataNode('ncfile', job[1], parent=var,
+                                 start_date=start_date, end_date=end_date)
+            var.add(ncfile)
+            if delete is True:
+                os.remove(f.name)
+        var.delete(f)
+    ens.squeeze()
+    return ens
+
+
+async def aareaint(ensemble, delete=True, output_prefix='', max_concurrent=4):
+    """Awaitable version of :func:`areaint`."""
+    build = functools.partial(pt._areaint_cmd, output_prefix=output_prefix)
+    return await _aprocess(ensemble, build, delete, max_concurrent)
+
+
+async def aareamean(ensemble, delete=True, output_prefix='', max_concurrent=4):
+    """Awaitable version of :func:`areamean`."""
+    build = functools.partial(pt._areamean_cmd, output_prefix=output_prefix)
+    return await _aprocess(ensemble, build, delete, max_concurrent)
+
+
+async def azonmean(ensemble, delete=True, output_prefix='', max_concurrent=4):
+    """Awaitable version of :func:`zonmean`."""
+    build = functools.partial(pt._zonmean_cmd, output_prefix=output_prefix)
+    return await _aprocess(ensemble, build, delete, max_concurrent)
+
+
+async def aclimatology(ensemble, delete=True, output_prefix='', max_concurrent=4):
+    """Awaitable version of :func:`climatology`."""
+    build = functools.partial(pt._climatology_cmd, output_prefix=output_prefix)
+    return await _aprocess(ensemble, build, delete, max_concurrent)
+
+
+async def aremap(ensemble, remap='r360x180', method='remapdis', delete=True,
+                 output_prefix='', max_concurrent=4):
+    """Awaitable version of :func:`remap`."""
+    build = functools.partial(pt._remap_cmd, remap=remap, method=method,
+                              output_prefix=output_prefix)
+    return await _aprocess(ensemble, build, delete, max_concurrent)
+
+
+async def atime_slice(ensemble, start_date, end_date, delete=True,
+                      output_prefix='', max_concurrent=4):
+    """Awaitable version of :func:`time_slice`. Files which do not span the
+    date-range are removed from the returned ensemble.
+    """
+    start_yyyymm = start_date.replace('-', '')[0:6]
+    end_yyyymm = end_date.replace('-', '')[0:6]
+
+    def build(f):
+        if f.start_date <= start_yyyymm and f.end_date >= end_yyyymm:
+            return pt._time_slice_cmd(f, start_date, end_date, output_prefix)
+        print("%s %s is not in the date-range" % (f.parent.parent.parent.parent.name,
+                                                   f.parent.parent.name))
+        return None
+
+    return await _aprocess(ensemble, build, delete, max_concurrent,
+                           dates=(start_yyyymm, end_yyyymm))
+
+
+async def amy_operator(ensemble, my_cdo_str="", output_prefix='processed_',
+                       delete=False, max_concurrent=4):
+    """Awaitable version of :func:`my_operator`."""
+    build = functools.partial(pt._my_operator_cmd, my_cdo_str=my_cdo_str,
+                              output_prefix=output_prefix)
+    return await _aprocess(ensemble, build, delete, max_concurrent)
+
+
+async def aloadfiles(ens, varname, toDatetime=False, cdostr=None, dtype=None, masked=True,
+                     max_concurrent=4):
+    """Awaitable version of :func:`loadfiles`.
+
+    If cdostr is given, the cdo chain is applied to each file by an asyncio
+    subprocess writing to a temporary file, which is read and then removed.
+    At most max_concurrent files are processed at once. netCDF4 is not
+    thread safe, so the files are read one at a time by a thread of the
+    call's own, straight into their rows of a matrix preallocated from the
+    first file as for loadfiles (with the same dtype and masked options).
+
+    Returns
+    -------
+    EnsembleArray, as for loadfiles.
+    """
+    from . import loading_tools as lt
+    import numpy as np
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrent)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    files = ens.objects('ncfile')
+    ifiles = [f.name for f in files]
+    result = {}
+
+    def read_first(ifile):
+        # the first file gives the shape, dtype and dimensions of the data
+        shape, file_dtype = lt._var_info(ifile, varname)
+        data_dtype = np.dtype(dtype or file_dtype)
+        if not masked and data_dtype.kind != 'f':
+            raise ValueError('masked=False needs a floating point dtype to hold NaN, not ' +
+                             str(data_dtype))
+        result['data'] = np.empty((len(ifiles),) + shape, dtype=data_dtype)
+        result['mask'] = np.zeros(result['data'].shape, dtype=bool) if masked else None
+        result['dimensions'] = lt.get_dimensions(ifile, varname, toDatetime=toDatetime)
+        read(0, ifile)
+
+    def read(i, ifile):
+        mask = result['mask']
+        lt._read_into(ifile, varname, result['data'][i], mask[i] if mask is not None else None)
+
+    async def load(i, ifile, reader):
+        if cdostr is None:
+            async with semaphore:
+                return await loop.run_in_executor(executor, reader, i, ifile)
+
+        fd, tmpfile = tempfile.mkstemp(suffix='.nc')
+        os.close(fd)
+        try:
+            ex = await run_cdo('cdo -O ' + cdostr + ' ' + ifile + ' ' + tmpfile,
+                               [tmpfile], semaphore)
+            if ex != 0:
+                raise RuntimeError('cdo failed on ' + ifile)
+            return await loop.run_in_executor(executor, reader, i, tmpfile)
+        finally:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+
+    try:
+        await load(0, ifiles[0], lambda i, ifile: read_first(ifile))
+        await asyncio.gather(*[load(i, ifile, read) for i, ifile in enumerate(ifiles)
+                               if i > 0])
+    finally:
+        executor.shutdown(wait=False)
+
+    varmat = result['data']
+    if masked:
+        varmat = np.ma.masked_array(varmat, mask=result['mask'], copy=False)
+    dimensions = result['dimensions']
+    dimensions['models'] = lt.get_models(files)
+    dimensions['realizations'] = lt.get_realizations(files)
+    dimensions['experiments'] = lt.get_experiments(files)
+    return lt.EnsembleArray(varmat, dimensions)
@@ -27,6 +27,7 @@ the :mod:`preprocessing_tools` to apply systematic operations to all files.
 import os
 import glob
 import copy
+from . import profiling as prof
 
 class DataNode(object):
     """ Defines a cmipdata DataNode.
@@ -198,6 +199,7 @@ class DataNode(object):
          
         
         
+    @prof.profiled('tree')
     def squeeze(self):
         """ Remove any empty elements from the ensemble
         """
@@ -268,6 +270,7 @@ class DataNode(object):
                             for filename in variable.children:
                                 f.write('\t\t\t\t' + filename.name + '\n')
 
+@prof.profiled('tree')
 def mkensemble(filepattern, experiment='*', prefix='', kwargs=''):
     """Creates and returns a cmipdata ensemble from a list of
     filenames matching filepattern.
@@ -382,6 +385,7 @@ def mkensemble(filepattern, experiment='*', prefix='', kwargs=''):
     return ens
 
 
+@prof.profiled('tree')
 def match_models(ens1, ens2, delete=False):
     """
     Find common models between two ensembles.
@@ -431,6 +435,7 @@ def match_models(ens1, ens2, delete=False):
     return ens1, ens2
 
 
+@prof.profiled('tree')
 def match_realizations(ens1, ens2, delete=False):
     """
     Find common realizations between two ensembles.
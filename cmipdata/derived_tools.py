@@ -0,0 +1,287 @@
+"""derived_tools
+======================
+
+The derived_tools module of cmipdata computes derived variables, such as
+the wind speed from uas and vas, or the net heat flux from its components,
+from several ensembles at once. Files are matched across the ensembles on
+model, experiment and realization, and on their time steps, and the data
+are streamed through the expression a chunk of time steps at a time, so
+that memory use is bounded whatever the size of the files. The results are
+written to new netCDF files, and returned as a new ensemble.
+
+Examples
+--------
+
+1. Wind speed from uas and vas::
+
+    uas = cd.mkensemble('uas_Amon_*')
+    vas = cd.mkensemble('vas_Amon_*')
+    sfcwind = cd.derive({'uas': uas, 'vas': vas}, 'sqrt(uas**2 + vas**2)',
+                        'sfcWind', units='m s-1')
+
+2. Any function of the variables, as a python callable::
+
+    hfnet = cd.derive({'hfls': hfls, 'hfss': hfss, 'rlds': rlds},
+                      lambda hfls, hfss, rlds: rlds - hfls - hfss, 'hfnet')
+
+  .. moduleauthor:: Neil Swart <neil.swart@ec.gc.ca>
+"""
+import os
+import copy
+import numpy as np
+from netCDF4 import Dataset
+from . import classes as dc
+from . import loading_tools as lt
+from . import profiling as prof
+from .time_tools import _fields
+
+# the functions which may be used in an expression given as a string. The
+# masked versions are used, so that missing values stay missing.
+_FUNCTIONS = dict((name, getattr(np.ma, name)) for name in
+                  ('sqrt', 'exp', 'log', 'log10', 'abs', 'sin', 'cos', 'tan', 'arctan2',
+                   'maximum', 'minimum', 'where', 'power', 'hypot'))
+_FUNCTIONS['np'] = np
+
+
+def derive(ensembles, expression, output_variable, units=None, long_name=None,
+           output_prefix='', max_memory=256 * 1024 ** 2):
+    """
+    Compute a derived variable from the variables in several ensembles, and
+    write it to a new ensemble of netCDF files.
+
+    The files are paired with a hash join on model-experiment-realization.
+    Within each realization, the time steps of each file of the first
+    variable are matched by date to the time steps of the other variables,
+    which may be split over files differently; only the time steps found
+    for every variable are computed. Matching time steps are then read a
+    chunk at a time and passed through the expression.
+
+    Parameters
+    ----------
+    ensembles : dict
+                Maps the name of each variable to the ensemble holding it.
+                The first variable gives the grid, time axis and file names
+                of the output.
+    expression : str or callable
+                 Either a string such as 'sqrt(uas**2 + vas**2)', using the
+                 variable names, the functions sqrt, exp, log, log10, abs,
+                 sin, cos, tan, arctan2, maximum, minimum, where, power and
+                 hypot, and np; or a callable taking the variables as
+                 keyword arguments. Variables are passed as masked arrays
+                 of shape (time, ...).
+    output_variable : str
+                      The name of the derived variable, which replaces the
+                      name of the first variable in the output file names.
+    units, long_name : str
+                       Attributes of the output variable, which has the dtype
+                       of the first variable (at least float32) and the fill
+                       value 1e20.
+    output_prefix : str
+                    Prepended to the output file names.
+    max_memory : int
+                 The number of bytes of input and output data held in memory
+                 at a time, which sets the number of time steps per chunk.
+
+    Returns
+    -------
+    ens : cmipdata Ensemble
+          The ensemble of the output files, written to the present working
+          directory.
+    """
+    names = list(ensembles)
+    if not names:
+        raise ValueError('no ensembles given')
+
+    # index the files of each variable by model-experiment-realization
+    tables = {}
+    for name in names:
+        table = {}
+        for variable in ensembles[name].objects('variable'):
+            if variable.name != name:
+                continue
+            key = (variable.parentobject('model').name,
+                   variable.parentobject('experiment').name,
+                   variable.parentobject('realization').name)
+            table.setdefault(key, []).extend(f.name for f in variable.children)
+        if not table:
+            raise ValueError('no files found for ' + name)
+        tables[name] = table
+
+    # the join, built on the first variable
+    matches = [key for key in tables[names[0]] if all(key in tables[n] for n in names[1:])]
+
+    ens = copy.deepcopy(ensembles[names[0]])
+    matched = set(matches)
+    for variable in list(ens.objects('variable')):
+        realization = variable.parent
+        key = (variable.parentobject('model').name, variable.parentobject('experiment').name,
+               realization.name)
+        if variable.name != names[0] or key not in matched:
+            realization.delete(variable)
+            continue
+        outputs = []
+        timelines = dict((n, _timeline(tables[n][key], n)) for n in names[1:])
+        for f in sorted(variable.children, key=lambda f: f.name):
+            outfile = _derive_file(f.name, names, timelines, expression, output_variable,
+                                   units, long_name, output_prefix, max_memory)
+            if outfile is not None:
+                outputs.append(dc.DataNode('ncfile', outfile, parent=variable,
+                                           start_date=getattr(f, 'start_date', None),
+                                           end_date=getattr(f, 'end_date', None)))
+        variable.children = []
+        variable.name = output_variable
+        for ncfile in outputs:
+            variable.add(ncfile)
+    ens.squeeze()
+    return ens
+
+
+def _dates(ifile, varname):
+    """The dates of the time steps of varname in ifile, in its own calendar,
+    as the integers ((YYYY * 100 + MM) * 100 + DD) * 86400 + seconds of the
+    day, so that e.g. 30 February of a 360_day calendar is kept apart from
+    28 February."""
+    with lt._dataset(ifile) as nc:
+        dimension = nc.variables[varname].dimensions[0]
+        nc_time = nc.variables[dimension]
+        values = np.asarray(lt._coordinate(nc, dimension), dtype='f8')
+        calendar = (getattr(nc_time, 'calendar', None) or 'standard').lower()
+        year, month, day, seconds = _fields(values, nc_time.units, calendar)
+    return ((year * 100 + month) * 100 + day) * 86400 + seconds
+
+
+def _timeline(ifiles, varname):
+    """The time steps of varname in the files ifiles of one realization,
+    sorted by date: a tuple of the dates, and the file and step of each."""
+    dates, files, steps = [], [], []
+    for ifile in ifiles:
+        d = _dates(ifile, varname)
+        dates.append(d)
+        files.extend([ifile] * len(d))
+        steps.append(np.arange(len(d)))
+    dates = np.concatenate(dates)
+    order = np.argsort(dates, kind='stable')
+    return dates[order], np.array(files, dtype=object)[order], np.concatenate(steps)[order]
+
+
+def _read_steps(varname, files, steps, shape, dtype):
+    """Read the time steps steps[i] of files[i] into a masked array, reading
+    runs of consecutive steps of the same file at once."""
+    data = np.empty((len(steps),) + shape, dtype=dtype)
+    mask = np.zeros(data.shape, dtype=bool)
+    start = 0
+    for i in range(1, len(steps) + 1):
+        if i < len(steps) and files[i] == files[start] and steps[i] == steps[i - 1] + 1:
+            continue
+        lt._read_into(files[start], varname, data[start:i], mask[start:i],
+                      {'steps': (int(steps[start]), int(steps[i - 1]) + 1)})
+        start = i
+    return np.ma.masked_array(data, mask=mask, copy=False)
+
+
+def _evaluate(expression, arrays):
+    if callable(expression):
+        return expression(**arrays)
+    namespace = dict(_FUNCTIONS)
+    namespace['__builtins__'] = {}
+    return eval(expression, namespace, arrays)
+
+
+def _derive_file(ifile, names, timelines, expression, output_variable, units, long_name,
+                 output_prefix, max_memory):
+    """Compute the derived variable for the time steps of ifile (of the first
+    variable) found for all the variables. Returns the output file name, or
+    None if no time steps match."""
+    dates = _dates(ifile, names[0])
+    keep = np.ones(len(dates), dtype=bool)
+    positions = {}
+    for n in names[1:]:
+        other = timelines[n][0]
+        idx = np.minimum(np.searchsorted(other, dates), max(len(other) - 1, 0))
+        keep &= (len(other) > 0) & (other[idx] == dates)
+        positions[n] = idx
+    steps = np.nonzero(keep)[0]
+    if not len(steps):
+        print('No time steps of ' + ifile + ' are found for all of ' + ', '.join(names))
+        return None
+
+    shapes = {}
+    for n in names:
+        source = ifile if n == names[0] else timelines[n][1][positions[n][steps[0]]]
+        shapes[n] = lt._var_info(source, n, {'steps': (0, 1)})
+    rowbytes = sum(int(np.prod(s)) * np.dtype(d).itemsize for s, d in shapes.values())
+    chunk = max(int(max_memory // (2 * max(rowbytes, 1))), 1)
+
+    basename = os.path.basename(ifile)
+    if basename.startswith(names[0] + '_'):
+        basename = output_variable + basename[len(names[0]):]
+    else:
+        basename = output_variable + '_' + basename
+    outfile = output_prefix + basename
+
+    with prof.record('netcdf', 'derive', inputs=[ifile], outputs=[outfile]):
+        out = _create_output(ifile, names[0], outfile, output_variable, steps, units,
+                             long_name, expression)
+        try:
+            ncvar = out.variables[output_variable]
+            for a in range(0, len(steps), chunk):
+                s = steps[a:a + chunk]
+                arrays = {names[0]: _read_steps(names[0], [ifile] * len(s), s, *shapes[names[0]])}
+                for n in names[1:]:
+                    idx = positions[n][s]
+                    arrays[n] = _read_steps(n, timelines[n][1][idx], timelines[n][2][idx],
+                                            *shapes[n])
+                result = np.ma.asarray(_evaluate(expression, arrays))
+                ncvar[a:a + len(s)] = result.reshape((len(s),) + ncvar.shape[1:])
+        finally:
+            out.close()
+    return outfile
+
+
+def _create_output(ifile, varname, outfile, output_variable, steps, units, long_name,
+                   expression):
+    """Create outfile with the dimensions, coordinates and global attributes
+    of varname in ifile, keeping only the given time steps, and an empty
+    output_variable in the dtype varname is loaded as (at least float32, to
+    hold the fill value 1e20 of missing data)."""
+    dtype = np.result_type(lt._var_info(ifile, varname)[1], 'f4')
+    with lt._dataset(ifile) as nc:
+        ncvar = nc.variables[varname]
+        timedim = ncvar.dimensions[0]
+        out = Dataset(outfile, 'w')
+        out.setncatts(dict((a, nc.getncattr(a)) for a in nc.ncattrs()))
+        history = getattr(nc, 'history', '')
+        out.history = ('cmipdata derive ' + output_variable + ' = ' + str(expression) +
+                       ('\n' + history if history else ''))
+        for name, dim in nc.dimensions.items():
+            if name == timedim:
+                out.createDimension(name, None)
+            else:
+                out.createDimension(name, len(dim))
+
+        # the coordinates and bounds, with the time steps kept
+        for name, var in nc.variables.items():
+            if name == varname or not set(var.dimensions) <= set(ncvar.dimensions) | set(
+                    d for d in nc.dimensions if 'bnd' in d or 'bound' in d):
+                continue
+            if not var.dimensions:
+                continue
+            copy_var = out.createVariable(name, var.dtype, var.dimensions)
+            copy_var.setncatts(dict((a, var.getncattr(a)) for a in var.ncattrs()
+                                    if a != '_FillValue'))
+            if var.dimensions[0] == timedim:
+                copy_var[:] = var[steps]
+            else:
+                copy_var[:] = var[:]
+
+        fill = dtype.type(1e20)
+        derived = out.createVariable(output_variable, dtype, ncvar.dimensions, fill_value=fill)
+        derived.missing_value = fill
+        if units is not None:
+            derived.units = units
+        derived.long_name = long_name or (output_variable + ' = ' + str(expression)
+                                          if not callable(expression) else output_variable)
+        for attr in ('cell_methods', 'coordinates'):
+            if attr in ncvar.ncattrs():
+                derived.setncattr(attr, ncvar.getncattr(attr))
+    return out
@@ -12,9 +12,28 @@ remapping, time-slicing, time-averaging and zonal-averaging.
 import cdo as cdo
 cdo = cdo.Cdo()  # recommended import
 import os
+import re
+import mmap
+import contextlib
+import pickle
+import queue
+import shutil
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+import concurrent.futures
 import numpy as np
-from netCDF4 import Dataset, num2date, date2num
+from netCDF4 import Dataset, date2num, default_fillvals
+import cftime
 import datetime
+from collections import OrderedDict
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+from . import profiling as prof
+from .time_tools import decode_times, from_int_dates
 
 # clean out tmp to make space for CDO processing.
 os.system('rm -rf /tmp/cdo*')
@@ -28,63 +47,559 @@ def loadvar(ifile, varname, cdostr=None, **kwargs):
         cdo string for preprocessing the data from the netCDF files.
         Requires netCDF4, CDO and CDO python bindings.
         Returns a masked array, var.
+
+        Instead of a cdostr, a selection can be given with the keyword
+        arguments below. The selection is resolved against the coordinate
+        variables and only the selected hyperslab is read from disk.
+
+        dates : tuple of str
+                (start_date, end_date) with format YYYY-MM-DD, inclusive.
+        lat : tuple
+              (south, north) latitude limits.
+        lon : tuple
+              (west, east) longitude limits. The box may cross the
+              longitude seam of the grid, e.g. lon=(-30, 60) on a 0-360 grid.
+        level : list
+                The level values to select (nearest match) from the
+                vertical dimension.
+        stride : dict
+                 Steps to take along each dimension, e.g. {'time': 12}.
+
+        Example: the tropical Pacific from 1979 to 2008, every second level::
+
+            ts = loadvar(ifile, 'ta', dates=('1979-01-01', '2008-12-31'),
+                         lat=(-20, 20), lon=(120, 280), stride={'level': 2})
+
+        The data (or the selection) can also be reduced as it is read, with
+        the reduce keyword argument, see loadfiles.
       """
-    # Open the variable using NetCDF4 to get scale and offset attributes.
-    nc = Dataset(ifile, 'r')
-    ncvar = nc.variables[varname]
-    
+    selection = _selection(kwargs)
+    if cdostr and (selection or kwargs.get('reduce')):
+        raise ValueError('a selection or reduce cannot be combined with a cdostr')
+    if kwargs.get('reduce'):
+        return _reduce(ifile, varname, kwargs['reduce'], selection)[0]
+
     # apply cdo string if it exists
     if(cdostr):
         opslist = cdostr.split()
         base_op = opslist[0].replace('-', '')
-        if len(opslist) > 1:
-            ops_str = ' '.join(opslist[1::]) + ' ' + ifile
-            var = getattr(cdo, base_op)(input=ops_str, returnMaArray=varname)
+        # the cdo bindings read the output with netCDF4
+        with prof.record('cdo', base_op, inputs=[ifile]), _netcdf_lock:
+            if len(opslist) > 1:
+                ops_str = ' '.join(opslist[1::]) + ' ' + ifile
+                var = getattr(cdo, base_op)(input=ops_str, returnMaArray=varname)
+            else:
+                var = getattr(cdo, base_op)(input=ifile, returnMaArray=varname)
+        return np.squeeze(var)
+
+    shape, dtype = _var_info(ifile, varname, selection)
+    var = np.empty(shape, dtype=dtype)
+    mask = np.zeros(shape, dtype=bool)
+    _read_into(ifile, varname, var, mask, selection)
+    return np.ma.masked_array(var, mask=mask, copy=False)
+
+
+# keyword arguments of loadvar and loadfiles selecting a hyperslab
+_SELECTIONS = ('dates', 'lat', 'lon', 'level', 'stride')
+
+
+def _selection(kwargs):
+    return dict((k, kwargs[k]) for k in _SELECTIONS if kwargs.get(k) is not None)
+
+
+def _dim_kind(nc, dimension):
+    """Classify a dimension as 'time', 'lat', 'lon' or 'level' (any other
+    dimension with a coordinate variable)."""
+    name = dimension.lower()
+    for kind in ('time', 'lat', 'lon'):
+        if name.startswith(kind):
+            return kind
+    if dimension in nc.variables:
+        return 'level'
+    return None
+
+
+def _date_to_num(date, units, calendar, offset_days=0):
+    """Convert a YYYY-MM-DD string to a time value in units and calendar,
+    optionally offset by a number of days."""
+    year, month, day = [int(x) for x in date.split('-')]
+    if calendar == '360_day':
+        day = min(day, 30)
+    d = cftime.datetime(year, month, day, calendar=calendar) + datetime.timedelta(days=offset_days)
+    return date2num(d, units, calendar)
+
+
+def _runs(indices):
+    """Split sorted or wrapped integer indices into a list of contiguous
+    slices."""
+    breaks = np.nonzero(np.diff(indices) != 1)[0] + 1
+    return [slice(int(r[0]), int(r[-1]) + 1) for r in np.split(indices, breaks)]
+
+
+def _hyperslab(nc, ncvar, dates=None, lat=None, lon=None, level=None, stride=None,
+               steps=None, rows=None, columns=None):
+    """Resolve a selection to one index per dimension of ncvar. Each index is
+    a slice, or a list of slices (for longitudes wrapping around the seam),
+    or a sorted integer array (for levels). steps=(a, b) further restricts
+    the selected time steps to the a-th to the b-th, as used by iterfiles,
+    and rows=(a, b) and columns=(a, b) the selected latitudes and
+    longitudes likewise, as used by ensemble_percentiles and loadregions."""
+    stride = stride or {}
+    index = []
+    for dimension in ncvar.dimensions:
+        kind = _dim_kind(nc, dimension)
+        step = stride.get(kind) or stride.get(dimension)
+        idx = slice(None)
+        if kind == 'time' and dates is not None:
+            nc_time = nc.variables[dimension]
+            calendar = getattr(nc_time, 'calendar', 'standard')
+            values = _coordinate(nc, dimension)
+            start = _date_to_num(dates[0], nc_time.units, calendar)
+            end = _date_to_num(dates[1], nc_time.units, calendar, offset_days=1)
+            idx = slice(int(np.searchsorted(values, start, side='left')),
+                        int(np.searchsorted(values, end, side='left')))
+        elif kind == 'lat' and lat is not None:
+            values = _coordinate(nc, dimension)
+            sel = np.nonzero((values >= min(lat)) & (values <= max(lat)))[0]
+            idx = slice(int(sel[0]), int(sel[-1]) + 1) if len(sel) else slice(0, 0)
+        elif kind == 'lon' and lon is not None:
+            values = np.asarray(_coordinate(nc, dimension), dtype='f8')
+            width = lon[1] - lon[0]
+            width = 360. if width >= 360. else width % 360. or 360.
+            offset = (values - lon[0]) % 360.
+            sel = np.nonzero(offset <= width)[0]
+            sel = sel[np.argsort(offset[sel], kind='stable')]
+            idx = _runs(sel) if len(sel) else slice(0, 0)
+            if isinstance(idx, list) and len(idx) == 1:
+                idx = idx[0]
+        elif kind == 'level' and level is not None:
+            values = _coordinate(nc, dimension)
+            idx = np.unique([np.argmin(np.abs(values - v)) for v in np.atleast_1d(level)])
+        if step:
+            if isinstance(idx, list):
+                idx = [slice(p.start, p.stop, step) for p in idx]
+            elif isinstance(idx, slice):
+                idx = slice(idx.start, idx.stop, step)
+            else:
+                idx = idx[::step]
+        if kind == 'time' and steps is not None:
+            idx = _first_axis_block(idx, ncvar.shape[len(index)], *steps)
+        if kind == 'lat' and rows is not None:
+            idx = _first_axis_block(idx, ncvar.shape[len(index)], *rows)
+        if kind == 'lon' and columns is not None:
+            idx = _first_axis_block(idx, ncvar.shape[len(index)], *columns)
+        index.append(idx)
+    return tuple(index)
+
+
+def _index_len(idx, n):
+    if isinstance(idx, list):
+        return sum(len(range(*p.indices(n))) for p in idx)
+    if isinstance(idx, slice):
+        return len(range(*idx.indices(n)))
+    return len(idx)
+
+
+def _read(ncvar, index):
+    """Read the hyperslab index from ncvar, joining wrapped pieces."""
+    for axis, idx in enumerate(index):
+        if isinstance(idx, list):
+            pieces = [_read(ncvar, index[:axis] + (p,) + index[axis + 1:]) for p in idx]
+            return np.concatenate(pieces, axis=axis)
+    return ncvar[index]
+
+
+def _first_axis_block(idx, n, a, b):
+    """The index selecting items a to b of the index idx along an axis of
+    length n."""
+    if isinstance(idx, slice):
+        start, stop, step = idx.indices(n)
+        return slice(start + a * step, min(start + b * step, stop), step)
+    if isinstance(idx, list):
+        idx = np.concatenate([np.arange(*p.indices(n)) for p in idx])
+    return idx[a:b]
+
+
+def _var_info(ifile, varname, selection=None):
+    """Returns the squeezed shape of varname in ifile (or of the selection
+    from it) and the dtype it is loaded as (the dtype of
+    scale_factor/add_offset if the data is packed)."""
+    with _dataset(ifile) as nc:
+        ncvar = nc.variables[varname]
+        shape = ncvar.shape
+        if selection and ncvar.ndim:
+            index = _hyperslab(nc, ncvar, **selection)
+            shape = tuple(_index_len(idx, n) for idx, n in zip(index, ncvar.shape))
+        shape = tuple(n for n in shape if n != 1)
+        dtype = ncvar.dtype
+        for attr in ('scale_factor', 'add_offset'):
+            if attr in ncvar.ncattrs():
+                dtype = np.result_type(dtype, np.asarray(getattr(ncvar, attr)).dtype)
+    return shape, dtype
+
+
+def _fill_values(ncvar):
+    """The raw values of ncvar which mark missing data."""
+    attrs = ncvar.ncattrs()
+    fills = []
+    for attr in ('_FillValue', 'missing_value'):
+        if attr in attrs:
+            fills.extend(np.atleast_1d(getattr(ncvar, attr)).tolist())
+    if not fills and ncvar.dtype.str[1:] in default_fillvals and ncvar.dtype.itemsize > 1:
+        fills.append(default_fillvals[ncvar.dtype.str[1:]])
+    return fills
+
+
+# Files are read in blocks of at most this many bytes along the first axis,
+# so that the temporary raw array stays small.
+_READ_BLOCK = 64 * 1024 ** 2
+
+
+def _read_into(ifile, varname, out, mask=None, selection=None):
+    """Read varname (or the hyperslab given by selection) from ifile straight
+    into the preallocated array out, whose shape is the squeezed shape of the
+    data. Missing data, identified by the _FillValue and missing_value
+    attributes of the variable, is flagged in the boolean array mask or, if
+    mask is None, set to NaN in out.
+    """
+    with prof.record('netcdf', 'loadvar', inputs=[ifile]) as rec:
+        with _dataset(ifile) as nc:
+            ncvar = nc.variables[varname]
+            ncvar.set_auto_maskandscale(False)
+            fills = _fill_values(ncvar)
+            scale = getattr(ncvar, 'scale_factor', None)
+            offset = getattr(ncvar, 'add_offset', None)
+
+            index, shape = _index_shape(nc, ncvar, selection)
+            view = _unsqueeze(out, shape, ifile, varname)
+            mview = _unsqueeze(mask, shape, ifile, varname) if mask is not None else None
+            for a, raw, missing in _raw_blocks(ncvar, index, shape, fills):
+                block = view[a:a + len(raw)]
+                block[...] = raw
+                if scale is not None:
+                    block *= scale
+                if offset is not None:
+                    block += offset
+                if mview is not None:
+                    mview[a:a + len(raw)] = missing
+                else:
+                    block[missing] = np.nan
+            if rec is not None:
+                rec['bytes_read'] = out.nbytes
+
+
+def _unsqueeze(out, shape, ifile, varname):
+    """A view of out with the (unsqueezed) shape of the data read from
+    ifile, given by inserting the unit axes. Raises ValueError if the
+    squeezed shapes of out and the data differ."""
+    squeezed = tuple(n for n in shape if n != 1)
+    if tuple(n for n in out.shape if n != 1) != squeezed:
+        raise ValueError('%s in %s has shape %s, expected %s' %
+                         (varname, ifile, squeezed, tuple(n for n in out.shape if n != 1)))
+    return np.expand_dims(np.squeeze(out), tuple(i for i, n in enumerate(shape) if n == 1))
+
+
+def _index_shape(nc, ncvar, selection=None):
+    """The hyperslab index of the selection from ncvar and its (unsqueezed)
+    shape. A scalar variable is treated as having one element."""
+    if ncvar.ndim == 0:
+        return (slice(None),), (1,)
+    index = _hyperslab(nc, ncvar, **(selection or {}))
+    return index, tuple(_index_len(idx, n) for idx, n in zip(index, ncvar.shape))
+
+
+def _raw_blocks(ncvar, index, shape, fills):
+    """Read the hyperslab index of ncvar (with auto mask and scale off) in
+    blocks of at most _READ_BLOCK bytes along the first axis. Yields the
+    position of each block along the first axis, the raw block with the
+    given shape, and a boolean array flagging the missing values."""
+    rowbytes = max(ncvar.dtype.itemsize * int(np.prod(shape[1:])), 1)
+    step = max(_READ_BLOCK // rowbytes, 1)
+    for a in range(0, shape[0], step):
+        if ncvar.ndim == 0:
+            raw = np.asarray(ncvar[...])
         else:
-            var = getattr(cdo, base_op)(input=ifile, returnMaArray=varname)
+            block_index = (_first_axis_block(index[0], ncvar.shape[0], a, a + step),)
+            raw = np.asarray(_read(ncvar, block_index + index[1:]))
+        raw = raw.reshape((min(step, shape[0] - a),) + tuple(shape[1:]))
+        missing = np.zeros(raw.shape, dtype=bool)
+        for fill in fills:
+            missing |= (raw == fill)
+        if raw.dtype.kind == 'f':
+            missing |= np.isnan(raw)
+        yield a, raw, missing
+
+
+# the reductions loadfiles can apply as the data is read
+_TIME_REDUCTIONS = ('timmean', 'yearmean', 'seasmean')
+_SPACE_REDUCTIONS = ('zonmean', 'fldmean')
+
 
+def _reductions(reduce):
+    """Parse reduce, a list of reduction names or a string such as
+    '-yearmean -fldmean', into a list of names."""
+    if isinstance(reduce, str):
+        reduce = reduce.split()
+    ops = [op.lstrip('-') for op in reduce]
+    for op in ops:
+        if op not in _TIME_REDUCTIONS + _SPACE_REDUCTIONS:
+            raise ValueError('unknown reduction ' + op + ', expected one of ' +
+                             ', '.join(_TIME_REDUCTIONS + _SPACE_REDUCTIONS))
+    if len([op for op in ops if op in _TIME_REDUCTIONS]) > 1:
+        raise ValueError('at most one of ' + ', '.join(_TIME_REDUCTIONS) + ' can be applied')
+    return ops
+
+
+def _time_groups(nc, dimension, idx, op):
+    """Integer group codes of the selected time steps for the time reduction
+    op. Seasons are DJF, MAM, JJA and SON, with December counted in the
+    following year's DJF."""
+    nc_time = nc.variables[dimension]
+    values = _take(_coordinate(nc, dimension), idx)
+    if op == 'timmean':
+        return np.zeros(len(values), dtype=int)
+    dates = decode_times(values, nc_time.units, getattr(nc_time, 'calendar', 'standard'), form='int')
+    years = dates // 10000
+    if op == 'yearmean':
+        labels = years
     else:
-        var = cdo.readMaArray(ifile, varname=varname)
+        months = dates // 100 % 100
+        labels = (years + (months == 12)) * 4 + (months % 12) // 3
+    # consecutive steps with the same label form a group
+    return np.concatenate([[0], np.cumsum(labels[1:] != labels[:-1])]).astype(int)
 
-    # Apply any scaling and offsetting needed:
-    try:
-        var_offset = ncvar.add_offset
-    except:
-        var_offset = 0
-    try:
-        var_scale = ncvar.scale_factor
-    except:
-        var_scale = 1
 
-    # var = var*var_scale + var_offset
-    # return var
-    return np.squeeze(var)
+def _reduce(ifile, varname, reduce, selection=None):
+    """Read varname (or the selection from it) from ifile and apply the
+    reductions in reduce, block by block as the data is read.
+
+    Missing values are left out, so that each mean is over all valid points
+    it covers (weighted by cos(latitude) for fldmean). Returns the reduced
+    masked array, squeezed, and the indices into the selected time axis of
+    the middle time step of each group of a time reduction (None if there is
+    no time reduction).
+    """
+    ops = _reductions(reduce)
+    with prof.record('netcdf', 'reduce', inputs=[ifile]) as rec:
+        with _dataset(ifile) as nc:
+            ncvar = nc.variables[varname]
+            ncvar.set_auto_maskandscale(False)
+            fills = _fill_values(ncvar)
+            scale = getattr(ncvar, 'scale_factor', None)
+            offset = getattr(ncvar, 'add_offset', None)
+            index, shape = _index_shape(nc, ncvar, selection)
+            kinds = [_dim_kind(nc, d) for d in ncvar.dimensions]
+
+            # the spatial reductions, applied to each block in turn
+            space = []
+            remaining = list(kinds)
+            for op in ops:
+                if op not in _SPACE_REDUCTIONS:
+                    continue
+                reduced = ['lon'] if op == 'zonmean' else ['lat', 'lon']
+                weights = None
+                for kind in reduced:
+                    if kind not in kinds:
+                        raise ValueError(varname + ' has no ' + kind + ' dimension for ' + op)
+                if op == 'fldmean' and 'lat' in remaining:
+                    dimension = ncvar.dimensions[kinds.index('lat')]
+                    lat = _take(_coordinate(nc, dimension), index[kinds.index('lat')])
+                    weights = np.cos(np.deg2rad(np.asarray(lat, dtype='f8')))
+                axes = tuple(remaining.index(k) for k in reduced if k in remaining)
+                space.append((axes, remaining.index('lat') if weights is not None else None, weights))
+                remaining = [k for i, k in enumerate(remaining) if i not in axes]
+
+            time_op = [op for op in ops if op in _TIME_REDUCTIONS]
+            groups = None
+            if time_op:
+                if kinds[0] != 'time':
+                    raise ValueError(varname + ' has no leading time dimension for ' + time_op[0])
+                groups = _time_groups(nc, ncvar.dimensions[0], index[0], time_op[0])
+
+            total = weight = None
+            blocks = []
+            for a, raw, missing in _raw_blocks(ncvar, index, shape, fills):
+                data = raw.astype('f8')
+                if scale is not None:
+                    data *= scale
+                if offset is not None:
+                    data += offset
+                valid = (~missing).astype('f8')
+                data[missing] = 0.
+                for axes, lat_axis, weights in space:
+                    if weights is not None:
+                        w = weights.reshape([-1 if i == lat_axis else 1 for i in range(data.ndim)])
+                        data, valid = data * w, valid * w
+                    data, valid = data.sum(axis=axes), valid.sum(axis=axes)
+                if groups is None:
+                    blocks.append((data, valid))
+                    continue
+                if total is None:
+                    total = np.zeros((groups[-1] + 1,) + data.shape[1:])
+                    weight = np.zeros(total.shape)
+                codes = groups[a:a + len(data)]
+                starts = np.concatenate([[0], np.nonzero(np.diff(codes))[0] + 1])
+                total[codes[starts]] += np.add.reduceat(data, starts, axis=0)
+                weight[codes[starts]] += np.add.reduceat(valid, starts, axis=0)
+            if groups is None and any(0 in axes for axes, _, _ in space):
+                # the first axis itself was reduced, so blocks are summed
+                total, weight = sum(b[0] for b in blocks), sum(b[1] for b in blocks)
+            elif groups is None:
+                total = np.concatenate([b[0] for b in blocks])
+                weight = np.concatenate([b[1] for b in blocks])
+            if rec is not None:
+                rec['bytes_read'] = int(np.prod(shape)) * ncvar.dtype.itemsize
 
+    var = np.ma.masked_array(total / np.where(weight > 0, weight, 1.), mask=weight == 0)
+    steps = None
+    if groups is not None:
+        starts = np.concatenate([[0], np.nonzero(np.diff(groups))[0] + 1, [len(groups)]])
+        steps = (starts[:-1] + starts[1:] - 1) // 2
+    return np.ma.squeeze(var), steps
 
-def _create_tempfile(ens, varname, ifileone, cdostr=None, **kwargs):
+
+# cdo operators which leave the dimensions of the data unchanged
+_POINTWISE_OPS = ('selvar', 'selname', 'chname', 'setname', 'setunit', 'setattribute',
+                  'addc', 'subc', 'mulc', 'divc', 'abs', 'sqr', 'sqrt', 'exp', 'ln', 'log10',
+                  'setmisstoc', 'setctomiss', 'setrtomiss', 'setvrange', 'setmissval')
+_TIMMEAN_OPS = ('timmean', 'timavg', 'timsum', 'timmin', 'timmax', 'timstd', 'timvar')
+_YEAR_OPS = ('yearmean', 'yearavg', 'yearsum', 'yearmin', 'yearmax', 'yearstd')
+_SEAS_OPS = ('seasmean', 'seasavg', 'seassum', 'seasmin', 'seasmax', 'seasstd')
+_MON_OPS = ('monmean', 'monavg', 'monsum', 'monmin', 'monmax', 'monstd')
+_ZON_OPS = ('zonmean', 'zonavg', 'zonsum', 'zonmin', 'zonmax', 'zonstd')
+_FLD_OPS = ('fldmean', 'fldavg', 'fldsum', 'fldmin', 'fldmax', 'fldstd')
+
+
+def _infer_dimensions(ifile, varname, cdostr, toDatetime=False):
     """
-        _create_tempfile is called when modifications are made to the ensemeble without
-        creating new files. Creates a temporary file that can be used to determine dimensions of
-        the modified data.
+    Derive the dimensions of the output of the cdo chain cdostr applied to
+    ifile from the input header and coordinates alone, without running cdo.
+
+    Time statistics (tim*, year*, seas*, mon*), zonal and field statistics,
+    seldate, selyear, selmon, sellevel, sellonlatbox, remapping to a global
+    rNxM grid, and operators which do not change the dimensions (selvar,
+    arithmetic with constants, ...) are modelled. Returns None if any
+    operator in cdostr cannot be modelled.
     """
-    if(cdostr):
-        opslist = cdostr.split()
-        op = opslist[0].replace('-', '')
-        cdo_str = 'cdo ' + op + ' ' + ifileone + ' temporary_0.nc'
-        ex = os.system(cdo_str)
-        if len(opslist) > 1:
-            for i in range(1, len(opslist)):
-                op = opslist[i].replace('-', '')
-                cdo_str = 'cdo ' + op + ' ' + 'temporary_' + str(i-1) + '.nc' + ' temporary_' + str(i) + '.nc'
-                ex = os.system(cdo_str)
-                os.remove('temporary_' + str(i-1) + '.nc')
-                if i == len(opslist)-1:
-                    os.rename('temporary_' + str(len(opslist)-1) + '.nc', 'temp123.nc')
+    dimensions = _get_dimensions(ifile, varname)
+    units, calendar = None, 'standard'
+    if 'time' in dimensions:
+        with _dataset(ifile) as nc:
+            for dimension in nc.variables[varname].dimensions:
+                if dimension.lower().startswith('time'):
+                    units = nc.variables[dimension].units
+                    calendar = getattr(nc.variables[dimension], 'calendar', 'standard')
+
+    # cdo applies the last operator of the chain first
+    for op in reversed(cdostr.split()):
+        name = op.lstrip('-').split(',')[0]
+        args = op.lstrip('-').split(',')[1:]
+        if name in _POINTWISE_OPS:
+            continue
+        if name in _ZON_OPS + _FLD_OPS:
+            if 'lon' not in dimensions:
+                return None
+            dimensions['lon'] = np.array([0.])
+            if name in _FLD_OPS:
+                if 'lat' not in dimensions:
+                    return None
+                dimensions['lat'] = np.array([0.])
+            continue
+        if name.startswith('remap') and len(args) == 1:
+            grid = re.match(r'^r(\d+)x(\d+)$', args[0])
+            if not grid or 'lat' not in dimensions or 'lon' not in dimensions:
+                return None
+            nlon, nlat = int(grid.group(1)), int(grid.group(2))
+            dimensions['lon'] = np.arange(nlon) * 360. / nlon
+            dimensions['lat'] = -90. + (np.arange(nlat) + 0.5) * 180. / nlat
+            continue
+        if name == 'sellonlatbox' and len(args) == 4:
+            lon1, lon2, lat1, lat2 = [float(a) for a in args]
+            if 'lat' not in dimensions or 'lon' not in dimensions:
+                return None
+            lat = dimensions['lat']
+            dimensions['lat'] = lat[(lat >= min(lat1, lat2)) & (lat <= max(lat1, lat2))]
+            lon = lon1 + (np.asarray(dimensions['lon'], dtype='f8') - lon1) % 360.
+            dimensions['lon'] = np.sort(lon[lon <= lon2]) if lon2 - lon1 < 360. else np.sort(lon)
+            continue
+        if name == 'sellevel':
+            levels = [k for k in dimensions if k not in ('time', 'lat', 'lon')]
+            if not levels:
+                return None
+            values = np.array([float(a) for a in args])
+            level = dimensions[levels[0]]
+            dimensions[levels[0]] = level[np.isin(level, values)]
+            continue
+        if 'time' not in dimensions or units is None:
+            return None
+        time = np.asarray(dimensions['time'])
+        if name in _TIMMEAN_OPS:
+            dimensions['time'] = time[[(len(time) - 1) // 2]]
+            continue
+        dates = decode_times(time, units, calendar, form='int')
+        years, months = dates // 10000, dates // 100 % 100
+        if name == 'seldate' and len(args) == 2:
+            start = _date_to_num(args[0][:10], units, calendar)
+            end = _date_to_num(args[1][:10], units, calendar, offset_days=1)
+            dimensions['time'] = time[(time >= start) & (time < end)]
+        elif name == 'selyear':
+            dimensions['time'] = time[np.isin(years, _int_args(args))]
+        elif name == 'selmon':
+            dimensions['time'] = time[np.isin(months, _int_args(args))]
+        elif name in _YEAR_OPS + _SEAS_OPS + _MON_OPS:
+            if name in _YEAR_OPS:
+                labels = years
+            elif name in _MON_OPS:
+                labels = years * 12 + months
+            else:
+                labels = (years + (months == 12)) * 4 + (months % 12) // 3
+            starts = np.concatenate([[0], np.nonzero(labels[1:] != labels[:-1])[0] + 1, [len(time)]])
+            dimensions['time'] = time[(starts[:-1] + starts[1:] - 1) // 2]
         else:
-            os.rename('temporary_0.nc', 'temp123.nc')
+            return None
+
+    if toDatetime and 'time' in dimensions:
+        dimensions['time'] = _to_datetime(dimensions['time'], units, calendar, toDatetime)
+    return dimensions
 
 
-def loadfiles(ens, varname, toDatetime=False, **kwargs):
+def _dimensions_shape(dimensions):
+    """The squeezed shape of the data described by dimensions."""
+    return tuple(len(v) for v in dimensions.values() if len(v) != 1)
+
+
+def _int_args(args):
+    """Integer arguments of a cdo operator, expanding ranges like 1979/2008."""
+    values = []
+    for a in args:
+        if '/' in a:
+            first, last = a.split('/')
+            values.extend(range(int(first), int(last) + 1))
+        else:
+            values.append(int(a))
+    return values
+
+
+def _materialize(ifile, varname, cdostr, toDatetime=False):
+    """Run the cdo chain cdostr on ifile once, into a temporary directory,
+    and return the dimensions and data of the output."""
+    opslist = cdostr.split()
+    base_op = opslist[0].replace('-', '')
+    tmpdir = tempfile.mkdtemp(prefix='cmipdata-')
+    try:
+        output = os.path.join(tmpdir, 'first.nc')
+        with prof.record('cdo', base_op, inputs=[ifile], outputs=[output]):
+            getattr(cdo, base_op)(input=' '.join(opslist[1:] + [ifile]), output=output)
+        dimensions = get_dimensions(output, varname, toDatetime=toDatetime)
+        first = loadvar(output, varname)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return dimensions, first
+
+
+def loadfiles(ens, varname, toDatetime=False, dtype=None, masked=True, workers=1,
+              parallel=None, lazy=False, cache_size=1024 ** 3, cache_dir=None,
+              cache_limit=20 * 1024 ** 3, align=None, resolution='M', **kwargs):
     """
         Load a variable "varname" from all files in ens, and load it into a matrix
         where the zeroth dimensions represents an input file and dimensions 1 to n are
@@ -92,14 +607,75 @@ def loadfiles(ens, varname, toDatetime=False, **kwargs):
         in all ifiles. Keyword argument toDatetime (defaults to False) will be passed as 
         a keyword argument to get_dimensions(). Optionally specify any kwargs valid for loadvar.
 
+        The matrix is allocated once, in the dtype of the data in the files
+        or in dtype if given (e.g. dtype='float32' halves the memory needed
+        for double precision data), and each file is read straight into it.
+        Missing values are found from the _FillValue and missing_value
+        attributes as the files are read. If masked=False, a plain array is
+        returned with missing values set to NaN, which saves the memory of
+        the mask (dtype must then be a floating point type).
+
+        With workers > 1 the files are loaded concurrently, each worker
+        writing its files straight into their rows of the matrix, which stays
+        in the order of ens.objects('ncfile'). parallel='process' (the
+        default) uses a pool of forked processes writing into shared memory.
+        parallel='thread' uses a thread pool, but as netCDF4 and HDF5 are not
+        thread safe the threads take turns to read: they only overlap the
+        cdo subprocesses run for a cdostr. Plain reads (and reduce) gain
+        nothing over workers=1 with threads, and need parallel='process'
+        to run concurrently. Either pool only pays off with several CPUs
+        and files large enough to outweigh starting it (see
+        test/bench_loadfiles.py).
+
+        Instead of a cdostr, reductions can be applied natively, as each file
+        is read block by block, so that only the reduced data is held in
+        memory and no cdo process or temporary file is needed. reduce is a
+        list of reductions (or a string of them, such as '-yearmean -fldmean')
+        from 'timmean', 'yearmean', 'seasmean', 'zonmean' and 'fldmean'
+        (weighted by cos(latitude)), combined with any selection. Missing
+        values are left out of the means. The time of each reduced step is
+        the middle time step of its group.
+
+        If lazy=True, nothing more than the headers (and, with a cdostr or
+        reduce, the first file) is read, and data is a LazyEnsembleArray,
+        which reads the files and time steps touched by each indexing
+        operation, keeping up to cache_size bytes of them in memory. E.g.::
+
+            d = loadfiles(ens, 'ts', lazy=True)
+            models = np.array(d['dimensions']['models'])
+            ts = d['data'][models == 'CanESM2', :, 40:60]
+
+        If cache_dir is given, the result is saved there as uncompressed
+        .npy files (the data and mask) and a pickle of the dimensions. It is
+        keyed on the files and their modification times, varname and the
+        other arguments, so a repeated call with nothing changed returns
+        read-only np.memmap views of the saved arrays, which open instantly
+        and share memory between processes. The least recently used results
+        are removed to keep cache_dir below cache_limit bytes. cache_dir
+        cannot be combined with lazy=True.
+
+        Files with different time axes (different start or end dates, or
+        calendars) can be loaded with align='union' or align='intersection'.
+        The time axis of each file is read from its header and its dates
+        rounded to the resolution 'Y', 'M' (the default) or 'D'. The matrix
+        then covers all the dates found in any file (union) or in every file
+        (intersection), and each file is read only for its overlapping time
+        steps, straight into its row (with workers > 1 by a pool of forked
+        processes, as for parallel='process'). Time steps a file does
+        not have are masked (or NaN if masked=False). The time dimension is
+        returned as integers YYYY, YYYYMM or YYYYMMDD, or as datetimes if
+        toDatetime is given. Any selection is applied first.
+
         Requires netCDF4, cdo bindings and numpy
         
         Returns 
         -------
-        dictionary with keys data and dimensions
+        EnsembleArray, a dictionary with keys data and dimensions
              data maps to a numpy array containing the data
-             dimensions has keys; models, realizations, 
+             dimensions has keys; models, realizations, experiments
                 and possibly lat, lon, and time
+             and with methods for selecting and averaging by model,
+             experiment and realization, see EnsembleArray.
         
     """
     # Get all input files from the ensemble
@@ -107,31 +683,1387 @@ def loadfiles(ens, varname, toDatetime=False, **kwargs):
     ifiles = []
     for f in files:
         ifiles.append(f.name)
+
+    if cache_dir and lazy:
+        raise ValueError('cache_dir cannot be combined with lazy=True, which reads nothing '
+                         'to cache')
+    if cache_dir:
+        options = dict(kwargs, align=align, resolution=resolution) if align else kwargs
+        key = _cache_key(files, varname, toDatetime, dtype, masked, options)
+        cached = _cache_load(cache_dir, key)
+        if cached is not None:
+            return cached
+        result = loadfiles(ens, varname, toDatetime=toDatetime, dtype=dtype, masked=masked,
+                           workers=workers, parallel=parallel, align=align,
+                           resolution=resolution, **kwargs)
+        _cache_store(cache_dir, key, result, cache_limit)
+        return result
+
+    if align:
+        if kwargs.get('cdostr') or kwargs.get('reduce') or lazy:
+            raise ValueError('align cannot be combined with a cdostr, reduce or lazy')
+        return _load_aligned(files, varname, toDatetime, dtype, masked, workers, align,
+                             resolution, _selection(kwargs))
     
     # if a cdostr is being applied, 
     # create a temporaryfile to determine the dimensions of the data
-    if 'cdostr' in kwargs:
-        _create_tempfile(ens, varname, ifiles[0], **kwargs)
-        dimensions = get_dimensions('temp123.nc', varname, toDatetime=toDatetime)
-        os.remove('temp123.nc')
+    cdostr = kwargs.get('cdostr')
+    selection = _selection(kwargs)
+    reduce = kwargs.get('reduce')
+    if cdostr and (selection or reduce):
+        raise ValueError('a selection or reduce cannot be combined with a cdostr')
+    if reduce:
+        # the first file gives the shape, and is kept as the first row
+        first, steps = _reduce(ifiles[0], varname, reduce, selection)
+        shape, file_dtype = first.shape, np.result_type(_var_info(ifiles[0], varname)[1], 'f4')
+        dimensions = _reduced_dimensions(
+            get_dimensions(ifiles[0], varname, toDatetime=toDatetime, **selection), reduce, steps)
+    elif cdostr:
+        # the dimensions are derived from the headers where the operators
+        # can be modelled, and checked against the first file as loaded;
+        # otherwise the first file is processed once, and its output gives
+        # the dimensions. Either way, the first file gives the shape, and is
+        # kept as the first row
+        dimensions = _infer_dimensions(ifiles[0], varname, cdostr, toDatetime=toDatetime)
+        if dimensions is not None:
+            first = loadvar(ifiles[0], varname, **kwargs)
+            if _dimensions_shape(dimensions) != tuple(n for n in first.shape if n != 1):
+                dimensions = None
+        if dimensions is None:
+            dimensions, first = _materialize(ifiles[0], varname, cdostr, toDatetime=toDatetime)
+        shape, file_dtype = first.shape, first.dtype
     else:
-        dimensions = get_dimensions(ifiles[0], varname, toDatetime=toDatetime)
+        dimensions = get_dimensions(ifiles[0], varname, toDatetime=toDatetime, **selection)
+        shape, file_dtype = _var_info(ifiles[0], varname, selection)
 
-    vst = loadvar(ifiles[0], varname, **kwargs)
-    varmat = np.ones((len(ifiles),) + vst.shape) * 999e99
+    dtype = np.dtype(dtype or file_dtype)
+    if not masked and dtype.kind != 'f':
+        raise ValueError('masked=False needs a floating point dtype to hold NaN, not ' + str(dtype))
+    if lazy:
+        data = LazyEnsembleArray(ifiles, varname, (len(ifiles),) + shape, dtype, masked=masked,
+                                 cache_size=cache_size, **kwargs)
+        if cdostr or reduce:
+            data._put(0, 0, first)
+        dimensions['models'] = get_models(files)
+        dimensions['realizations'] = get_realizations(files)
+        dimensions['experiments'] = get_experiments(files)
+        return EnsembleArray(data, dimensions)
+    if parallel is None:
+        parallel = 'process'
+    if parallel not in ('thread', 'process'):
+        raise ValueError("parallel must be 'thread' or 'process'")
+    shared = workers > 1 and parallel == 'process'
+    empty = _shared_empty if shared else np.empty
+    varmat = empty((len(ifiles),) + shape, dtype=dtype)
+    mask = None
+    if masked:
+        mask = _shared_empty(varmat.shape, bool) if shared else np.zeros(varmat.shape, dtype=bool)
 
-    for i, ifile in enumerate(ifiles):
-        varmat[i, :] = loadvar(ifile, varname, **kwargs)
+    rows = [(i, ifile, varname, kwargs) for i, ifile in enumerate(ifiles)]
+    if cdostr or reduce:
+        _store(varmat, mask, 0, first)
+        rows = rows[1:]
+    if workers > 1 and parallel == 'thread':
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda row: _load_row(varmat, mask, *row), rows))
+    else:
+        _fork_map(lambda row: _load_row(varmat, mask, *row), rows, workers)
 
-    varmat = np.ma.masked_equal(varmat, 999e99)
+    if masked:
+        varmat = np.ma.masked_array(varmat, mask=mask, copy=False)
     
     models = get_models(files)
     realizations = get_realizations(files)
     dimensions['models'] = models
     dimensions['realizations'] = realizations
-    return {"data": varmat, 
-            "dimensions": dimensions,
-            }
+    dimensions['experiments'] = get_experiments(files)
+    return EnsembleArray(varmat, dimensions)
+
+class EnsembleArray(dict):
+    """
+    The result of loadfiles: a dictionary with keys data (the array, with
+    one row per file) and dimensions (the coordinates, and the lists models,
+    realizations and experiments naming each row), as before.
+
+    The model, experiment and realization of each row are also held as
+    integer codes (model_codes etc.), indexing the names in order of first
+    appearance (model_names etc.), which give vectorized selections and
+    group means.
+
+    Examples
+    --------
+
+    1. The mean of each model, and the ensemble mean with each model
+       weighted equally rather than each realization::
+
+        d = cd.loadfiles(ens, 'ts', cdostr='-yearmean -fldmean')
+        model_means = d.model_mean()
+        ens_mean = d.ensemble_mean(weighting='model')
+
+    2. The realizations of CanESM2 (a view, since the rows are contiguous)::
+
+        canesm2 = d.sel(model='CanESM2')
+    """
+
+    def __init__(self, data, dimensions):
+        dict.__init__(self, data=data, dimensions=dimensions)
+        for label in ('model', 'realization', 'experiment'):
+            names = dimensions.get(label + 's')
+            if names is None:
+                setattr(self, label + '_names', None)
+                setattr(self, label + '_codes', None)
+                continue
+            unique = list(OrderedDict.fromkeys(names))
+            lookup = dict((name, i) for i, name in enumerate(unique))
+            setattr(self, label + '_names', unique)
+            setattr(self, label + '_codes', np.array([lookup[n] for n in names], dtype=int))
+
+    @property
+    def data(self):
+        return self['data']
+
+    @property
+    def dimensions(self):
+        return self['dimensions']
+
+    def sel(self, model=None, experiment=None, realization=None):
+        """
+        Select the rows with the given model, experiment and realization
+        names (each a name or a list of names, or None for all). Returns an
+        EnsembleArray, whose data is a view of the data of this one (not a
+        copy) when the selected rows are contiguous.
+        """
+        keep = np.ones(len(self.model_codes), dtype=bool)
+        for label, wanted in (('model', model), ('experiment', experiment),
+                              ('realization', realization)):
+            if wanted is None:
+                continue
+            names = getattr(self, label + '_names')
+            if names is None:
+                raise ValueError('no ' + label + 's to select from')
+            wanted = [wanted] if isinstance(wanted, str) else list(wanted)
+            codes = [names.index(w) for w in wanted if w in names]
+            keep &= np.isin(getattr(self, label + '_codes'), codes)
+        rows = np.nonzero(keep)[0]
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+            index = slice(rows[0], rows[-1] + 1)
+        else:
+            index = rows
+        return self._rows(index)
+
+    def _rows(self, index):
+        dimensions = dict(self['dimensions'])
+        for key in ('models', 'realizations', 'experiments'):
+            if key in dimensions:
+                values = dimensions[key]
+                if isinstance(index, slice):
+                    dimensions[key] = list(values[index])
+                else:
+                    dimensions[key] = [values[i] for i in index]
+        return EnsembleArray(self['data'][index], dimensions)
+
+    def group_mean(self, by='model'):
+        """
+        The mean over the rows of each model (by='model'), experiment or
+        realization, ignoring missing values (masked, or NaN if the data was
+        loaded with masked=False). Models are grouped within each
+        experiment, so that e.g. the historical and rcp45 runs of a model
+        give two rows rather than being averaged together. Returns an
+        EnsembleArray with one row per group, in order of first appearance.
+        """
+        labels = getattr(self, by + '_codes', None)
+        if labels is None:
+            raise ValueError('cannot group by ' + str(by))
+        codes = labels
+        if by == 'model' and self.experiment_codes is not None:
+            # number the (experiment, model) pairs in order of first appearance
+            pairs = self.experiment_codes * (labels.max() + 1) + labels
+            first, inverse = np.unique(pairs, return_index=True, return_inverse=True)[1:]
+            codes = np.argsort(np.argsort(first))[inverse.ravel()]
+        data = self['data']
+        if isinstance(data, LazyEnsembleArray):
+            data = data[:]
+        order = None
+        if np.any(np.diff(codes) < 0):
+            order = np.argsort(codes, kind='stable')
+            codes = codes[order]
+            data = data[order]
+        starts = np.concatenate([[0], np.nonzero(np.diff(codes))[0] + 1])
+        # missing values are masked, or NaN if loaded with masked=False
+        valid = ~np.ma.getmaskarray(data)
+        if data.dtype.kind == 'f':
+            valid &= ~np.isnan(np.ma.getdata(data))
+        total = np.add.reduceat(np.where(valid, np.ma.getdata(data), 0), starts, axis=0,
+                                dtype='f8')
+        count = np.add.reduceat(valid, starts, axis=0, dtype='f8')
+        mean = np.ma.masked_array(total / np.where(count > 0, count, 1.), mask=count == 0)
+        mean = mean.astype(np.result_type(data.dtype, np.float32))
+        if not np.ma.isMaskedArray(self['data']) and not isinstance(self['data'], LazyEnsembleArray):
+            mean = np.ma.filled(mean, np.nan)
+
+        names = getattr(self, by + '_names')
+        rows = starts if order is None else order[starts]
+        dimensions = dict(self['dimensions'])
+        for key in ('models', 'realizations', 'experiments'):
+            if key in dimensions:
+                dimensions[key] = [dimensions[key][i] for i in rows]
+        dimensions[by + 's'] = [names[c] for c in labels[rows]]
+        if by != 'realization' and 'realizations' in dimensions:
+            dimensions['realizations'] = ['mean'] * len(starts)
+        return EnsembleArray(mean, dimensions)
+
+    def model_mean(self):
+        """The mean of the realizations of each model in each experiment, see
+        group_mean."""
+        return self.group_mean(by='model')
+
+    def ensemble_mean(self, weighting='model'):
+        """
+        The mean over all rows, ignoring missing values. With
+        weighting='model' (the default) each model (of each experiment) has
+        the same weight, whatever its number of realizations; with
+        weighting='realization' each row has the same weight.
+        """
+        if weighting == 'model':
+            data = self.model_mean()['data']
+        elif weighting == 'realization':
+            data = self['data'][:]
+        else:
+            raise ValueError("weighting must be 'model' or 'realization'")
+        # leaving out missing values, which are NaN if loaded with masked=False
+        mean = np.ma.masked_invalid(data).mean(axis=0) if data.dtype.kind == 'f' \
+            else data.mean(axis=0)
+        if not np.ma.isMaskedArray(data):
+            mean = np.ma.filled(mean, np.nan)
+        return mean
+
+
+class LazyEnsembleArray(object):
+    """
+    An array-like view of variable varname in a list of files, as returned
+    by loadfiles(..., lazy=True), with the shape (files, ...) and dtype the
+    data would have if loaded. Data is read only when the array is indexed.
+
+    Indexing works as for numpy arrays, with the first index selecting files
+    (an integer, slice, integer array, or boolean array such as
+    models == 'CanESM2'). For files whose leading dimension is time, only
+    the blocks of time steps touched by the second index are read. Read
+    blocks are kept in a cache of at most cache_size bytes, from which the
+    least recently used blocks are dropped first. np.asarray(arr) or arr[:]
+    loads everything.
+    """
+
+    def __init__(self, ifiles, varname, shape, dtype, masked=True, cache_size=1024 ** 3,
+                 **kwargs):
+        self.ifiles = list(ifiles)
+        self.varname = varname
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.masked = masked
+        self.cache_size = cache_size
+        self.kwargs = kwargs
+        self.selection = _selection(kwargs)
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+        # blocks of time steps can be read if time is the leading dimension
+        self.chunk = None
+        if not (kwargs.get('cdostr') or kwargs.get('reduce')) and len(self.shape) > 1:
+            with _dataset(self.ifiles[0]) as nc:
+                ncvar = nc.variables[varname]
+                index, full = _index_shape(nc, ncvar, self.selection)
+                time_leading = (_dim_kind(nc, ncvar.dimensions[0]) == 'time' and
+                                full[0] == self.shape[1])
+            if time_leading:
+                rowbytes = max(self.dtype.itemsize * int(np.prod(self.shape[2:])), 1)
+                self.chunk = max(_READ_BLOCK // rowbytes, 1)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'LazyEnsembleArray(%s, shape=%s, dtype=%s, %d bytes cached)' % (
+            self.varname, self.shape, self.dtype, self._cached_bytes)
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.ma.filled(self[:], np.nan) if self.masked else self[:]
+        return np.asarray(data, dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        files = np.arange(self.shape[0])[key[0]]
+        if np.ndim(files) == 0:
+            return self._file(int(files), key[1:])
+        data = [self._file(int(i), key[1:]) for i in files]
+        if not data:
+            return np.ma.masked_array(np.empty((0,) + self.shape[1:], dtype=self.dtype))
+        if self.masked:
+            return np.ma.stack(data)
+        return np.stack(data)
+
+    def _file(self, i, key):
+        """Index the data of file i by key."""
+        if self.chunk is None or len(key) == 0:
+            return self._block(i, 0)[key]
+        steps = np.arange(self.shape[1])[key[0]]
+        wanted = np.atleast_1d(steps)
+        blocks = np.unique(wanted // self.chunk)
+        data = [self._block(i, b) for b in blocks]
+        data = np.ma.concatenate(data) if self.masked else np.concatenate(data)
+        # position of each wanted step in the concatenated blocks
+        offsets = np.searchsorted(blocks, wanted // self.chunk) * self.chunk
+        data = data[offsets + wanted % self.chunk]
+        if np.ndim(steps) == 0:
+            return data[0][key[1:]]
+        return data[(slice(None),) + key[1:]]
+
+    def _block(self, i, b):
+        """Block b of time steps of file i (the whole file if not chunked),
+        read from the cache or from disk."""
+        if (i, b) in self._cache:
+            self._cache.move_to_end((i, b))
+            return self._cache[(i, b)]
+        ifile = self.ifiles[i]
+        if self.chunk is None:
+            var = loadvar(ifile, self.varname, **self.kwargs)
+            if var.shape != self.shape[1:]:
+                raise ValueError('%s has shape %s, expected %s' % (ifile, var.shape, self.shape[1:]))
+        else:
+            a = b * self.chunk
+            n = min(self.chunk, self.shape[1] - a)
+            var = np.empty((n,) + self.shape[2:], dtype=self.dtype)
+            mask = np.zeros(var.shape, dtype=bool) if self.masked else None
+            _read_into(ifile, self.varname, var, mask, dict(self.selection, steps=(a, a + n)))
+            if self.masked:
+                var = np.ma.masked_array(var, mask=mask, copy=False)
+        return self._put(i, b, var)
+
+    def _put(self, i, b, var):
+        """Cache var as block b of file i, dropping least recently used
+        blocks to stay within cache_size."""
+        var = var.astype(self.dtype, copy=False)
+        if not self.masked:
+            var = np.ma.filled(var, np.nan)
+        nbytes = np.ma.getdata(var).nbytes + (var.mask.nbytes if np.ma.isMaskedArray(var) else 0)
+        self._cache[(i, b)] = var
+        self._cached_bytes += nbytes
+        while self._cached_bytes > self.cache_size and len(self._cache) > 1:
+            old = self._cache.popitem(last=False)[1]
+            self._cached_bytes -= np.ma.getdata(old).nbytes + (
+                old.mask.nbytes if np.ma.isMaskedArray(old) else 0)
+        return var
+
+    def clear_cache(self):
+        """Drop all cached blocks."""
+        self._cache.clear()
+        self._cached_bytes = 0
+
+
+# divisors turning YYYYMMDD dates into dates of each resolution
+_RESOLUTIONS = {'Y': 10000, 'M': 100, 'D': 1}
+
+
+def _load_aligned(files, varname, toDatetime, dtype, masked, workers, align, resolution,
+                  selection):
+    """loadfiles for files with different time axes, see loadfiles."""
+    if align not in ('union', 'intersection'):
+        raise ValueError("align must be 'union' or 'intersection'")
+    if resolution not in _RESOLUTIONS:
+        raise ValueError("resolution must be one of 'Y', 'M' or 'D'")
+    ifiles = [f.name for f in files]
+
+    # the dates of the selected time steps of each file, from the headers,
+    # whose other dimensions must match those of the first file
+    labels = []
+    shape = None
+    for ifile in ifiles:
+        with _dataset(ifile) as nc:
+            ncvar = nc.variables[varname]
+            if not ncvar.ndim or _dim_kind(nc, ncvar.dimensions[0]) != 'time':
+                raise ValueError(varname + ' in ' + ifile + ' has no leading time dimension')
+            index = _hyperslab(nc, ncvar, **selection)
+            file_shape = tuple(_index_len(idx, n) for idx, n in zip(index[1:], ncvar.shape[1:]))
+            file_shape = tuple(n for n in file_shape if n != 1)
+            if shape is None:
+                shape = file_shape
+            elif file_shape != shape:
+                raise ValueError('%s in %s has shape %s after the time dimension, expected %s '
+                                 'as in %s' % (varname, ifile, file_shape, shape, ifiles[0]))
+            nc_time = nc.variables[ncvar.dimensions[0]]
+            dates = decode_times(_take(_coordinate(nc, ncvar.dimensions[0]), index[0]),
+                                 nc_time.units, getattr(nc_time, 'calendar', 'standard'),
+                                 form='int')
+        label = dates // _RESOLUTIONS[resolution]
+        if len(np.unique(label)) != len(label):
+            raise ValueError(ifile + ' has several time steps per date at resolution ' +
+                             resolution + ', use a finer resolution or reduce the data first')
+        labels.append(label)
+
+    common = labels[0]
+    for label in labels[1:]:
+        if align == 'union':
+            common = np.union1d(common, label)
+        else:
+            common = np.intersect1d(common, label)
+    common = np.unique(common)
+
+    file_dtype = _var_info(ifiles[0], varname)[1]
+    dtype = np.dtype(dtype or file_dtype)
+    if not masked and dtype.kind != 'f':
+        raise ValueError('masked=False needs a floating point dtype to hold NaN, not ' + str(dtype))
+    empty = _shared_empty if workers > 1 else np.empty
+    varmat = empty((len(ifiles), len(common)) + shape, dtype=dtype)
+    mask = None
+    if masked:
+        mask = empty(varmat.shape, dtype=bool)
+        mask[...] = True
+    else:
+        varmat[...] = np.nan
+
+    # runs of time steps of a file which land on consecutive common dates
+    # are read straight into their place in the matrix
+    rows = []
+    for i, (ifile, label) in enumerate(zip(ifiles, labels)):
+        steps = np.nonzero(np.isin(label, common))[0]
+        if not len(steps):
+            continue
+        positions = np.searchsorted(common, label[steps])
+        breaks = np.nonzero((np.diff(steps) != 1) | (np.diff(positions) != 1))[0] + 1
+        for run_steps, run_positions in zip(np.split(steps, breaks), np.split(positions, breaks)):
+            rows.append((i, ifile, int(run_steps[0]), int(run_steps[-1]) + 1,
+                         int(run_positions[0])))
+
+    def load(row):
+        i, ifile, a, b, p = row
+        _read_into(ifile, varname, varmat[i, p:p + b - a],
+                   mask[i, p:p + b - a] if mask is not None else None,
+                   dict(selection, steps=(a, b)))
+
+    _fork_map(load, rows, workers)
+    if masked:
+        varmat = np.ma.masked_array(varmat, mask=mask, copy=False)
+
+    dimensions = get_dimensions(ifiles[0], varname, **dict(selection, dates=None))
+    if toDatetime:
+        # the first day of each year or month
+        dates = common * _RESOLUTIONS[resolution]
+        dates = dates + (dates % 10000 == 0) * 100
+        dates = dates + (dates % 100 == 0)
+        form = 'datetime64' if toDatetime == 'datetime64' else 'datetime'
+        dimensions['time'] = from_int_dates(dates, form=form)
+    else:
+        dimensions['time'] = common
+    dimensions['models'] = get_models(files)
+    dimensions['realizations'] = get_realizations(files)
+    dimensions['experiments'] = get_experiments(files)
+    return EnsembleArray(varmat, dimensions)
+
+
+def _cache_key(files, varname, toDatetime, dtype, masked, kwargs):
+    """A hash of everything a loadfiles result depends on."""
+    items = [(f.name, os.path.getmtime(f.name), os.path.getsize(f.name),
+              f.parentobject('model').name, f.parentobject('realization').name) for f in files]
+    options = (varname, toDatetime, str(np.dtype(dtype)) if dtype else None, masked,
+               sorted((k, repr(v)) for k, v in kwargs.items()))
+    return hashlib.sha1(repr((items, options)).encode()).hexdigest()
+
+
+def _cache_load(cache_dir, key):
+    """Return the cached result for key as memmap views, or None."""
+    entry = os.path.join(cache_dir, key)
+    try:
+        data = np.load(os.path.join(entry, 'data.npy'), mmap_mode='r')
+        with open(os.path.join(entry, 'dimensions.pkl'), 'rb') as f:
+            dimensions = pickle.load(f)
+        if not isinstance(dimensions, dict):
+            return None
+        if os.path.exists(os.path.join(entry, 'mask.npy')):
+            mask = np.load(os.path.join(entry, 'mask.npy'), mmap_mode='r')
+            if mask.shape != data.shape:
+                return None
+            data = np.ma.masked_array(data, mask=mask, copy=False)
+    except Exception:
+        # a truncated or corrupt entry is loaded again from the files
+        return None
+    # the modification time of an entry records when it was last used
+    os.utime(entry)
+    return EnsembleArray(data, dimensions)
+
+
+def _cache_store(cache_dir, key, result, cache_limit):
+    """Save result in cache_dir under key, then remove the least recently
+    used entries while the cache is larger than cache_limit bytes."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # written to a temporary directory first, so readers never see a
+    # partial entry
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    try:
+        data = result['data']
+        np.save(os.path.join(tmp, 'data.npy'), np.ma.getdata(data))
+        if np.ma.isMaskedArray(data):
+            np.save(os.path.join(tmp, 'mask.npy'), np.ma.getmaskarray(data))
+        with open(os.path.join(tmp, 'dimensions.pkl'), 'wb') as f:
+            pickle.dump(result['dimensions'], f, protocol=pickle.HIGHEST_PROTOCOL)
+        entry = os.path.join(cache_dir, key)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+    except OSError as e:
+        shutil.rmtree(tmp, ignore_errors=True)
+        print('Could not cache the loaded data in ' + cache_dir + ': ' + str(e))
+        return
+    _cache_evict(cache_dir, cache_limit, keep=key)
+
+
+def _cache_evict(cache_dir, cache_limit, keep=None):
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, name))
+    total = sum(e[1] for e in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= cache_limit:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+
+
+def clear_load_cache(cache_dir):
+    """Remove all results cached by loadfiles in cache_dir."""
+    for name in os.listdir(cache_dir):
+        if os.path.isdir(os.path.join(cache_dir, name)):
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def _reduced_dimensions(dimensions, reduce, steps):
+    """Drop the dimensions removed by the reductions in reduce, and keep the
+    time steps (the middle of each group) returned by _reduce."""
+    ops = _reductions(reduce)
+    for op, reduced in (('timmean', 'time'), ('zonmean', 'lon'), ('fldmean', 'lon'), ('fldmean', 'lat')):
+        if op in ops:
+            dimensions.pop(reduced, None)
+    if steps is not None and 'time' in dimensions:
+        dimensions['time'] = dimensions['time'][steps]
+    return dimensions
+
+
+def loadvariables(ens, varnames, toDatetime=False, dtype=None, masked=True, workers=1,
+                  **kwargs):
+    """
+    Load several variables from the files of ens in one pass, e.g. uas and
+    vas for the wind speed, or hfls and hfss for the turbulent heat flux.
+
+    The files of each variable are matched on model, experiment and
+    realization (and, for realizations split over several files, on the
+    order of the files). Realizations which do not have all the variables
+    are left out. For each matched realization the files are opened once,
+    and all the variables they hold are read from them, straight into one
+    preallocated matrix per variable, as for loadfiles.
+
+    Parameters
+    ----------
+    ens : cmipdata Ensemble
+          The ensemble holding the files of all the variables.
+    varnames : list of str
+               The variables to load.
+    toDatetime, dtype, masked :
+               As for loadfiles.
+    workers : int
+              With workers > 1, the realizations are loaded by a pool of
+              forked processes, writing into shared memory as for loadfiles.
+    kwargs : the selection keyword arguments of loadvar (dates, lat, lon,
+             level and stride), applied to every variable.
+
+    Returns
+    -------
+    A dictionary mapping each variable name to an EnsembleArray, as returned
+    by loadfiles, whose rows are in the same order for all variables.
+
+    Examples
+    --------
+
+    1. Wind speed::
+
+        d = cd.loadvariables(ens, ['uas', 'vas'])
+        speed = np.ma.sqrt(d['uas']['data'] ** 2 + d['vas']['data'] ** 2)
+    """
+    if kwargs.get('cdostr') or kwargs.get('reduce'):
+        raise ValueError('loadvariables does not support a cdostr or reduce')
+    selection = _selection(kwargs)
+    varnames = list(varnames)
+
+    # the files of each variable, keyed by model, experiment, realization
+    # and position in the realization
+    keyed = dict((v, OrderedDict()) for v in varnames)
+    for variable in ens.objects('variable'):
+        if variable.name not in keyed:
+            continue
+        realization = variable.parentobject('realization')
+        mer = (variable.parentobject('model').name, variable.parentobject('experiment').name,
+               realization.name)
+        for k, f in enumerate(sorted(variable.children, key=lambda f: f.name)):
+            keyed[variable.name][mer + (k,)] = f
+    for v in varnames:
+        if not keyed[v]:
+            raise ValueError('no files found for ' + v)
+    keys = [k for k in keyed[varnames[0]] if all(k in keyed[v] for v in varnames[1:])]
+    dropped = set(k for v in varnames for k in keyed[v]) - set(keys)
+    if dropped:
+        print('Leaving out %d files of realizations without all of %s:' %
+              (len(dropped), ', '.join(varnames)))
+        for key in sorted(dropped):
+            print('\t' + '-'.join(key[:3]))
+    if not keys:
+        raise ValueError('no realizations have all of ' + ', '.join(varnames))
+
+    files = dict((v, [keyed[v][k] for k in keys]) for v in varnames)
+    # shared memory starts zero filled
+    empty, zeros = (_shared_empty, _shared_empty) if workers > 1 else (np.empty, np.zeros)
+    varmats, masks, results = {}, {}, {}
+    for v in varnames:
+        first = files[v][0].name
+        shape, file_dtype = _var_info(first, v, selection)
+        var_dtype = np.dtype(dtype or file_dtype)
+        if not masked and var_dtype.kind != 'f':
+            raise ValueError('masked=False needs a floating point dtype to hold NaN, not ' +
+                             str(var_dtype))
+        varmats[v] = empty((len(keys),) + shape, dtype=var_dtype)
+        masks[v] = zeros(varmats[v].shape, dtype=bool) if masked else None
+        dimensions = get_dimensions(first, v, toDatetime=toDatetime, **selection)
+        dimensions['models'] = get_models(files[v])
+        dimensions['realizations'] = get_realizations(files[v])
+        dimensions['experiments'] = get_experiments(files[v])
+        results[v] = dimensions
+
+    def load(i):
+        # each file is opened once, and every variable it holds is read
+        byfile = OrderedDict()
+        for v in varnames:
+            byfile.setdefault(files[v][i].name, []).append(v)
+        for ifile, names in byfile.items():
+            with _dataset(ifile):
+                for v in names:
+                    _read_into(ifile, v, varmats[v][i],
+                               masks[v][i] if masks[v] is not None else None, selection)
+
+    _fork_map(load, range(len(keys)), workers)
+
+    for v in varnames:
+        data = varmats[v]
+        if masked:
+            data = np.ma.masked_array(data, mask=masks[v], copy=False)
+        results[v] = EnsembleArray(data, results[v])
+    return results
+
+
+def loadregions(ens, varname, regions, mean=True, toDatetime=False, workers=1, **kwargs):
+    """
+    Extract many regions from the files of ens in one pass, e.g. the area
+    mean time series of 50 boxes from each of 2000 files.
+
+    The latitudes and longitudes of each region are found once per grid.
+    Each file is then read once, for the bounding box of all the regions,
+    and every region is cut out of that, rather than each file being read
+    once per region.
+
+    Parameters
+    ----------
+    ens : cmipdata Ensemble
+          The ensemble of files to read.
+    varname : str
+              The variable to extract, which must have lat and lon
+              dimensions.
+    regions : dict
+              Maps the name of each region to either a box, given as a
+              dictionary {'lat': (south, north), 'lon': (west, east)} with
+              longitudes as for loadvar (so boxes may cross the 0 or 180
+              meridian), or an object with corners ll and ur as used by
+              slice_nc.get_var_2D; or a boolean mask of shape (lat, lon),
+              True inside the region.
+    mean : boolean
+           If True (the default), return the mean over each region, weighted
+           by cos(latitude) and leaving out missing values. If False, return
+           the data of each region, with points outside a mask masked.
+    toDatetime : boolean
+                 Passed to get_dimensions.
+    workers : int
+              With workers > 1, the files are handled by a pool of forked
+              processes, writing into shared memory as for loadfiles.
+    kwargs : the selection keyword arguments of loadvar dates, level and
+             stride, applied to every region.
+
+    Returns
+    -------
+    A dictionary mapping each region name to an EnsembleArray, as returned
+    by loadfiles, with one row per file.
+
+    Examples
+    --------
+
+    1. The area mean of the Nino 3.4 and Nino 3 regions::
+
+        r = cd.loadregions(ens, 'ts', {'nino34': {'lat': (-5, 5), 'lon': (190, 240)},
+                                       'nino3': {'lat': (-5, 5), 'lon': (210, 270)}})
+        nino34 = r['nino34']['data']
+    """
+    if kwargs.get('cdostr') or kwargs.get('reduce'):
+        raise ValueError('loadregions does not support a cdostr or reduce')
+    if kwargs.get('lat') is not None or kwargs.get('lon') is not None:
+        raise ValueError('the latitudes and longitudes are given by the regions')
+    selection = _selection(kwargs)
+    files = ens.objects('ncfile')
+    ifiles = [f.name for f in files]
+    if not ifiles:
+        raise ValueError('no files found for ' + varname)
+    names = list(regions)
+    grids = {}
+
+    # the first file gives the shape of each region
+    first, coordinates = _extract_regions(ifiles[0], varname, regions, mean, selection, grids)
+    empty = _shared_empty if workers > 1 else np.empty
+    data, masks = {}, {}
+    for name in names:
+        var = first[name]
+        data[name] = empty((len(ifiles),) + var.shape, dtype=var.dtype)
+        masks[name] = empty((len(ifiles),) + var.shape, dtype=bool)
+        _store(data[name], masks[name], 0, var)
+
+    def load(i):
+        extracted = _extract_regions(ifiles[i], varname, regions, mean, selection, grids)[0]
+        for name in names:
+            if extracted[name].shape != first[name].shape:
+                raise ValueError('%s has shape %s for region %s, expected %s' %
+                                 (ifiles[i], extracted[name].shape, name, first[name].shape))
+            _store(data[name], masks[name], i, extracted[name])
+
+    _fork_map(load, range(1, len(ifiles)), workers)
+
+    dimensions = get_dimensions(ifiles[0], varname, toDatetime=toDatetime, **selection)
+    models = get_models(files)
+    realizations = get_realizations(files)
+    experiments = get_experiments(files)
+    results = {}
+    for name in names:
+        region_dimensions = dict(dimensions)
+        if mean:
+            region_dimensions.pop('lat', None)
+            region_dimensions.pop('lon', None)
+        else:
+            region_dimensions['lat'], region_dimensions['lon'] = coordinates[name]
+        region_dimensions['models'] = models
+        region_dimensions['realizations'] = realizations
+        region_dimensions['experiments'] = experiments
+        results[name] = EnsembleArray(np.ma.masked_array(data[name], mask=masks[name], copy=False),
+                                      region_dimensions)
+    return results
+
+
+def _region_indices(lat, lon, spec):
+    """The indices into the latitudes lat and longitudes lon of the region
+    spec (see loadregions), and its mask over them (None for a box)."""
+    if isinstance(spec, np.ndarray):
+        if spec.shape != (len(lat), len(lon)):
+            raise ValueError('a region mask has shape %s, expected %s' %
+                             (spec.shape, (len(lat), len(lon))))
+        spec = spec.astype(bool)
+        lat_idx = np.nonzero(spec.any(axis=1))[0]
+        lon_idx = np.nonzero(spec.any(axis=0))[0]
+        return lat_idx, lon_idx, spec[np.ix_(lat_idx, lon_idx)]
+    if hasattr(spec, 'll'):
+        spec = {'lat': (spec.ll.lat, spec.ur.lat), 'lon': (spec.ll.lon, spec.ur.lon)}
+    lat_idx = np.arange(len(lat))
+    lon_idx = np.arange(len(lon))
+    if spec.get('lat') is not None:
+        lat_idx = np.nonzero((lat >= min(spec['lat'])) & (lat <= max(spec['lat'])))[0]
+    if spec.get('lon') is not None:
+        # as in _hyperslab, from west to east across the seam
+        west, east = spec['lon']
+        width = (east - west) % 360. or 360.
+        offset = (np.asarray(lon, dtype='f8') - west) % 360.
+        lon_idx = np.nonzero(offset <= width)[0]
+        lon_idx = lon_idx[np.argsort(offset[lon_idx], kind='stable')]
+    return lat_idx, lon_idx, None
+
+
+def _extract_regions(ifile, varname, regions, mean, selection, grids):
+    """Read the bounding box of all the regions from ifile once, and cut
+    each region out of it. grids caches the indices of the regions by the
+    coordinates of the grid. Returns a dictionary of the (squeezed) masked
+    arrays of the regions, and one of the latitudes and longitudes of each."""
+    with _dataset(ifile) as nc:
+        ncvar = nc.variables[varname]
+        kinds = [_dim_kind(nc, d) for d in ncvar.dimensions]
+        if 'lat' not in kinds or 'lon' not in kinds:
+            raise ValueError(varname + ' has no lat and lon dimensions')
+        lat_axis, lon_axis = kinds.index('lat'), kinds.index('lon')
+        index = _hyperslab(nc, ncvar, **selection)
+        lat = _take(_coordinate(nc, ncvar.dimensions[lat_axis]), index[lat_axis])
+        lon = _take(_coordinate(nc, ncvar.dimensions[lon_axis]), index[lon_axis])
+
+        key = hashlib.sha1(np.asarray(lat).tobytes() + np.asarray(lon).tobytes()).hexdigest()
+        if key not in grids:
+            indices = dict((name, _region_indices(lat, lon, regions[name])) for name in regions)
+            bounds = []
+            for axis in (0, 1):
+                used = np.concatenate([np.arange(0)] + [i[axis] for i in indices.values()])
+                bounds.append((int(used.min()), int(used.max()) + 1) if len(used) else (0, 0))
+            grids[key] = (indices, bounds[0], bounds[1])
+        indices, rows, columns = grids[key]
+
+        box = dict(selection, rows=rows, columns=columns)
+        shape = _index_shape(nc, ncvar, box)[1]
+        data = np.empty(shape, dtype=np.result_type(_var_info(ifile, varname)[1], np.float32))
+        missing = np.zeros(shape, dtype=bool)
+        _read_into(ifile, varname, data, missing, box)
+
+    extracted = {}
+    coordinates = {}
+    for name, (lat_idx, lon_idx, region_mask) in indices.items():
+        var = np.take(np.take(data, lat_idx - rows[0], axis=lat_axis), lon_idx - columns[0],
+                      axis=lon_axis)
+        invalid = np.take(np.take(missing, lat_idx - rows[0], axis=lat_axis), lon_idx - columns[0],
+                          axis=lon_axis)
+        if region_mask is not None:
+            if lon_axis < lat_axis:
+                region_mask = region_mask.T
+            invalid = invalid | ~region_mask.reshape(
+                [var.shape[k] if k in (lat_axis, lon_axis) else 1 for k in range(var.ndim)])
+        if mean:
+            weights = np.cos(np.deg2rad(np.asarray(lat, dtype='f8')[lat_idx]))
+            weights = weights.reshape([-1 if k == lat_axis else 1 for k in range(var.ndim)])
+            valid = np.where(invalid, 0., weights)
+            total = np.sum(np.where(invalid, 0., var) * valid, axis=(lat_axis, lon_axis))
+            weight = np.sum(valid, axis=(lat_axis, lon_axis))
+            var = np.ma.masked_array(total / np.where(weight > 0, weight, 1.), mask=weight == 0)
+            var = var.astype(data.dtype)
+        else:
+            var = np.ma.masked_array(var, mask=invalid)
+        extracted[name] = np.ma.squeeze(var)
+        coordinates[name] = (np.asarray(lat)[lat_idx].copy(), np.asarray(lon)[lon_idx].copy())
+    return extracted, coordinates
+
+
+def loadpoints(ens, varname, lats, lons, method='nearest', k=4, toDatetime=False, workers=1,
+               **kwargs):
+    """
+    Extract the data at many points, such as stations, from the files of
+    ens, on regular or curvilinear grids.
+
+    The grid points nearest to each station are found with a spatial
+    index: a KD-tree of the grid points as unit vectors in 3-D, so that
+    distances are correct across the poles and the date line. The index is
+    built once per grid and cached, and all stations are looked up at
+    once. Each file is then read once, for the rows and columns holding
+    the grid points used, a block of time steps at a time.
+
+    Curvilinear grids are recognised from the 2-D latitude and longitude
+    variables named in the coordinates attribute of the variable (or with
+    a latitude or longitude standard_name). scipy is used for the KD-tree
+    if it is installed; otherwise the nearest points are found by brute
+    force, which is slower for many stations.
+
+    Parameters
+    ----------
+    ens : cmipdata Ensemble
+          The ensemble of files to read.
+    varname : str
+              The variable to extract.
+    lats, lons : arrays
+                 The latitudes and longitudes of the stations, in degrees.
+    method : str
+             'nearest' (the default) for the value at the nearest grid
+             point, or 'idw' for the inverse distance weighted mean of the
+             k nearest grid points, leaving out missing values (e.g. the
+             land points of an ocean grid), a smooth interpolation which
+             also works on curvilinear grids.
+    k : int
+        The number of grid points used with method='idw'.
+    toDatetime : boolean
+                 Passed to get_dimensions.
+    workers : int
+              With workers > 1, the files are handled by a pool of forked
+              processes, writing into shared memory as for loadfiles.
+    kwargs : the selection keyword arguments of loadvar dates, level and
+             stride.
+
+    Returns
+    -------
+    EnsembleArray, as returned by loadfiles, with the stations as the
+    last dimension. The dimensions lat and lon are those of the stations,
+    and distance holds the distance in km from each station to its
+    nearest grid point.
+
+    Examples
+    --------
+
+    1. Sea surface temperature at three buoys::
+
+        d = cd.loadpoints(ens, 'tos', [0., 5., -5.], [220., 250., 265.])
+        buoys = d['data']
+    """
+    if kwargs.get('cdostr') or kwargs.get('reduce'):
+        raise ValueError('loadpoints does not support a cdostr or reduce')
+    if kwargs.get('lat') is not None or kwargs.get('lon') is not None:
+        raise ValueError('the latitudes and longitudes are given by the stations')
+    if method not in ('nearest', 'idw'):
+        raise ValueError("method must be 'nearest' or 'idw'")
+    lats = np.atleast_1d(np.asarray(lats, dtype='f8'))
+    lons = np.atleast_1d(np.asarray(lons, dtype='f8'))
+    if lats.shape != lons.shape or lats.ndim != 1:
+        raise ValueError('lats and lons must be 1-D and of the same length')
+    selection = _selection(kwargs)
+    files = ens.objects('ncfile')
+    ifiles = [f.name for f in files]
+    if not ifiles:
+        raise ValueError('no files found for ' + varname)
+    neighbours = 1 if method == 'nearest' else k
+
+    # the first file also builds the spatial index, which forked workers
+    # inherit
+    first, distance = _extract_points(ifiles[0], varname, lats, lons, neighbours, selection)
+    empty = _shared_empty if workers > 1 else np.empty
+    varmat = empty((len(ifiles),) + first.shape, dtype=first.dtype)
+    mask = empty(varmat.shape, dtype=bool)
+    _store(varmat, mask, 0, first)
+
+    def load(i):
+        var = _extract_points(ifiles[i], varname, lats, lons, neighbours, selection)[0]
+        if var.shape != first.shape:
+            raise ValueError('%s has shape %s, expected %s' % (ifiles[i], var.shape, first.shape))
+        _store(varmat, mask, i, var)
+
+    _fork_map(load, range(1, len(ifiles)), workers)
+    varmat = np.ma.masked_array(varmat, mask=mask, copy=False)
+
+    dimensions = get_dimensions(ifiles[0], varname, toDatetime=toDatetime, **selection)
+    with _dataset(ifiles[0]) as nc:
+        ncvar = nc.variables[varname]
+        for axis in _horizontal_grid(nc, ncvar)[2]:
+            # the keys get_dimensions gives the horizontal dimensions
+            name = ncvar.dimensions[axis]
+            dimensions.pop(name[:3].lower() if name[:3].lower() in ('lat', 'lon') else name, None)
+    dimensions['lat'] = lats
+    dimensions['lon'] = lons
+    dimensions['distance'] = distance
+    dimensions['models'] = get_models(files)
+    dimensions['realizations'] = get_realizations(files)
+    dimensions['experiments'] = get_experiments(files)
+    return EnsembleArray(varmat, dimensions)
+
+
+# KD-trees of the grids searched by loadpoints, by grid
+_MAX_TREES = 16
+_trees = OrderedDict()
+_trees_lock = threading.Lock()
+
+
+def _horizontal_grid(nc, ncvar):
+    """The latitudes and longitudes of the horizontal grid of ncvar, as 1-D
+    coordinates (for a regular grid) or 2-D arrays (for a curvilinear grid),
+    and the axes of ncvar they span."""
+    kinds = [_dim_kind(nc, d) for d in ncvar.dimensions]
+    if 'lat' in kinds and 'lon' in kinds:
+        lat_axis, lon_axis = kinds.index('lat'), kinds.index('lon')
+        lat = _coordinate(nc, ncvar.dimensions[lat_axis])
+        lon = _coordinate(nc, ncvar.dimensions[lon_axis])
+        if np.ndim(lat) == 1 and np.ndim(lon) == 1:
+            return lat, lon, (lat_axis, lon_axis)
+
+    names = getattr(ncvar, 'coordinates', '').split() + list(nc.variables)
+    found = {}
+    for name in names:
+        var = nc.variables.get(name)
+        if var is None or var.ndim != 2 or not set(var.dimensions) <= set(ncvar.dimensions):
+            continue
+        standard_name = getattr(var, 'standard_name', '')
+        units = getattr(var, 'units', '')
+        for kind, north_east in (('lat', 'north'), ('lon', 'east')):
+            if kind not in found and (standard_name == kind + ('itude' if kind == 'lat' else 'gitude')
+                                      or units.startswith('degree') and units.endswith(north_east)
+                                      or name.lower().startswith(kind)
+                                      or name.lower().startswith('nav_' + kind)):
+                found[kind] = var
+                break
+    if 'lat' not in found or 'lon' not in found:
+        raise ValueError('the latitudes and longitudes of ' + ncvar.name + ' were not found')
+    lat, lon = found['lat'][:], found['lon'][:]
+    if found['lon'].dimensions != found['lat'].dimensions:
+        lon = lon.T
+    axes = tuple(ncvar.dimensions.index(d) for d in found['lat'].dimensions)
+    return lat, lon, axes
+
+
+def _unit_vectors(lat, lon):
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _grid_tree(lat, lon):
+    """The spatial index of a grid: the flat indices of its valid points,
+    and a KD-tree of them (or their unit vectors, without scipy), cached by
+    the coordinates of the grid."""
+    key = hashlib.sha1(np.ma.getdata(lat).tobytes() + np.ma.getdata(lon).tobytes() +
+                       str((np.shape(lat), np.shape(lon))).encode()).hexdigest()
+    with _trees_lock:
+        if key in _trees:
+            _trees.move_to_end(key)
+            return _trees[key]
+    if np.ndim(lat) == 1:
+        lat, lon = np.meshgrid(lat, lon, indexing='ij')
+    lat, lon = np.ma.masked_invalid(lat).ravel(), np.ma.masked_invalid(lon).ravel()
+    valid = np.nonzero(~(np.ma.getmaskarray(lat) | np.ma.getmaskarray(lon)))[0]
+    points = _unit_vectors(np.ma.getdata(lat)[valid], np.ma.getdata(lon)[valid])
+    tree = (valid, cKDTree(points) if cKDTree is not None else points)
+    with _trees_lock:
+        _trees[key] = tree
+        while len(_trees) > _MAX_TREES:
+            _trees.popitem(last=False)
+    return tree
+
+
+def _nearest(tree, lats, lons, k):
+    """The flat grid indices of the k nearest grid points to each station,
+    and their angular distances in radians, each of shape (stations, k)."""
+    valid, index = tree
+    k = min(k, len(valid))
+    stations = _unit_vectors(lats, lons)
+    if cKDTree is not None:
+        chord, nearest = index.query(stations, k=k)
+        chord, nearest = chord.reshape(len(stations), k), nearest.reshape(len(stations), k)
+    else:
+        chord = np.empty((len(stations), k))
+        nearest = np.empty((len(stations), k), dtype=int)
+        # blocks of stations, so that the distance matrix stays small
+        step = max(2 ** 24 // max(len(index), 1), 1)
+        for a in range(0, len(stations), step):
+            d2 = np.maximum(2. - 2. * stations[a:a + step].dot(index.T), 0.)
+            part = np.argpartition(d2, k - 1, axis=1)[:, :k] if k < len(index) else \
+                np.tile(np.arange(len(index)), (len(d2), 1))
+            order = np.argsort(np.take_along_axis(d2, part, axis=1), axis=1)
+            nearest[a:a + step] = np.take_along_axis(part, order, axis=1)
+            chord[a:a + step] = np.sqrt(np.take_along_axis(d2, nearest[a:a + step], axis=1))
+    return valid[nearest], 2. * np.arcsin(np.minimum(chord / 2., 1.))
+
+
+def _extract_points(ifile, varname, lats, lons, k, selection):
+    """Read the values of varname in ifile at the k grid points nearest to
+    each station, and return them (or their inverse distance weighted mean)
+    as a masked array with the stations last, and the distance in km from
+    each station to its nearest grid point."""
+    with prof.record('netcdf', 'loadpoints', inputs=[ifile]) as rec:
+        with _dataset(ifile) as nc:
+            ncvar = nc.variables[varname]
+            lat, lon, axes = _horizontal_grid(nc, ncvar)
+            tree = _grid_tree(lat, lon)
+            grid_shape = tuple(ncvar.shape[a] for a in axes)
+            flat, angle = _nearest(tree, lats, lons, k)
+            rows, columns = np.unravel_index(flat, grid_shape)
+
+            # the rows and columns needed, read as one box, or as the lists
+            # of them if those hold much fewer points
+            index = list(_hyperslab(nc, ncvar, **selection))
+            needed = []
+            for axis, used in zip(axes, (rows, columns)):
+                unique = np.unique(used)
+                box = slice(int(unique[0]), int(unique[-1]) + 1)
+                needed.append((unique, box))
+            if len(needed[0][0]) * len(needed[1][0]) * 4 < np.prod(
+                    [b.stop - b.start for _, b in needed]):
+                for axis, (unique, _) in zip(axes, needed):
+                    index[axis] = unique
+                positions = [np.searchsorted(needed[0][0], rows),
+                             np.searchsorted(needed[1][0], columns)]
+            else:
+                for axis, (_, box) in zip(axes, needed):
+                    index[axis] = box
+                positions = [rows - needed[0][1].start, columns - needed[1][1].start]
+            index = tuple(index)
+            shape = tuple(_index_len(idx, n) for idx, n in zip(index, ncvar.shape))
+
+            ncvar.set_auto_maskandscale(False)
+            fills = _fill_values(ncvar)
+            scale = getattr(ncvar, 'scale_factor', None)
+            offset = getattr(ncvar, 'add_offset', None)
+            dtype = np.result_type(_var_info(ifile, varname)[1], np.float32)
+            if 0 in axes:
+                # blocks of rows would not hold all the points, so the
+                # (horizontal) data is read at once
+                raw = np.asarray(_read(ncvar, index)).reshape(shape)
+                invalid = np.zeros(shape, dtype=bool)
+                for fill in fills:
+                    invalid |= (raw == fill)
+                if raw.dtype.kind == 'f':
+                    invalid |= np.isnan(raw)
+                blocks = [(0, raw, invalid)]
+            else:
+                blocks = _raw_blocks(ncvar, index, shape, fills)
+            values, missing = [], []
+            for a, raw, invalid in blocks:
+                # the horizontal axes last, then the points picked out
+                raw = np.moveaxis(raw, axes, (-2, -1))
+                invalid = np.moveaxis(invalid, axes, (-2, -1))
+                values.append(raw[..., positions[0], positions[1]])
+                missing.append(invalid[..., positions[0], positions[1]])
+            if rec is not None:
+                rec['bytes_read'] = int(np.prod(shape)) * ncvar.dtype.itemsize
+
+    if not values:
+        raise ValueError(ifile + ' has no data for the selection')
+    data = np.concatenate(values).astype(dtype)
+    missing = np.concatenate(missing)
+    if scale is not None:
+        data *= scale
+    if offset is not None:
+        data += offset
+    if data.shape[-1] == 1:
+        var = np.ma.masked_array(data[..., 0], mask=missing[..., 0])
+    else:
+        # inverse distance weights of the valid neighbours, with a station
+        # on a valid grid point taking its value
+        weights = np.where(missing, 0., 1. / np.maximum(angle, 1e-12))
+        exact = (angle < 1e-12) & ~missing
+        weights = np.where(exact.any(axis=-1, keepdims=True), exact.astype('f8'), weights)
+        total = np.sum(np.where(missing, 0., data) * weights, axis=-1)
+        weight = np.sum(weights, axis=-1)
+        var = np.ma.masked_array((total / np.where(weight > 0, weight, 1.)).astype(dtype),
+                                 mask=weight == 0)
+    # squeezed as loadfiles, but keeping the station axis
+    keep = tuple(n for n in range(var.ndim - 1) if var.shape[n] != 1)
+    var = var.reshape(tuple(var.shape[n] for n in keep) + var.shape[-1:])
+    return var, angle[:, 0] * 6371.
+
+
+def iterfiles(ens, varname, toDatetime=False, block=None, prefetch=2, **kwargs):
+    """
+    Iterate over the data of variable varname in the files of ens, for
+    ensembles too large to be loaded at once with loadfiles.
+
+    By default one file is yielded at a time. With block=n, blocks of n time
+    steps are yielded, holding those time steps from all files (which must
+    then have the same shape). The next prefetch items are read ahead on a
+    background thread, so that reading overlaps with the work done on each
+    item, while at most prefetch + 2 items are held in memory.
+
+    Parameters
+    ----------
+    ens : cmipdata Ensemble
+          The ensemble of files to read.
+    varname : str
+              The variable to read.
+    toDatetime : boolean
+                 Passed to get_dimensions.
+    block : int
+            The number of time steps in each block. Defaults to None, to
+            yield one file at a time.
+    prefetch : int
+               The number of items read ahead. 0 reads each item only when
+               it is asked for.
+    kwargs : the selection keyword arguments of loadvar (dates, lat, lon,
+             level and stride) and, one file at a time, also cdostr or
+             reduce as for loadfiles.
+
+    Yields
+    ------
+    dictionary with keys data and dimensions, as returned by loadfiles. One
+    file at a time, data has no file axis and dimensions also has the key
+    file. With a cdostr, dimensions has only the keys file, models and
+    realizations.
+
+    Examples
+    --------
+
+    1. Global mean of daily data, file by file::
+
+        for item in cd.iterfiles(ens, 'ta', reduce='fldmean'):
+            np.save(item['dimensions']['file'] + '.npy', item['data'])
+
+    2. The ensemble mean a year at a time::
+
+        for item in cd.iterfiles(ens, 'tas', block=365):
+            means.append(item['data'].mean(axis=0))
+    """
+    files = ens.objects('ncfile')
+    selection = _selection(kwargs)
+    if kwargs.get('cdostr') and (selection or kwargs.get('reduce')):
+        raise ValueError('a selection or reduce cannot be combined with a cdostr')
+    if block is not None and (kwargs.get('cdostr') or kwargs.get('reduce')):
+        raise ValueError('cdostr and reduce are only supported one file at a time (block=None)')
+    if block is None:
+        items = _iter_files(files, varname, toDatetime, kwargs)
+    else:
+        items = _iter_blocks(files, varname, toDatetime, block, selection)
+    if prefetch > 0:
+        items = _prefetch(items, prefetch)
+    return items
+
+
+def _iter_files(files, varname, toDatetime, kwargs):
+    selection = _selection(kwargs)
+    for f in files:
+        if kwargs.get('reduce'):
+            data, steps = _reduce(f.name, varname, kwargs['reduce'], selection)
+            dimensions = _reduced_dimensions(
+                get_dimensions(f.name, varname, toDatetime=toDatetime, **selection),
+                kwargs['reduce'], steps)
+        elif kwargs.get('cdostr'):
+            data = loadvar(f.name, varname, **kwargs)
+            dimensions = {}
+        else:
+            data = loadvar(f.name, varname, **kwargs)
+            dimensions = get_dimensions(f.name, varname, toDatetime=toDatetime, **selection)
+        dimensions['file'] = f.name
+        dimensions['models'] = get_models([f])
+        dimensions['realizations'] = get_realizations([f])
+        yield {"data": data, "dimensions": dimensions}
+
+
+def _iter_blocks(files, varname, toDatetime, block, selection):
+    ifiles = [f.name for f in files]
+    dimensions = get_dimensions(ifiles[0], varname, toDatetime=toDatetime, **selection)
+    if 'time' not in dimensions:
+        raise ValueError(varname + ' has no time dimension to iterate over')
+    models = get_models(files)
+    realizations = get_realizations(files)
+    ntime = len(dimensions['time'])
+    for a in range(0, ntime, block):
+        steps = dict(selection, steps=(a, a + block))
+        shape, dtype = _var_info(ifiles[0], varname, steps)
+        if block > 1 and a + 1 == ntime:
+            # keep the time axis of a last block of one time step
+            shape = (1,) + shape
+        varmat = np.empty((len(ifiles),) + shape, dtype=dtype)
+        mask = np.zeros(varmat.shape, dtype=bool)
+        for i, ifile in enumerate(ifiles):
+            _read_into(ifile, varname, varmat[i], mask[i], steps)
+        block_dimensions = dict(dimensions)
+        block_dimensions['time'] = dimensions['time'][a:a + block]
+        block_dimensions['models'] = models
+        block_dimensions['realizations'] = realizations
+        yield {"data": np.ma.masked_array(varmat, mask=mask, copy=False),
+               "dimensions": block_dimensions}
+
+
+def _prefetch(items, prefetch):
+    """Run the iterator items on a background thread, which keeps up to
+    prefetch items ready. The thread stops when the returned generator is
+    closed or garbage collected."""
+    ready = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(message):
+        while not stop.is_set():
+            try:
+                ready.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(('item', item)):
+                    return
+            put(('end', None))
+        except Exception as e:
+            put(('error', e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, item = ready.get()
+            if kind == 'end':
+                return
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def _load_row(varmat, mask, i, ifile, varname, kwargs):
+    """Load varname from ifile into row i of varmat (and mask)."""
+    if kwargs.get('cdostr') or kwargs.get('reduce'):
+        _store(varmat, mask, i, loadvar(ifile, varname, **kwargs))
+    else:
+        _read_into(ifile, varname, varmat[i], mask[i] if mask is not None else None,
+                   _selection(kwargs))
+
+
+def _shared_empty(shape, dtype):
+    """An array in an anonymous shared memory mapping, which is written to by
+    forked worker processes and seen by the parent without any copying. The
+    mapping is freed with the array. It starts zero filled."""
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+def _fork_map(func, items, workers):
+    """Call func on each of items, with workers > 1 in a pool of forked
+    processes. func is inherited by the workers rather than pickled, so it
+    may be a closure; its results must be written into arrays made by
+    _shared_empty, which the parent sees without any copying."""
+    if workers <= 1:
+        for item in items:
+            func(item)
+        return
+    context = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                initializer=_init_shared,
+                                                initargs=(func,)) as executor:
+        list(executor.map(_call_shared, items))
+
+
+_shared = None
+
+
+def _init_shared(func):
+    # runs in each forked worker, which inherits func and its shared arrays
+    global _shared
+    _shared = func
+
+
+def _call_shared(item):
+    _shared(item)
+
+
+def _store(varmat, mask, i, var):
+    """Store the masked array var as row i of varmat, flagging its masked
+    values in mask or, if mask is None, setting them to NaN."""
+    if var.shape != varmat.shape[1:]:
+        raise ValueError('file %d has shape %s, expected %s' % (i, var.shape, varmat.shape[1:]))
+    varmat[i] = np.ma.getdata(var)
+    if mask is not None:
+        mask[i] = np.ma.getmaskarray(var)
+    else:
+        varmat[i][np.ma.getmaskarray(var)] = np.nan
+
 
 def get_models(files):
     models = []
@@ -145,42 +2077,190 @@ def get_realizations(files):
         realizations.append(f.parentobject('realization').name)
     return realizations    
 
+def get_experiments(files):
+    experiments = []
+    for f in files:
+        experiments.append(f.parentobject('experiment').name)
+    return experiments
+
         
-def get_dimensions(ifile, varname, toDatetime=False):
+def get_dimensions(ifile, varname, toDatetime=False, **selection):
     """Returns the dimensions of variable varname in file ifile as a dictionary.
     If one of the dimensions begins with lat (Lat, Latitude and Latitudes), it
     will be returned with a key of lat, and similarly for lon. If toDatetime=True,
-    the time dimension is converted to a datetime.
+    the time dimension is converted to datetimes, or if toDatetime='datetime64'
+    to numpy datetime64 values (see time_tools.decode_times). Optionally give the
+    selection keyword arguments of loadvar (dates, lat, lon, level, stride)
+    to get the coordinates of the selected hyperslab.
     """
 
-    # Open the variable using NetCDF4
-    nc = Dataset(ifile, 'r')
-    ncvar = nc.variables[varname]
+    with prof.record('netcdf', 'get_dimensions', inputs=[ifile]) as rec:
+        dimensions = _get_dimensions(ifile, varname, toDatetime, _selection(selection))
+        if rec is not None:
+            rec['bytes_read'] = sum(np.asarray(v).nbytes for v in dimensions.values())
+    return dimensions
 
-    dimensions = {}
-    for dimension in ncvar.dimensions:
-        if dimension.lower().startswith('lat'):
-            dimensions['lat'] = nc.variables[dimension][:]
-        elif dimension.lower().startswith('lon'):
-            dimensions['lon'] = nc.variables[dimension][:]
-        elif dimension.lower().startswith('time'):
-            if toDatetime is True:
-                # Following Phil Austin's slice_nc
-                nc_time = nc.variables[dimension]
-                try:
-                    cal = nc_time.calendar
-                except:
-                    cal = 'standard'
-                dimensions['time'] = num2date(nc_time[:], nc_time.units, cal)
-                dimensions['time'] = [datetime.datetime(
-                    *item.timetuple()[:6]) for item in dimensions['time']]
-                dimensions['time'] = np.array(dimensions['time'])
+
+def _get_dimensions(ifile, varname, toDatetime=False, selection=None):
+    with _dataset(ifile) as nc:
+        ncvar = nc.variables[varname]
+        index = _hyperslab(nc, ncvar, **(selection or {}))
+
+        dimensions = {}
+        for dimension, idx in zip(ncvar.dimensions, index):
+            if dimension not in nc.variables:
+                dimensions[dimension] = np.arange(len(nc.dimensions[dimension]))[idx]
+                continue
+            # copied, so that the cached coordinates cannot be modified
+            values = _take(_coordinate(nc, dimension), idx).copy()
+            if dimension.lower().startswith('lat'):
+                dimensions['lat'] = values
+            elif dimension.lower().startswith('lon'):
+                dimensions['lon'] = values
+            elif dimension.lower().startswith('time'):
+                if toDatetime:
+                    nc_time = nc.variables[dimension]
+                    values = _to_datetime(values, nc_time.units,
+                                          getattr(nc_time, 'calendar', 'standard'), toDatetime)
+                dimensions['time'] = values
             else:
-                dimensions['time'] = nc.variables[dimension][:]
-        else:
-            dimensions[dimension] = nc.variables[dimension][:]
+                dimensions[dimension] = values
     return dimensions
 
 
+def _to_datetime(values, units, calendar='standard', toDatetime=True):
+    """Convert time values to an array of datetime.datetime, or of
+    datetime64 if toDatetime='datetime64'."""
+    form = 'datetime64' if toDatetime == 'datetime64' else 'datetime'
+    # copied, as decode_times returns its cached, read-only result
+    return decode_times(values, units, calendar, form=form).copy()
+
+
+# Open netCDF files are kept in a process-wide pool, so that files read
+# several times (for the dimensions, the header and the data) are opened
+# once. At most _max_open files are kept open; files in use are never closed.
+_max_open = 64
+_pool = OrderedDict()
+_pool_lock = threading.RLock()
+
+# netCDF4 and HDF5 are not thread safe, so this lock is held whenever a file
+# is in use: reads from several threads are serialized. It is taken before
+# _pool_lock.
+_netcdf_lock = threading.RLock()
+
+# Coordinate variables, read once per file and dimension, and shared between
+# all files with the same values.
+_MAX_COORDINATES = 4096
+_coordinates = OrderedDict()
+_grids = OrderedDict()
+
+
+def set_max_open_files(n):
+    """Set the maximum number of netCDF files loading_tools keeps open
+    (default 64), closing the least recently used files if needed."""
+    global _max_open
+    _max_open = max(int(n), 1)
+    with _netcdf_lock, _pool_lock:
+        _evict_handles()
+
+
+def close_files():
+    """Close all files kept open by loading_tools, and clear the cached
+    coordinates."""
+    with _netcdf_lock, _pool_lock:
+        for ifile in list(_pool):
+            if _pool[ifile][2] == 0:
+                _pool.pop(ifile)[0].close()
+        _coordinates.clear()
+        _grids.clear()
+
+
+@contextlib.contextmanager
+def _dataset(ifile):
+    """An open Dataset for ifile from the pool, which is reopened if the
+    file has been modified since it was opened. _netcdf_lock is held while
+    the Dataset is in use."""
+    mtime = os.path.getmtime(ifile)
+    with _netcdf_lock:
+        with _pool_lock:
+            entry = _pool.get(ifile)
+            if entry is not None and entry[1] != mtime and entry[2] == 0:
+                _pool.pop(ifile)[0].close()
+                entry = None
+            if entry is None:
+                entry = [Dataset(ifile, 'r'), mtime, 0]
+                _pool[ifile] = entry
+            entry[2] += 1
+            _pool.move_to_end(ifile)
+            _evict_handles()
+        try:
+            yield entry[0]
+        finally:
+            with _pool_lock:
+                entry[2] -= 1
+                _evict_handles()
+
+
+def _evict_handles():
+    # called with _pool_lock held
+    for ifile in list(_pool):
+        if len(_pool) <= _max_open:
+            break
+        if _pool[ifile][2] == 0:
+            _pool.pop(ifile)[0].close()
+
+
+def _forget_handles():
+    # forked children must not share the parent's HDF5 file handles, nor
+    # inherit locks held by the parent's other threads
+    global _pool_lock, _netcdf_lock
+    _pool_lock = threading.RLock()
+    _netcdf_lock = threading.RLock()
+    _pool.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_handles)
+
+
+def _coordinate(nc, dimension):
+    """The values of the coordinate variable dimension of the open Dataset
+    nc, read once per file (and modification time). Latitudes, longitudes
+    and levels with exactly the values of a grid already read (the same
+    name, dtype, units and a hash of all the values) share its array, so
+    that the caches keyed on it are shared too."""
+    ifile = nc.filepath()
+    key = (ifile, os.path.getmtime(ifile), dimension)
+    with _pool_lock:
+        if key in _coordinates:
+            _coordinates.move_to_end(key)
+            return _coordinates[key]
+    ncvar = nc.variables[dimension]
+    values = ncvar[:]
+    if np.ma.isMaskedArray(values) and not np.ma.is_masked(values):
+        values = values.data
+    values.flags.writeable = False
+    grid = None
+    if _dim_kind(nc, dimension) != 'time' and not np.ma.isMaskedArray(values):
+        grid = (dimension, values.dtype.str, values.shape, getattr(ncvar, 'units', None),
+                hashlib.sha1(values.tobytes()).hexdigest())
+    with _pool_lock:
+        if grid is not None:
+            values = _grids.setdefault(grid, values)
+            _grids.move_to_end(grid)
+        _coordinates[key] = values
+        for cache in (_coordinates, _grids):
+            while len(cache) > _MAX_COORDINATES:
+                cache.popitem(last=False)
+    return values
+
+
+def _take(values, idx):
+    """Index the coordinate values by an index from _hyperslab."""
+    if isinstance(idx, list):
+        return np.concatenate([values[p] for p in idx])
+    return values[idx]
+
+
 if __name__ == "__main__":
     pass
@@ -23,7 +23,7 @@ from matplotlib.backends.backend_pdf import PdfPages
 
 def plot_realizations_1d(data, varname, dimension, ax=None, pdf="", png="",
                          xlabel="", ylabel="", title="",
-                         kwargs={'color': [0.5, 0.5, 0.5]}):
+                         kwargs={'color': [0.5, 0.5, 0.5]}, per_model=False):
     """ For each realization in ens (and data, which is generated from ens
     using loadfiles), plot the realization in color (grey by default)
     for variable varname. Data should be 1-d for each realization, along the
@@ -32,7 +32,7 @@ def plot_realizations_1d(data, varname, dimension, ax=None, pdf="", png="",
     Parameters
     ----------
     data : dictionary 
-           returned from loadfiles()
+           returned from loadfiles() (an EnsembleArray)
            has keys 'data' and 'dimensions' which map to numpy arrays
     varname : str
               the name of the variable
@@ -49,6 +49,9 @@ def plot_realizations_1d(data, varname, dimension, ax=None, pdf="", png="",
     kwargs : (optional) dict 
              options to pass to plt
              ex. {'color': [0.5, 0.5, 0.5]}
+    per_model : (optional) boolean
+                if True, plot the mean of each model rather than each
+                realization (data must be an EnsembleArray)
              
     EXAMPLES:
     # first call loadfiles to get the data dictionary
@@ -56,6 +59,8 @@ def plot_realizations_1d(data, varname, dimension, ax=None, pdf="", png="",
     # plot the tas data against latitude in red
     cd.plot_realizations_1d(data, 'tas', dimension='lat', kwargs={'color':'r'})
     """
+    if per_model:
+        data = data.model_mean()
     plotdata = data["data"]
     dimensions = data["dimensions"]
     x = dimensions[dimension]
@@ -10,8 +10,13 @@
 import os
 import glob
 from . import classes as dc
+from . import profiling as prof
 import copy
 import itertools
+import queue
+import re
+import subprocess
+import concurrent.futures
 
 # ===========================================================================
 # The next three operators work on multiple files across the ensemble,
@@ -104,7 +109,8 @@ def cat_exp_slices(ensemble, delete=True, output_prefix=''):
             if not os.path.isfile(outfile):
                 # join the files
                 catstring = 'cdo mergetime ' + infiles + ' ' + outfile
-                os.system(catstring)
+                prof.system(catstring, 'mergetime', node=files[0],
+                            inputs=modfiles, outputs=[outfile])
             else:
                 print(outfile + ' already exists.')
             f = dc.DataNode('ncfile', outfile, parent=var, start_date=min(startdates), end_date=max(enddates))
@@ -247,7 +253,8 @@ def cat_experiments(ensemble, variable_name, exp1_name, exp2_name, delete=True,
                 print("\n join " + model.name + '_' + e1r.name + ' ' + e1.name + ' to ' + e2.name)
                 catstring = ('cdo mergetime ' + infiles + ' ' + outfile)
 
-                os.system(catstring)
+                prof.system(catstring, 'mergetime', model=model.name,
+                            inputs=filenames, outputs=[outfile])
 
                 # Add a new joined experiment to ens,
                 # with a newly minted realization, variable + filenames.
@@ -389,7 +396,8 @@ def ens_stats(ens, variable_name, output_prefix=''):
             if os.path.isfile(outfile):
                 files_to_mean.append(outfile)
             else:
-                os.system(cdostr)
+                prof.system(cdostr, 'ensmean', model=model,
+                            inputs=fnames, outputs=[outfile])
                 files_to_mean.append(outfile)
 
         in_files = ' '.join(files_to_mean)
@@ -400,14 +408,14 @@ def ens_stats(ens, variable_name, output_prefix=''):
         out_file = output_prefix + 'ENS-MEAN_' + outfilename
 
         cdo_str = 'cdo ensmean ' + in_files + ' ' + out_file
-        os.system(cdo_str)
+        prof.system(cdo_str, 'ensmean', inputs=files_to_mean, outputs=[out_file])
         meanfiles.append(out_file)
 
         # Now do the standard deviation
         out_file = output_prefix + 'ENS-STD_' + outfilename.replace('R-MEAN', 'STD')
 
         cdo_str = 'cdo ensstd ' + in_files + ' ' + out_file
-        os.system(cdo_str)
+        prof.system(cdo_str, 'ensstd', inputs=files_to_mean, outputs=[out_file])
         stdevfiles.append(out_file)
 
         for fname in files_to_mean:
@@ -417,10 +425,170 @@ def ens_stats(ens, variable_name, output_prefix=''):
 # =========================================================================
 # The operators below this point work on a file-by-file basis and can be chained together
 # (in principle, not implemented). Practically my_operator can be used to chain operations.
+#
+# The cdo command for each operator is built by a matching _<operator>_cmd
+# function, which returns the command string and the name of the output file.
+# These are shared with the async_tools module.
 # =========================================================================
 
 
-def areaint(ensemble, delete=True, output_prefix=''):
+def _areaint_cmd(f, output_prefix=''):
+    outfile = output_prefix + 'area-integral_' + os.path.split(f.name)[1]
+    cdostr = 'cdo fldsum -mul ' + f.name + ' -gridarea ' + f.name + ' ' + outfile
+    return cdostr, outfile
+
+
+def _areamean_cmd(f, output_prefix=''):
+    outfile = output_prefix + 'area-mean_' + os.path.split(f.name)[1]
+    cdostr = 'cdo fldmean ' + f.name + ' ' + outfile
+    return cdostr, outfile
+
+
+def _zonmean_cmd(f, output_prefix=''):
+    outfile = output_prefix + 'zonal-mean_' + os.path.split(f.name)[1]
+    cdostr = 'cdo zonmean ' + f.name + ' ' + outfile
+    return cdostr, outfile
+
+
+def _climatology_cmd(f, output_prefix=''):
+    outfile = output_prefix + 'climatology_' + os.path.split(f.name)[1]
+    cdostr = 'cdo ymonmean -selvar,' + f.parent.name + ' ' + f.name + ' ' + outfile
+    return cdostr, outfile
+
+
+def _remap_cmd(f, remap='r360x180', method='remapdis', output_prefix=''):
+    outfile = output_prefix + 'remap_' + os.path.split(f.name)[1]
+    cdostr = ('cdo ' + method + ',' + remap + ' -selvar,' +
+              f.parent.name + ' ' + f.name + ' ' + outfile)
+    return cdostr, outfile
+
+
+def _time_slice_cmd(f, start_date, end_date, output_prefix=''):
+    date_range = start_date + ',' + end_date
+    start_yyyymm = start_date.replace('-', '')[0:6]
+    end_yyyymm = end_date.replace('-', '')[0:6]
+    outfile = (output_prefix + os.path.split(f.getNameWithoutDates())[1] +
+               '_' + start_yyyymm + '-' + end_yyyymm + '.nc')
+    cdostr = ('cdo -L seldate,' + date_range + ' -selvar,' +
+              f.parent.name + ' ' + f.name + ' ' + outfile)
+    return cdostr, outfile
+
+
+def _time_anomaly_cmd(f, start_date, end_date, output_prefix=''):
+    date_range = start_date + ',' + end_date
+    outfile = output_prefix + 'anomaly_' + os.path.split(f.name)[1]
+    cdostr = ('cdo sub ' + f.name + ' -timmean -seldate,' + date_range +
+              ' -selvar,' + f.parent.name + ' ' + f.name + ' ' + outfile)
+    return cdostr, outfile
+
+
+def _my_operator_cmd(f, my_cdo_str, output_prefix='processed_'):
+    outfile = output_prefix + os.path.split(f.name)[1]
+    values = f.getDictionary()
+    values['infile'] = f.name
+    values['outfile'] = outfile
+    return my_cdo_str.format(**values), outfile
+
+
+class _ShellWorker(object):
+    """A persistent shell, to which commands are written on stdin. The exit
+    status of each command is echoed back on stdout after a marker, along
+    with the CPU time used so far by the shell's children, while the output
+    of the commands themselves goes to stderr. Each command runs in a
+    subshell, as it would under os.system, and is written only once the
+    status of the previous one has been read, so that neither pipe can fill
+    up and block both sides.
+    """
+    _MARKER = '__cmipdata_status__'
+
+    def __init__(self):
+        self.proc = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     universal_newlines=True, bufsize=1)
+        self.cpu_time = 0.
+
+    def run(self, cmd):
+        """Run cmd in the shell and return its exit status and CPU time."""
+        try:
+            self.proc.stdin.write('( %s\n) </dev/null 1>&2; s=$?; times; echo %s $s\n'
+                                  % (cmd, self._MARKER))
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            raise RuntimeError('shell worker exited before running: ' + cmd)
+        times = ''
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise RuntimeError('shell worker exited while running: ' + cmd)
+            if line.startswith(self._MARKER):
+                break
+            times = line
+        # the last line of times is the user and system time of the children,
+        # e.g. 0m0.260000s 0m0.010000s
+        total = sum(60 * float(m) + float(sec)
+                    for m, sec in re.findall(r'(\d+)m([\d.]+)s', times))
+        cpu_time, self.cpu_time = total - self.cpu_time, total
+        return int(line.split()[1]), cpu_time
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def _run_cmds(files, jobs, name, batch_size=1, workers=1):
+    """Run the cdo command of each (cdostr, outfile) job in jobs, where
+    files are the corresponding input ncfile DataNodes, and return a list of
+    the exit statuses in the same order.
+
+    By default each command is run with its own os.system call. batch_size
+    > 1 instead sends the commands in batches of batch_size to workers
+    persistent shells, and runs workers batches at once. Every file still
+    runs its own cdo process: batching only saves forking the (possibly
+    large) python process and starting /bin/sh once per file, which matters
+    only when the files are small enough for cdo itself to be quick. The cdo
+    commands and their outputs are unchanged, so the results map back to the
+    same ensemble nodes.
+
+    Either way, when profiling is enabled each file gets its own record.
+    Through the shell workers the record has the CPU time of the command,
+    but no peak resident set size.
+    """
+    if batch_size <= 1 and workers <= 1:
+        return [prof.system(cdostr, name, node=f, outputs=[outfile])
+                for f, (cdostr, outfile) in zip(files, jobs)]
+
+    batch_size = max(batch_size, 1)
+    batches = [list(range(i, min(i + batch_size, len(jobs))))
+               for i in range(0, len(jobs), batch_size)]
+    statuses = [None] * len(jobs)
+    shells = queue.Queue()
+    for i in range(min(workers, len(batches))):
+        shells.put(_ShellWorker())
+
+    def run_batch(batch):
+        shell = shells.get()
+        try:
+            for i in batch:
+                cdostr, outfile = jobs[i]
+                with prof.record('cdo', name, node=files[i], outputs=[outfile]) as rec:
+                    statuses[i], cpu_time = shell.run(cdostr)
+                    if rec is not None:
+                        rec['cpu_time'] = cpu_time
+                        if statuses[i] != 0:
+                            rec['outcome'] = 'exit status ' + str(statuses[i])
+        finally:
+            shells.put(shell)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run_batch, batches))
+    finally:
+        while not shells.empty():
+            shells.get().close()
+    return statuses
+
+
+def areaint(ensemble, delete=True, output_prefix='', batch_size=1, workers=1):
     """
     Calculate the area weighted integral for each file in ens.
 
@@ -436,6 +604,16 @@ def areaint(ensemble, delete=True, output_prefix=''):
     delete : boolean
              If delete=True, delete the original input files.
 
+    batch_size : int
+                 If batch_size > 1, the cdo commands are sent in batches of
+                 batch_size files to persistent shell workers, rather than
+                 forking python and a shell for every file. Each file still
+                 runs its own cdo process, so this only helps when cdo itself
+                 is quick, i.e. for many small files.
+
+    workers : int
+              The number of batches processed at once.
+
     Returns
     -------
     ens : cmipdata Ensemble
@@ -455,12 +633,10 @@ def areaint(ensemble, delete=True, output_prefix=''):
     ens = copy.deepcopy(ensemble)
     
     # loop over all files
-    for f in ens.objects('ncfile'):
-        outfile = output_prefix + 'area-integral_' + os.path.split(f.name)[1]
-
-        cdostr = 'cdo fldsum -mul ' + f.name + ' -gridarea ' + f.name + ' ' + outfile
-        os.system(cdostr)
-        
+    files = ens.objects('ncfile')
+    jobs = [_areaint_cmd(f, output_prefix) for f in files]
+    _run_cmds(files, jobs, 'areaint', batch_size, workers)
+    for f, (cdostr, outfile) in zip(files, jobs):
         # delete old files
         if delete is True:
             delstr = 'rm ' + f.name
@@ -474,7 +650,7 @@ def areaint(ensemble, delete=True, output_prefix=''):
     return ens
 
 
-def areamean(ensemble, delete=True, output_prefix=''):
+def areamean(ensemble, delete=True, output_prefix='', batch_size=1, workers=1):
     """
     Calculate the area mean for each file in ens.
 
@@ -490,6 +666,16 @@ def areamean(ensemble, delete=True, output_prefix=''):
     delete : boolean
              If delete=True, delete the original input files.
 
+    batch_size : int
+                 If batch_size > 1, the cdo commands are sent in batches of
+                 batch_size files to persistent shell workers, rather than
+                 forking python and a shell for every file. Each file still
+                 runs its own cdo process, so this only helps when cdo itself
+                 is quick, i.e. for many small files.
+
+    workers : int
+              The number of batches processed at once.
+
     Returns
     -------
     ens : cmipdata Ensemble
@@ -509,12 +695,10 @@ def areamean(ensemble, delete=True, output_prefix=''):
     ens = copy.deepcopy(ensemble)
     
     # loop over all files
-    for f in ens.objects('ncfile'):
-        outfile = output_prefix + 'area-mean_' + os.path.split(f.name)[1]
-
-        cdostr = 'cdo fldmean ' + f.name + ' ' + outfile
-        os.system(cdostr)
-        
+    files = ens.objects('ncfile')
+    jobs = [_areamean_cmd(f, output_prefix) for f in files]
+    _run_cmds(files, jobs, 'areamean', batch_size, workers)
+    for f, (cdostr, outfile) in zip(files, jobs):
         # delete old files
         if delete is True:
             delstr = 'rm ' + f.name
@@ -528,7 +712,7 @@ def areamean(ensemble, delete=True, output_prefix=''):
     return ens
 
 
-def zonmean(ensemble, delete=True, output_prefix=''):
+def zonmean(ensemble, delete=True, output_prefix='', batch_size=1, workers=1):
     """
     Calculate the zonal mean for each file in ens.
 
@@ -544,6 +728,16 @@ def zonmean(ensemble, delete=True, output_prefix=''):
     delete : boolean
              If delete=True, delete the original input files.
 
+    batch_size : int
+                 If batch_size > 1, the cdo commands are sent in batches of
+                 batch_size files to persistent shell workers, rather than
+                 forking python and a shell for every file. Each file still
+                 runs its own cdo process, so this only helps when cdo itself
+                 is quick, i.e. for many small files.
+
+    workers : int
+              The number of batches processed at once.
+
     Returns
     -------
     ens : cmipdata Ensemble
@@ -563,12 +757,10 @@ def zonmean(ensemble, delete=True, output_prefix=''):
     ens = copy.deepcopy(ensemble)
     
     # loop over all files
-    for f in ens.objects('ncfile'):
-        outfile = output_prefix + 'zonal-mean_' + os.path.split(f.name)[1]
-
-        cdostr = 'cdo zonmean ' + f.name + ' ' + outfile
-        ex = os.system(cdostr)
-
+    files = ens.objects('ncfile')
+    jobs = [_zonmean_cmd(f, output_prefix) for f in files]
+    statuses = _run_cmds(files, jobs, 'zonmean', batch_size, workers)
+    for f, (cdostr, outfile), ex in zip(files, jobs, statuses):
         var = f.parent
         
         # if zonalmean is not succesful, delete the new file
@@ -592,7 +784,7 @@ def zonmean(ensemble, delete=True, output_prefix=''):
     return ens
 
 
-def climatology(ensemble, delete=True, output_prefix=''):
+def climatology(ensemble, delete=True, output_prefix='', batch_size=1, workers=1):
     """
     Compute the monthly climatology for each file in ens.
 
@@ -612,6 +804,16 @@ def climatology(ensemble, delete=True, output_prefix=''):
     delete : boolean
              If delete=True, delete the original input files.
 
+    batch_size : int
+                 If batch_size > 1, the cdo commands are sent in batches of
+                 batch_size files to persistent shell workers, rather than
+                 forking python and a shell for every file. Each file still
+                 runs its own cdo process, so this only helps when cdo itself
+                 is quick, i.e. for many small files.
+
+    workers : int
+              The number of batches processed at once.
+
     Returns
     -------
     ens : cmipdata Ensemble
@@ -631,11 +833,11 @@ def climatology(ensemble, delete=True, output_prefix=''):
     ens = copy.deepcopy(ensemble)
     
     # loop over all the files
-    for f in ens.objects('ncfile'):
-        outfile = output_prefix + 'climatology_' + os.path.split(f.name)[1]
+    files = ens.objects('ncfile')
+    jobs = [_climatology_cmd(f, output_prefix) for f in files]
+    _run_cmds(files, jobs, 'climatology', batch_size, workers)
+    for f, (cdostr, outfile) in zip(files, jobs):
         var = f.parent
-        cdostr = 'cdo ymonmean -selvar,' + var.name + ' ' + f.name + ' ' + outfile
-        os.system(cdostr)
         
         # delete the old file
         if delete is True:
@@ -649,7 +851,8 @@ def climatology(ensemble, delete=True, output_prefix=''):
     return ens
 
 
-def remap(ensemble, remap='r360x180', method='remapdis', delete=True, output_prefix=''):
+def remap(ensemble, remap='r360x180', method='remapdis', delete=True, output_prefix='',
+          batch_size=1, workers=1):
     """
     Remap files to a specified resolution.
 
@@ -672,6 +875,16 @@ def remap(ensemble, remap='r360x180', method='remapdis', delete=True, output_pre
     delete : boolean
              If delete=True, delete the original input files.
 
+    batch_size : int
+                 If batch_size > 1, the cdo commands are sent in batches of
+                 batch_size files to persistent shell workers, rather than
+                 forking python and a shell for every file. Each file still
+                 runs its own cdo process, so this only helps when cdo itself
+                 is quick, i.e. for many small files.
+
+    workers : int
+              The number of batches processed at once.
+
     Returns
     -------
     ens : cmipdata Ensemble
@@ -693,12 +906,11 @@ def remap(ensemble, remap='r360x180', method='remapdis', delete=True, output_pre
     ens = copy.deepcopy(ensemble)
     
     # loop over all files
-    for f in ens.objects('ncfile'):
-        outfile = output_prefix + 'remap_' + os.path.split(f.name)[1]
+    files = ens.objects('ncfile')
+    jobs = [_remap_cmd(f, remap, method, output_prefix) for f in files]
+    statuses = _run_cmds(files, jobs, method, batch_size, workers)
+    for f, (cdostr, outfile), ex in zip(files, jobs, statuses):
         var = f.parent
-        cdostr = ('cdo ' + method + ',' + remap + ' -selvar,' +
-                  var.name + ' ' + f.name + ' ' + outfile)
-        ex = os.system(cdostr)
         
         # if remapping is not successful delete the new file
         if ex != 0:
@@ -759,7 +971,6 @@ def time_slice(ensemble, start_date, end_date, delete=True, output_prefix=''):
 
     """
     ens = copy.deepcopy(ensemble)
-    date_range = start_date + ',' + end_date
 
     # convert dates to CMIP YYYYMM format
     start_yyyymm = start_date.replace('-', '')[0:6]
@@ -772,12 +983,9 @@ def time_slice(ensemble, start_date, end_date, delete=True, output_prefix=''):
             var = f.parent
             # check that the new date range is within the old date range
             if f.start_date <= start_yyyymm and f.end_date >= end_yyyymm:
-                outfile = output_prefix + os.path.split(f.getNameWithoutDates())[1] + '_' + start_yyyymm + '-' + end_yyyymm + '.nc'
+                cdostr, outfile = _time_slice_cmd(f, start_date, end_date, output_prefix)
                 print('time limiting...')
-
-                cdostr = ('cdo -L seldate,' + date_range + ' -selvar,' +
-                          var.name + ' ' + f.name + ' ' + outfile)
-                ex = os.system(cdostr)
+                ex = prof.system(cdostr, 'seldate', node=f, outputs=[outfile])
 
                 # if the time silcing is unsuccesful, remove the new file
                 if ex != 0:
@@ -844,7 +1052,6 @@ def time_anomaly(ensemble, start_date, end_date, delete=False, output_prefix='')
 
     """
     ens = copy.deepcopy(ensemble)
-    date_range = start_date + ',' + end_date
 
     # convert dates to CMIP YYYYMM format
     start_yyyymm = start_date.replace('-', '')[0:6]
@@ -855,10 +1062,8 @@ def time_anomaly(ensemble, start_date, end_date, delete=False, output_prefix='')
         # check the date range is within the file date range
         if f.start_date <= start_yyyymm and f.end_date >= start_yyyymm:
             var = f.parent
-            outfile = output_prefix + 'anomaly_' + os.path.split(f.name)[1]
-            cdostr = ('cdo sub ' + f.name + ' -timmean -seldate,' + date_range +
-                      ' -selvar,' + var.name + ' ' + f.name + ' ' + outfile)
-            os.system(cdostr)
+            cdostr, outfile = _time_anomaly_cmd(f, start_date, end_date, output_prefix)
+            prof.system(cdostr, 'time_anomaly', node=f, outputs=[outfile])
 
             ncfile = dc.DataNode('ncfile', outfile, parent=var, start_date=f.start_date, end_date=f.end_date)
             var.add(ncfile)
@@ -872,7 +1077,8 @@ def time_anomaly(ensemble, start_date, end_date, delete=False, output_prefix='')
     return ens
 
 
-def my_operator(ensemble, my_cdo_str="", output_prefix='processed_', delete=False):
+def my_operator(ensemble, my_cdo_str="", output_prefix='processed_', delete=False,
+                batch_size=1, workers=1):
     """
     Apply a customized cdo operation to all files in ens.
 
@@ -897,6 +1103,16 @@ def my_operator(ensemble, my_cdo_str="", output_prefix='processed_', delete=Fals
     delete : boolean
              If delete=True, delete the original input files.
 
+    batch_size : int
+                 If batch_size > 1, the cdo commands are sent in batches of
+                 batch_size files to persistent shell workers, rather than
+                 forking python and a shell for every file. Each file still
+                 runs its own cdo process, so this only helps when cdo itself
+                 is quick, i.e. for many small files.
+
+    workers : int
+              The number of batches processed at once.
+
     Returns
     -------
     ens : cmipdata Ensemble
@@ -926,13 +1142,10 @@ def my_operator(ensemble, my_cdo_str="", output_prefix='processed_', delete=Fals
         del_ens = copy.deepcopy(ensemble)
     
     # loop over all files
-    for f in ensem.objects('ncfile'):
-        outfile = output_prefix + os.path.split(f.name)[1]
-        values = f.getDictionary()
-        values['infile'] = f.name
-        values['outfile'] = outfile
-        cdostr = my_cdo_str.format(**values)
-        ex = os.system(cdostr)
+    files = ensem.objects('ncfile')
+    jobs = [_my_operator_cmd(f, my_cdo_str, output_prefix) for f in files]
+    statuses = _run_cmds(files, jobs, 'my_operator', batch_size, workers)
+    for f, (cdostr, outfile), ex in zip(files, jobs, statuses):
         var = f.parent
         
         # if the operation is unsuccessful, delete the new file
@@ -1022,7 +1235,8 @@ def trends(ensemble, start_date, end_date, delete=False):
                       'intercept_' + outfile + ' ' +
                       'slope_' + outfile)
 
-            ex = os.system(cdostr)
+            ex = prof.system(cdostr, 'trend', node=f,
+                             outputs=['intercept_' + outfile, 'slope_' + outfile])
             
             # if the trands are not successful the new file is deleted
             if ex != 0:
@@ -0,0 +1,313 @@
+"""profiling
+======================
+
+The profiling module of cmipdata provides opt-in instrumentation of the
+work done by the other modules: every cdo invocation made by the
+:mod:`preprocessing_tools` operators, the netCDF reads in :func:`loadvar` and
+:func:`get_dimensions`, and the tree operations of :mod:`classes`.
+
+Profiling is off by default and costs nothing but a flag check. Once
+switched on with :func:`enable_profiling`, one record is kept per task with
+its wall time, CPU time (including that of any child process), bytes read and
+written, the peak resident set size of the child process (where it can be
+measured) and the outcome.
+The records can be written as JSON lines with :func:`export_jsonl`, as a
+Chrome trace-event file (load it in chrome://tracing or Perfetto) with
+:func:`export_chrome_trace`, or summarized with :func:`profile_summary`.
+
+Examples
+--------
+
+1. Profile a zonal mean and a load, and summarize by operator::
+
+    cd.enable_profiling()
+    ens = cd.zonmean(ens)
+    data = cd.loadfiles(ens, 'ts')
+    cd.profile_summary(by='name')
+    cd.export_chrome_trace('trace.json')
+
+  .. moduleauthor:: Neil Swart <neil.swart@ec.gc.ca>
+"""
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+_enabled = False
+_records = []
+_lock = threading.Lock()
+
+# ru_maxrss is in kilobytes on Linux, but in bytes on OSX
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def enable_profiling():
+    """Start recording a profile of all instrumented tasks."""
+    global _enabled
+    _enabled = True
+
+
+def disable_profiling():
+    """Stop recording. The records collected so far are kept."""
+    global _enabled
+    _enabled = False
+
+
+def profiling_enabled():
+    """Returns True if profiling is switched on."""
+    return _enabled
+
+
+def clear_profile():
+    """Discard all records collected so far."""
+    with _lock:
+        del _records[:]
+
+
+def profile_records():
+    """Returns a list of the records (dictionaries) collected so far."""
+    with _lock:
+        return list(_records)
+
+
+def _filesize(names):
+    size = 0
+    for name in names:
+        try:
+            size += os.path.getsize(name)
+        except OSError:
+            pass
+    return size
+
+
+@contextlib.contextmanager
+def record(category, name, node=None, model=None, inputs=(), outputs=()):
+    """Context manager recording one task when profiling is enabled.
+
+    Parameters
+    ----------
+    category : str
+               The kind of task, e.g. 'cdo', 'netcdf' or 'tree'.
+    name : str
+           The operator or function name.
+    node : DataNode
+           Optional ncfile DataNode the task works on. Gives the model and
+           the input file, when these are not given explicitly.
+    model : str
+            The model the task works on.
+    inputs, outputs : list of str
+                      Files read and written. Unless the task sets
+                      'bytes_read' or 'bytes_written' itself, these are
+                      taken from the sizes of the files.
+
+    The CPU time is that of the calling thread plus any 'child_cpu_time' the
+    task sets, unless the task sets 'cpu_time' itself (e.g. a coroutine,
+    whose thread also runs other tasks while it awaits).
+
+    Yields
+    ------
+    dictionary : the record, which the task may update (or None when
+                 profiling is disabled).
+    """
+    if not _enabled:
+        yield None
+        return
+
+    if node is not None:
+        if model is None:
+            model = node.getDictionary().get('model')
+        if not inputs and node.genre == 'ncfile':
+            inputs = [node.name]
+
+    rec = {'category': category, 'name': name, 'model': model,
+           'inputs': list(inputs), 'outputs': list(outputs),
+           'pid': os.getpid(), 'tid': threading.current_thread().ident,
+           'start': time.time()}
+    t0 = time.perf_counter()
+    c0 = time.thread_time()
+    try:
+        yield rec
+        rec.setdefault('outcome', 'ok')
+    except BaseException as e:
+        rec['outcome'] = 'error: ' + type(e).__name__
+        raise
+    finally:
+        rec['wall_time'] = time.perf_counter() - t0
+        if 'cpu_time' not in rec:
+            rec['cpu_time'] = time.thread_time() - c0 + rec.pop('child_cpu_time', 0.)
+        if 'bytes_read' not in rec:
+            rec['bytes_read'] = _filesize(rec['inputs'])
+        if 'bytes_written' not in rec:
+            rec['bytes_written'] = _filesize(rec['outputs'])
+        rec.setdefault('peak_rss', None)
+        with _lock:
+            _records.append(rec)
+
+
+def profiled(category):
+    """Decorator recording every call of the decorated function under
+    category, when profiling is enabled.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with record(category, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def system(cmd, name=None, node=None, model=None, inputs=(), outputs=()):
+    """Run the shell command cmd, like os.system, recording it when
+    profiling is enabled.
+
+    The CPU time and peak resident set size of the command are measured by a
+    small python process which runs it and waits for it with os.wait4, as
+    waiting for a child forked from this (possibly large) process would
+    count the parent's image in the peak resident set size. The peak
+    therefore never falls below that of the wrapper, about 15 MB.
+
+    Returns
+    -------
+    int : the exit status of cmd as the shell reports it (0 on success, 128
+          plus the signal number if it was killed), whether or not profiling
+          is enabled.
+    """
+    if not _enabled:
+        return _exit_status(os.system(cmd))
+
+    if name is None:
+        name = _operator(cmd)
+    with record('cdo', name, node=node, model=model, inputs=inputs,
+                outputs=outputs) as rec:
+        if hasattr(os, 'wait4'):
+            usage, writer = os.pipe()
+            try:
+                proc = subprocess.Popen([sys.executable, '-c', _WAIT4, str(writer), cmd],
+                                        pass_fds=(writer,))
+            finally:
+                os.close(writer)
+            try:
+                ex = proc.wait()
+                measured = os.read(usage, 64).split()
+            finally:
+                os.close(usage)
+            if measured:
+                rec['cpu_time'] = float(measured[0])
+                rec['peak_rss'] = int(measured[1]) * _RSS_UNIT
+        else:
+            ex = _exit_status(os.system(cmd))
+        if ex != 0:
+            rec['outcome'] = 'exit status ' + str(ex)
+    return ex
+
+
+# Runs the shell command argv[2], writes its CPU time and peak resident set
+# size to the file descriptor argv[1], and exits with its exit status.
+_WAIT4 = """
+import os, subprocess, sys
+pid, status, usage = os.wait4(subprocess.Popen(sys.argv[2], shell=True).pid, 0)
+os.write(int(sys.argv[1]), b'%r %d' % (usage.ru_utime + usage.ru_stime, usage.ru_maxrss))
+sys.exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status))
+"""
+
+
+def _exit_status(status):
+    """The exit status, as the shell reports it, of the wait status returned
+    by os.system."""
+    if not hasattr(os, 'WIFEXITED'):
+        # on Windows os.system returns the exit status itself
+        return status
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# cdo options which take a value, e.g. -f nc
+_CDO_VALUE_OPTIONS = ('-f', '-b', '-z', '-P', '-t', '-k', '-m', '--timestat_date')
+
+
+def _operator(cmd):
+    """The name of the (first) cdo operator in the shell command cmd, e.g.
+    'remapdis' for 'cdo -O -f nc -remapdis,r360x180 in.nc out.nc', or the
+    first word of cmd if it is not a cdo command."""
+    words = cmd.split()
+    if not words or os.path.basename(words[0]) != 'cdo':
+        return words[0] if words else cmd
+    skip = False
+    for word in words[1:]:
+        if skip:
+            skip = False
+        elif word in _CDO_VALUE_OPTIONS:
+            skip = True
+        elif not (word.startswith('--') or word.startswith('-') and len(word) == 2):
+            # options are single letters, or long options
+            return word.lstrip('-').split(',')[0]
+    return words[0]
+
+
+def export_jsonl(filename):
+    """Write all records to filename, one JSON object per line."""
+    with open(filename, 'w') as f:
+        for rec in profile_records():
+            f.write(json.dumps(rec, default=str) + '\n')
+
+
+def export_chrome_trace(filename):
+    """Write all records to filename in the Chrome trace-event format."""
+    events = []
+    for rec in profile_records():
+        args = dict((k, v) for k, v in rec.items()
+                    if k not in ('name', 'category', 'pid', 'tid', 'start', 'wall_time'))
+        events.append({'name': rec['name'],
+                       'cat': rec['category'],
+                       'ph': 'X',
+                       'ts': rec['start'] * 1e6,
+                       'dur': rec['wall_time'] * 1e6,
+                       'pid': rec['pid'],
+                       'tid': rec['tid'],
+                       'args': args})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+def profile_summary(by='name', show=True):
+    """Summarize the records, grouped by operator name (by='name'), model
+    (by='model') or category (by='category').
+
+    Returns
+    -------
+    dictionary mapping each group to a dictionary with keys count, failed,
+    wall_time, cpu_time, bytes_read, bytes_written and peak_rss. If show is
+    True the summary is also printed as a table.
+    """
+    summary = {}
+    for rec in profile_records():
+        key = rec.get(by)
+        s = summary.setdefault(key, {'count': 0, 'failed': 0, 'wall_time': 0.,
+                                     'cpu_time': 0., 'bytes_read': 0,
+                                     'bytes_written': 0, 'peak_rss': 0})
+        s['count'] += 1
+        if rec['outcome'] != 'ok':
+            s['failed'] += 1
+        s['wall_time'] += rec['wall_time']
+        s['cpu_time'] += rec['cpu_time']
+        s['bytes_read'] += rec['bytes_read']
+        s['bytes_written'] += rec['bytes_written']
+        s['peak_rss'] = max(s['peak_rss'], rec['peak_rss'] or 0)
+
+    if show:
+        print('%-24s %7s %7s %10s %10s %12s %12s %12s' %
+              (by, 'count', 'failed', 'wall(s)', 'cpu(s)', 'read(MB)',
+               'written(MB)', 'peakrss(MB)'))
+        for key in sorted(summary, key=lambda k: -summary[k]['wall_time']):
+            s = summary[key]
+            print('%-24s %7d %7d %10.2f %10.2f %12.1f %12.1f %12.1f' %
+                  (str(key), s['count'], s['failed'], s['wall_time'], s['cpu_time'],
+                   s['bytes_read'] / 1e6, s['bytes_written'] / 1e6, s['peak_rss'] / 1e6))
+    return summary
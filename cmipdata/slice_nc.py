@@ -2,23 +2,46 @@
 """
    Get a [time,lat,lon] slice from a netcdf file
 """
+import os
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
-from netCDF4 import Dataset, num2date, date2num
+from netCDF4 import Dataset, date2num
 import datetime as dt
 import nose
+try:
+    from .time_tools import decode_times
+except ImportError:
+    # run as a script
+    from time_tools import decode_times
 
 
-def find_index(vec_vals, target):
+# the sort order of recently searched coordinates which are not monotonic
+_MAX_ORDERS = 32
+_orders = OrderedDict()
+_orders_lock = threading.Lock()
+
+
+def find_index(vec_vals, target, period=None):
     """
 
     returns the first index of vec_vals that contains the value
     closest to target.
 
+    All targets are looked up at once with a binary search, so that
+    millions of targets can be found quickly. vec_vals need not be sorted:
+    increasing and decreasing values are searched directly, and the sort
+    order of other values is computed once and cached.
+
     Parameters
     ----------
 
-    vec_vals: list or 1-d array
-    target:   list 1-d array or scalar
+    vec_vals: list or 1-d array, of numbers or datetimes
+    target:   list 1-d array or scalar, of numbers or datetimes
+    period:   optional, float -- the period of a cyclic axis, e.g. 360
+              for longitudes, so that a target of -60 is found at 300 and
+              359.5 is closest to 0
 
 
     Returns
@@ -35,16 +58,75 @@ def find_index(vec_vals, target):
     [1, 5]
 
     """
+    values = _as_numbers(vec_vals)
+    target = _as_numbers(np.atleast_1d(target))
+    if not len(values):
+        raise ValueError('cannot find an index in an empty array')
+    if period is not None:
+        values = np.mod(values, period)
+        target = np.mod(target, period)
+
+    order, descending = _sort_order(values, period)
+    ordered = values if order is None else values[order]
+    n = len(ordered)
+    right = np.searchsorted(ordered, target, side='left')
+    left = right - 1
+    if period is None:
+        left = np.maximum(left, 0)
+        right = np.minimum(right, n - 1)
+    else:
+        # the neighbours on a cyclic axis wrap around its ends
+        left = np.mod(left, n)
+        right = np.mod(right, n)
+    # the first of repeated values, which are last in a decreasing axis
+    if descending:
+        left = np.searchsorted(ordered, ordered[left], side='right') - 1
+        right = np.searchsorted(ordered, ordered[right], side='right') - 1
+    else:
+        left = np.searchsorted(ordered, ordered[left], side='left')
+    if order is not None:
+        left, right = order[left], order[right]
+    left_distance = _distance(values[left], target, period)
+    right_distance = _distance(values[right], target, period)
+    closest = np.where((left_distance < right_distance) |
+                       ((left_distance == right_distance) & (left < right)), left, right)
+    return closest.tolist()
+
+
+def _as_numbers(values):
+    """values as a float array, with datetimes converted to microseconds."""
+    values = np.asarray(values)
+    if values.dtype == object or values.dtype.kind == 'M':
+        values = values.astype('datetime64[us]').astype('int64')
+    return values.astype('f8')
+
 
-    # turn scalar into iterable, no-op if already array
-    target = np.atleast_1d(target)
-    # turn list into ndarray or no-op if already array
-    vec_vals = np.array(vec_vals)
-    index_list = []
-    for item in target:
-        first_index = np.argmin(np.abs(vec_vals - item))
-        index_list.append(first_index)
-    return index_list
+def _distance(values, target, period):
+    distance = np.abs(values - target)
+    if period is not None:
+        distance = np.minimum(distance, period - distance)
+    return distance
+
+
+def _sort_order(values, period):
+    """The indices sorting values, or None if they are increasing, and
+    whether they are decreasing. The sort order of other values is cached."""
+    steps = np.diff(values)
+    if np.all(steps >= 0):
+        return None, False
+    if np.all(steps <= 0):
+        return np.arange(len(values))[::-1], True
+    key = (values.shape, period, hashlib.sha1(values.tobytes()).hexdigest())
+    with _orders_lock:
+        if key in _orders:
+            _orders.move_to_end(key)
+            return _orders[key], False
+    order = np.argsort(values, kind='stable')
+    with _orders_lock:
+        _orders[key] = order
+        while len(_orders) > _MAX_ORDERS:
+            _orders.popitem(last=False)
+    return order, False
 
 
 def get_var_2D(file_name, var_name, corners=None, start_date=None, stop_date=None,
@@ -55,13 +137,21 @@ def get_var_2D(file_name, var_name, corners=None, start_date=None, stop_date=Non
     var_name, return a slice with values
     [start_date:stop_date,corners.ll.lat:corners.ur.lat,corners.ll.lon:corners.ur.lon]
 
+    The Dataset is returned open, and must be closed by the caller; to
+    slice many files, or the same file many times, use a Slicer, which
+    keeps the files open between calls and closes them when done.
+
     Parameters
     ----------
 
     filename: str --  name of netcdf (possible including full path) of netcdf file
     varname:  str --  name of [time,lat,lon] netcdf variable (.eg. tos)
     corners:  optional, my_namedtuple -- Box object with latlon corner points
-                 if None, defaults to all lats, all lons
+                 if None, defaults to all lats, all lons. The points inside
+                 the box (edges included) are selected, with longitudes
+                 from corners.ll.lon eastwards to corners.ur.lon, so that
+                 a box may cross the dateline or the seam of the grid; a
+                 box 360 degrees wide spans all the longitudes
     start_date: optional, datetime  -- python datetime object to start slice
                  if None, defaults to time index 0
     stop_date: optional, datetime  -- python datetime object to end slice
@@ -92,58 +182,169 @@ def get_var_2D(file_name, var_name, corners=None, start_date=None, stop_date=Non
     """
     data_nc = Dataset(file_name)
     var_nc = data_nc.variables[var_name]
-    lat_nc = data_nc.variables[lat_name]
-    lon_nc = data_nc.variables[lon_name]
+    the_times, the_lats, the_lons, var_array = _slice(
+        data_nc, var_name, corners, start_date, stop_date, time_name, lat_name, lon_name)
+    return data_nc, var_nc, the_times, the_lats, the_lons, var_array
+
+
+def _slice(data_nc, var_name, corners, start_date, stop_date, time_name, lat_name, lon_name,
+           coordinates=None):
+    """
+
+    The slice of get_var_2D from the open Dataset data_nc. Only the times
+    of the slice are decoded: the start and stop dates are converted to
+    time values and looked up in the undecoded time axis. coordinates is an
+    optional dictionary caching the undecoded coordinate values by name.
+
+    """
+    if coordinates is None:
+        coordinates = {}
+
+    def values(name):
+        if name not in coordinates:
+            coordinates[name] = data_nc.variables[name][...]
+        return coordinates[name]
+
+    var_nc = data_nc.variables[var_name]
+    lats = values(lat_name)
+    lons = values(lon_name)
     if corners is not None:
-        #
-        # get all the lats and lons
-        #
-        lats = lat_nc[...]
-        lons = lon_nc[...]
-        crn = corners
         #
         # lat/lon points of box corners are stored in a named_tuple
         # in constants.py
         #
-        lat_slice = find_index(lats, [crn.ll.lat, crn.ur.lat])
-        lat_slice[1] += 1
-        lon_slice = find_index(lons, [crn.ll.lon, crn.ur.lon])
-        lon_slice[1] += 1
+        crn = corners
+        rows = np.nonzero((lats >= min(crn.ll.lat, crn.ur.lat)) &
+                          (lats <= max(crn.ll.lat, crn.ur.lat)))[0]
+        lat_slice = slice(int(rows[0]), int(rows[-1]) + 1) if len(rows) else slice(0, 0)
+        lon_slices = _runs(_lon_columns(lons, crn.ll.lon, crn.ur.lon)) or [slice(0, 0)]
     else:
-        lat_slice = [0, None]
-        lon_slice = [0, None]
-
-    lat_slice = slice(*lat_slice)
-    lon_slice = slice(*lon_slice)
+        lat_slice = slice(0, None)
+        lon_slices = [slice(0, None)]
 
-    the_lats = lat_nc[lat_slice]
-    the_lons = lon_nc[lon_slice]
-    #
-    # first convert to netcdftime datetime objects
-    #
-    time_nc = data_nc.variables['time']
-    the_times = time_nc[...]
-    the_dates = num2date(the_times, time_nc.units, time_nc.calendar)
-    #
-    # netCDF4 bug(?) means that netcdftime objects can't be compared/sorted
-    # so convert to python datetime objects
-    #
-    py_dates = [dt.datetime(*item.timetuple()[:6]) for item in the_dates]
-    py_dates = np.array(py_dates)
-    #
+    time_nc = data_nc.variables[time_name]
+    times = values(time_name)
+    calendar = getattr(time_nc, 'calendar', 'standard')
+    start_index = 0
+    stop_index = None
+    if start_date is not None:
+        start_index = find_index(times, date2num(start_date, time_nc.units, calendar))[0]
+    if stop_date is not None:
+        stop_index = find_index(times, date2num(stop_date, time_nc.units, calendar))[0]
+    time_slice = slice(start_index, stop_index)
     #
+    # convert to python datetime objects, which can be compared/sorted
+    # (unlike netcdftime objects)
     #
-    if start_date is None:
-        start_index = 0
-    else:
-        start_index = find_index(py_dates, start_date)[0]
-    if stop_date is not None:
-        stop_index = find_index(py_dates, stop_date)[0]
+    the_times = decode_times(times[time_slice], time_nc.units, calendar, form='datetime').copy()
+    the_lats = np.array(lats[lat_slice])
+    the_lons = np.concatenate([lons[p] for p in lon_slices])
+    var_array = np.ma.concatenate([var_nc[time_slice, lat_slice, p] for p in lon_slices],
+                                  axis=2)
+    return the_times, the_lats, the_lons, var_array
 
-    time_slice = slice(start_index, stop_index)
-    the_times = py_dates[time_slice]
-    var_array = var_nc[time_slice, lat_slice, lon_slice]
-    return data_nc, var_nc, the_times, the_lats, the_lons, var_array
+
+def _lon_columns(lons, west, east):
+    """
+
+    The indices of the longitudes lons which lie in the box from west
+    eastwards to east, ordered from west, so that a box may cross the seam
+    of the longitudes (e.g. from 350 to 10, or 170 to -170 across the
+    dateline). A box 360 degrees or more wide, or whose ends are the same
+    meridian, spans all the longitudes.
+
+    """
+    width = east - west
+    width = 360. if width >= 360. else width % 360. or 360.
+    offset = np.mod(np.asarray(lons, dtype='f8') - west, 360.)
+    columns = np.nonzero(offset <= width)[0]
+    return columns[np.argsort(offset[columns], kind='stable')]
+
+
+def _runs(indices):
+    """Split indices into a list of slices of contiguous indices."""
+    breaks = np.nonzero(np.diff(indices) != 1)[0] + 1
+    return [slice(int(r[0]), int(r[-1]) + 1) for r in np.split(indices, breaks) if len(r)]
+
+
+class Slicer(object):
+    """
+
+    Slice [time,lat,lon] variables from many netcdf files, keeping the files
+    open between calls, and closing them when done. The slices are plain
+    arrays, which do not refer to the open files.
+
+    Parameters
+    ----------
+
+    max_open: optional, int -- the maximum number of files kept open
+
+    Example
+    -------
+
+    with Slicer() as slicer:
+        for in_file in files:
+            the_times, the_lats, the_lons, sst = slicer.get_var_2D(
+                in_file, 'tos', corners=warm_pool, start_date=dt.datetime(2003, 4, 1))
+
+    """
+
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _open(self, file_name):
+        """The open Dataset of file_name and its cache of coordinates,
+        reopened if the file has changed."""
+        mtime = os.path.getmtime(file_name)
+        if file_name in self.files:
+            data_nc, coordinates, opened = self.files[file_name]
+            if opened == mtime:
+                self.files.move_to_end(file_name)
+                return data_nc, coordinates
+            self.files.pop(file_name)[0].close()
+        data_nc = Dataset(file_name)
+        self.files[file_name] = (data_nc, {}, mtime)
+        while len(self.files) > self.max_open:
+            self.files.popitem(last=False)[1][0].close()
+        return data_nc, self.files[file_name][1]
+
+    def get_var_2D(self, file_name, var_name, corners=None, start_date=None, stop_date=None,
+                   time_name='time', lat_name='lat', lon_name='lon'):
+        """
+
+        As the function get_var_2D, but reusing the open file, and returning
+        only the arrays.
+
+        Returns
+        -------
+
+        tuple containing:
+
+        the_times: np.array of datetimes for slice
+        the_lats: 1-D np.array of latitudes for slice
+        the_lons: 1_D np.array of longitudes for slice
+        vararray: 3-D np.array with variable slice
+
+        """
+        # netCDF is not thread safe
+        with self.lock:
+            data_nc, coordinates = self._open(file_name)
+            return _slice(data_nc, var_name, corners, start_date, stop_date, time_name,
+                          lat_name, lon_name, coordinates)
+
+    def close(self):
+        """Close all the open files."""
+        with self.lock:
+            while self.files:
+                self.files.popitem()[1][0].close()
 
 
 def test_get_var_2D():
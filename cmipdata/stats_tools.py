@@ -0,0 +1,458 @@
+"""stats_tools
+======================
+
+The stats_tools module of cmipdata computes statistics across the members
+of an ensemble while the files are read, without loading the whole
+ensemble into memory as loadfiles does. Each file is read in turn, and
+folded into running accumulators, so that memory use is a few times the
+size of one file, whatever the number of files. Percentiles, which cannot
+be accumulated in this way, are computed a tile of time steps or
+latitudes at a time, reading that tile from every file, with the size of
+the tiles set from a memory budget.
+
+Examples
+--------
+
+1. The ensemble mean and standard deviation, giving each model the same
+   weight, as ens_stats::
+
+    stats = cd.ensemble_statistics(ens, 'ts')
+    mean = stats['mean']['data'][0]
+    std = stats['std']['data'][0]
+
+2. The 5th, 50th and 95th percentiles across all realizations::
+
+    p = cd.ensemble_percentiles(ens, 'tasmax', [5, 50, 95])
+    median = p[50]['data'][0]
+
+  .. moduleauthor:: Neil Swart <neil.swart@ec.gc.ca>
+"""
+import os
+import warnings
+import itertools
+import numpy as np
+from . import loading_tools as lt
+
+_STATISTICS = ('mean', 'std', 'min', 'max', 'count')
+
+
+class _Running(object):
+    """Running count, mean, sum of squared deviations (Welford's method),
+    minimum and maximum of each element of a series of masked arrays,
+    leaving out the masked values."""
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype='f8')
+        self.mean = np.zeros(shape, dtype='f8')
+        self.m2 = np.zeros(shape, dtype='f8')
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, var):
+        valid = ~np.ma.getmaskarray(var)
+        x = np.where(valid, np.ma.getdata(var), 0.).astype('f8')
+        np.fmin(self.min, np.where(valid, x, np.inf), out=self.min)
+        np.fmax(self.max, np.where(valid, x, -np.inf), out=self.max)
+        self.count += valid
+        delta = x - self.mean
+        delta *= valid
+        self.mean += delta / np.maximum(self.count, 1.)
+        x -= self.mean
+        x *= delta
+        self.m2 += x
+
+    def result(self, stat, ddof=0):
+        empty = self.count == 0
+        if stat == 'count':
+            return self.count.astype('i8')
+        if stat == 'mean':
+            value = self.mean
+        elif stat == 'std':
+            value = np.sqrt(self.m2 / np.maximum(self.count - ddof, 1.))
+            empty = self.count <= ddof
+        elif stat == 'min':
+            value = self.min
+        else:
+            value = self.max
+        return np.ma.masked_array(value, mask=empty)
+
+
+def ensemble_statistics(ens, varname, stats=('mean', 'std', 'min', 'max'), weighting='model',
+                        ddof=0, toDatetime=False, masked=True, prefetch=2, **kwargs):
+    """
+    Compute statistics across the files of variable varname in ens, for
+    each experiment, reading one file at a time.
+
+    With weighting='model' (the default) the statistics are those of the
+    model means, as in ens_stats: the realizations of each model are first
+    averaged, and each model then has the same weight, whatever its number
+    of realizations. With weighting='realization' every file has the same
+    weight. Missing values are left out.
+
+    Each file is read as by iterfiles, with the next prefetch files read
+    ahead on a background thread, and folded into running accumulators.
+    The mean and standard deviation are updated with Welford's method,
+    which is stable in a single pass. Only the accumulators of each
+    experiment, and of the model being read, are held in memory.
+
+    Parameters
+    ----------
+    ens : cmipdata Ensemble
+          The ensemble of files. As for loadfiles, the variable must have
+          the same shape in all files.
+    varname : str
+              The variable to compute the statistics of.
+    stats : list of str
+            The statistics to compute, from 'mean', 'std', 'min', 'max'
+            and 'count' (the number of members with a value).
+    weighting : str
+                'model' or 'realization', see above.
+    ddof : int
+           The standard deviation is normalized by the number of members
+           minus ddof. Defaults to 0, as cdo ensstd.
+    toDatetime : boolean
+                 Passed to get_dimensions.
+    masked : boolean
+             If False, plain arrays are returned, with NaN where there
+             are no values.
+    prefetch : int
+               The number of files read ahead, as for iterfiles.
+    kwargs : the selection keyword arguments of loadvar (dates, lat, lon,
+             level and stride), or a cdostr or reduce as for loadfiles,
+             applied to each file before the statistics are computed.
+
+    Returns
+    -------
+    A dictionary mapping each statistic to an EnsembleArray, as returned by
+    loadfiles, with one row per experiment. The models of the rows are
+    named 'ENS-MEAN', 'ENS-STD' etc.
+
+    Examples
+    --------
+
+    1. The spread of the global mean annual means across all realizations::
+
+        stats = cd.ensemble_statistics(ens, 'tas', stats=['min', 'max'],
+                                       weighting='realization',
+                                       reduce='-yearmean -fldmean')
+    """
+    stats = [stats] if isinstance(stats, str) else list(stats)
+    for stat in stats:
+        if stat not in _STATISTICS:
+            raise ValueError('unknown statistic ' + str(stat) + ', choose from ' +
+                             ', '.join(_STATISTICS))
+    if weighting not in ('model', 'realization'):
+        raise ValueError("weighting must be 'model' or 'realization'")
+    files = ens.objects('ncfile')
+    if not files:
+        raise ValueError('no files found for ' + varname)
+    models = lt.get_models(files)
+    experiments = lt.get_experiments(files)
+
+    # the last file of each model and experiment, after which the mean of
+    # the model is complete
+    last = {}
+    for i, key in enumerate(zip(experiments, models)):
+        last[key] = i
+
+    accumulators = {}
+    model_means = {}
+    shape = dtype = dimensions = None
+    items = lt.iterfiles(ens, varname, toDatetime=toDatetime, prefetch=prefetch, **kwargs)
+    for i, item in enumerate(items):
+        var = np.ma.asarray(item['data'])
+        if shape is None:
+            shape, dtype = var.shape, np.result_type(var.dtype, np.float32)
+            dimensions = item['dimensions']
+        elif var.shape != shape:
+            raise ValueError('%s has shape %s, expected %s' %
+                             (item['dimensions']['file'], var.shape, shape))
+        experiment = experiments[i]
+        if experiment not in accumulators:
+            accumulators[experiment] = _Running(shape)
+        if weighting == 'realization':
+            accumulators[experiment].update(var)
+            continue
+
+        key = (experiment, models[i])
+        if key not in model_means:
+            model_means[key] = _Running(shape)
+        model_means[key].update(var)
+        if last[key] == i:
+            accumulators[experiment].update(model_means.pop(key).result('mean'))
+
+    names = list(accumulators)
+    results = {}
+    for stat in stats:
+        data = np.ma.stack([accumulators[e].result(stat, ddof) for e in names])
+        if stat != 'count':
+            data = data.astype(dtype)
+            if not masked:
+                data = np.ma.filled(data, np.nan)
+        elif not masked:
+            data = np.ma.getdata(data)
+        stat_dimensions = dict((k, v) for k, v in dimensions.items() if k != 'file')
+        stat_dimensions['models'] = ['ENS-' + stat.upper()] * len(names)
+        stat_dimensions['realizations'] = ['mean' if weighting == 'model' else 'all'] * len(names)
+        stat_dimensions['experiments'] = names
+        results[stat] = lt.EnsembleArray(data, stat_dimensions)
+    return results
+
+
+def ensemble_percentiles(ens, varname, percentiles=(5, 50, 95), weighting='realization',
+                         tile='time', method='exact', bins=100, max_memory=512 * 1024 ** 2,
+                         output_dir=None, toDatetime=False, **kwargs):
+    """
+    Compute percentiles across the files of variable varname in ens, for
+    each experiment, without loading the whole ensemble into memory.
+
+    The data are processed in tiles of time steps (tile='time') or of
+    latitudes (tile='lat'). For each tile, only its hyperslab is read from
+    every file, the percentiles of all its points are computed at once,
+    and written to the output. The size of the tiles is set so that the
+    data held in memory stays within max_memory bytes.
+
+    With method='exact' the tile is read from all files together, and the
+    percentiles are computed exactly, as np.nanpercentile with linear
+    interpolation. With method='histogram', for very large ensembles, the
+    files are read one at a time, twice per tile: once for the range of
+    each point, and then to count the values in bins equal divisions of
+    that range. Memory then depends on bins rather than on the number of
+    files. Each value is known to within its bin, so the percentiles are
+    in error by at most half the range of the point divided by bins.
+
+    Parameters
+    ----------
+    ens : cmipdata Ensemble
+          The ensemble of files. As for loadfiles, the variable must have
+          the same shape in all files.
+    varname : str
+              The variable to compute the percentiles of.
+    percentiles : list of float
+                  The percentiles, between 0 and 100.
+    weighting : str
+                'realization' (the default) for the percentiles across all
+                files, or 'model' for the percentiles across the model
+                means, the realizations of each model being averaged
+                first.
+    tile : str
+           'time' or 'lat', the dimension along which the data is tiled.
+    method : str
+             'exact' or 'histogram', see above.
+    bins : int
+           The number of bins with method='histogram'.
+    max_memory : int
+                 The memory budget in bytes, which sets the size of the
+                 tiles.
+    output_dir : str
+                 If given, the percentiles are written to .npy files in
+                 output_dir, named varname_ENS-P5.npy etc., and returned as
+                 np.memmap views of them, so that they need not fit in
+                 memory either. Points without values are then NaN, rather
+                 than masked.
+    toDatetime : boolean
+                 Passed to get_dimensions.
+    kwargs : the selection keyword arguments of loadvar (dates, lat, lon,
+             level and stride).
+
+    Returns
+    -------
+    A dictionary mapping each percentile to an EnsembleArray, as returned by
+    loadfiles, with one row per experiment. The models of the rows are
+    named 'ENS-P5', 'ENS-P50' etc.
+
+    Examples
+    --------
+
+    1. The 5-95 % envelope of the model means of daily maximum temperature,
+       approximated with 50 bins::
+
+        p = cd.ensemble_percentiles(ens, 'tasmax', [5, 95], weighting='model',
+                                    method='histogram', bins=50,
+                                    output_dir='/scratch/p')
+    """
+    if kwargs.get('cdostr') or kwargs.get('reduce'):
+        raise ValueError('ensemble_percentiles does not support a cdostr or reduce')
+    if weighting not in ('model', 'realization'):
+        raise ValueError("weighting must be 'model' or 'realization'")
+    if tile not in ('time', 'lat'):
+        raise ValueError("tile must be 'time' or 'lat'")
+    if method not in ('exact', 'histogram'):
+        raise ValueError("method must be 'exact' or 'histogram'")
+    percentiles = list(np.atleast_1d(percentiles))
+    for p in percentiles:
+        if not 0 <= p <= 100:
+            raise ValueError('percentiles must be between 0 and 100, not ' + str(p))
+    selection = lt._selection(kwargs)
+    files = ens.objects('ncfile')
+    if not files:
+        raise ValueError('no files found for ' + varname)
+    ifiles = [f.name for f in files]
+    models = lt.get_models(files)
+    experiments = lt.get_experiments(files)
+
+    # the members of each experiment: single files, or the files of a model
+    names = []
+    for e in experiments:
+        if e not in names:
+            names.append(e)
+    order = dict((m, k) for k, m in reversed(list(enumerate(models))))
+    members = {}
+    for e in names:
+        rows = [i for i in range(len(files)) if experiments[i] == e]
+        if weighting == 'model':
+            rows.sort(key=lambda i: order[models[i]])
+            members[e] = [[ifiles[i] for i in group]
+                          for _, group in itertools.groupby(rows, key=lambda i: models[i])]
+        else:
+            members[e] = [[ifiles[i]] for i in rows]
+
+    shape, axis, length = _tiling(ifiles[0], varname, selection, tile)
+    dtype = np.result_type(lt._var_info(ifiles[0], varname)[1], np.float32)
+    slab = int(np.prod(shape)) // max(length, 1)
+    nmembers = max(len(m) for m in members.values())
+    if method == 'exact':
+        # the members, a buffer and the copy made by nanpercentile
+        slab_bytes = (2 * nmembers + 2) * slab * dtype.itemsize
+    else:
+        # the counts, their cumulative sum and the bin of each value
+        slab_bytes = (3 * bins * 8 + 8 * dtype.itemsize) * slab
+    chunk = max(int(max_memory // max(slab_bytes, 1)), 1)
+
+    outputs = {}
+    for p in percentiles:
+        if output_dir:
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+            outputs[p] = np.lib.format.open_memmap(
+                os.path.join(output_dir, '%s_ENS-P%g.npy' % (varname, p)), mode='w+',
+                dtype=dtype, shape=(len(names),) + shape)
+        else:
+            outputs[p] = np.empty((len(names),) + shape, dtype=dtype)
+
+    key = 'steps' if tile == 'time' else 'rows'
+    for j, e in enumerate(names):
+        for a in range(0, max(length, 1), chunk):
+            n = min(chunk, length - a) if axis is not None else 1
+            tile_shape = shape if axis is None else shape[:axis] + (n,) + shape[axis + 1:]
+            tile_selection = dict(selection) if axis is None else dict(selection, **{key: (a, a + n)})
+            if method == 'exact':
+                values = _exact_percentiles(members[e], varname, tile_selection, tile_shape,
+                                            dtype, percentiles)
+            else:
+                values = _histogram_percentiles(members[e], varname, tile_selection,
+                                                tile_shape, dtype, percentiles, bins)
+            index = (j,) if axis is None else (j,) + (slice(None),) * axis + (slice(a, a + n),)
+            for p, value in zip(percentiles, values):
+                outputs[p][index] = value
+
+    dimensions = lt.get_dimensions(ifiles[0], varname, toDatetime=toDatetime, **selection)
+    results = {}
+    for p in percentiles:
+        data = outputs[p]
+        if output_dir:
+            data.flush()
+        else:
+            data = np.ma.masked_invalid(data, copy=False)
+        p_dimensions = dict(dimensions)
+        p_dimensions['models'] = ['ENS-P%g' % p] * len(names)
+        p_dimensions['realizations'] = ['mean' if weighting == 'model' else 'all'] * len(names)
+        p_dimensions['experiments'] = names
+        results[p] = lt.EnsembleArray(data, p_dimensions)
+    return results
+
+
+def _tiling(ifile, varname, selection, tile):
+    """The squeezed shape of the selection of varname in ifile, the axis of
+    the tiled dimension in it (None if it has no such dimension of length
+    more than one) and its length."""
+    with lt._dataset(ifile) as nc:
+        ncvar = nc.variables[varname]
+        index, full = lt._index_shape(nc, ncvar, selection)
+        shape, axis, length = [], None, 1
+        for dimension, n in zip(ncvar.dimensions or ('',), full):
+            if n == 1:
+                continue
+            if lt._dim_kind(nc, dimension) == tile:
+                axis, length = len(shape), n
+            shape.append(n)
+    return tuple(shape), axis, length
+
+
+def _read_member(ifiles, varname, selection, out, buf):
+    """Read the hyperslab selection of varname from ifiles into out, or if
+    there are several files (the realizations of a model), their mean.
+    Missing values are NaN."""
+    lt._read_into(ifiles[0], varname, out, None, selection)
+    if len(ifiles) == 1:
+        return
+    count = (~np.isnan(out)).astype(out.dtype)
+    np.nan_to_num(out, copy=False, nan=0.)
+    for ifile in ifiles[1:]:
+        lt._read_into(ifile, varname, buf, None, selection)
+        valid = ~np.isnan(buf)
+        count += valid
+        out += np.where(valid, buf, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out /= count
+
+
+def _exact_percentiles(members, varname, selection, shape, dtype, percentiles):
+    stack = np.empty((len(members),) + shape, dtype=dtype)
+    buf = np.empty(shape, dtype=dtype)
+    for k, ifiles in enumerate(members):
+        _read_member(ifiles, varname, selection, stack[k], buf)
+    with warnings.catch_warnings():
+        # points with no values give NaN, with a warning
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(stack, percentiles, axis=0, overwrite_input=True)
+
+
+def _histogram_percentiles(members, varname, selection, shape, dtype, percentiles, bins):
+    size = int(np.prod(shape))
+    member = np.empty(shape, dtype=dtype)
+    buf = np.empty(shape, dtype=dtype)
+
+    # the first pass finds the range of each point
+    low = np.full(shape, np.inf)
+    high = np.full(shape, -np.inf)
+    for ifiles in members:
+        _read_member(ifiles, varname, selection, member, buf)
+        np.fmin(low, member, out=low)
+        np.fmax(high, member, out=high)
+    with np.errstate(invalid='ignore'):
+        width = (high - low) / bins
+
+    # the second counts the values in each bin
+    counts = np.zeros((bins, size), dtype='i8')
+    points = np.arange(size)
+    scale = np.where(width > 0, width, 1.).ravel()
+    for ifiles in members:
+        _read_member(ifiles, varname, selection, member, buf)
+        x = member.ravel()
+        valid = ~np.isnan(x)
+        b = np.clip(((x[valid] - low.ravel()[valid]) / scale[valid]).astype('i8'), 0, bins - 1)
+        counts += np.bincount(b * size + points[valid], minlength=bins * size).reshape(bins, size)
+
+    # the percentiles, interpolated linearly between the order statistics
+    # as in np.percentile, each order statistic being taken as the middle
+    # of the bin holding it
+    total = counts.sum(axis=0)
+    cumulative = np.cumsum(counts, axis=0)
+    low, width = low.ravel(), width.ravel()
+
+    def order_statistic(rank):
+        k = np.argmax(cumulative > rank, axis=0)
+        return low + (k + 0.5) * width
+
+    results = []
+    with np.errstate(invalid='ignore'):
+        for p in percentiles:
+            h = p / 100. * np.maximum(total - 1, 0)
+            rank = np.floor(h)
+            fraction = h - rank
+            value = ((1 - fraction) * order_statistic(rank) +
+                     fraction * order_statistic(np.minimum(rank + 1, np.maximum(total - 1, 0))))
+            value[total == 0] = np.nan
+            results.append(value.reshape(shape))
+    return results
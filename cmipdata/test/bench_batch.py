@@ -0,0 +1,66 @@
+"""
+Benchmark of per-file versus batched cdo processing on many small files.
+
+Creates nfiles small global-mean-sized netCDF files in directory, and times
+cd.areamean over them, first with one process per file and then with the
+commands batched to persistent shell workers. Requires cdo and netCDF4.
+
+    python bench_batch.py /tmp/bench 10000
+
+"""
+import os
+import sys
+import time
+import shutil
+import numpy as np
+from netCDF4 import Dataset
+import cmipdata as cd
+
+
+def make_files(directory, nfiles):
+    """ Write nfiles small monthly files, with 12 time steps on a 4x8 grid."""
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    os.chdir(directory)
+    for i in range(nfiles):
+        name = 'ts_Amon_MODEL%d_historical_r%di1p1_200001-200012.nc' % (i // 10, i % 10 + 1)
+        nc = Dataset(name, 'w')
+        nc.createDimension('time', None)
+        nc.createDimension('lat', 4)
+        nc.createDimension('lon', 8)
+        t = nc.createVariable('time', 'f8', ('time',))
+        t.units = 'days since 2000-01-01'
+        t.calendar = '365_day'
+        t[:] = np.arange(12) * 30 + 15
+        lat = nc.createVariable('lat', 'f8', ('lat',))
+        lat.units = 'degrees_north'
+        lat[:] = [-67.5, -22.5, 22.5, 67.5]
+        lon = nc.createVariable('lon', 'f8', ('lon',))
+        lon.units = 'degrees_east'
+        lon[:] = np.arange(8) * 45.
+        v = nc.createVariable('ts', 'f4', ('time', 'lat', 'lon'))
+        v[:] = np.random.rand(12, 4, 8)
+        nc.close()
+
+
+def bench(nfiles, batch_size, workers):
+    ens = cd.mkensemble('ts_*.nc')
+    t0 = time.time()
+    out = cd.areamean(ens, delete=False, output_prefix='b%d_' % batch_size,
+                      batch_size=batch_size, workers=workers)
+    elapsed = time.time() - t0
+    nout = len(out.objects('ncfile'))
+    print('batch_size=%5d workers=%2d: %8.2f s for %d files (%6.2f ms/file), %d outputs' %
+          (batch_size, workers, elapsed, nfiles, 1e3 * elapsed / nfiles, nout))
+    return elapsed
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else '/tmp/cmipdata_bench'
+    nfiles = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    make_files(directory, nfiles)
+    serial = bench(nfiles, 1, 1)
+    batched = bench(nfiles, 500, 1)
+    parallel = bench(nfiles, 500, os.cpu_count() or 1)
+    print('speedup batched: %.2fx, batched and parallel: %.2fx' %
+          (serial / batched, serial / parallel))
@@ -0,0 +1,71 @@
+"""
+Benchmark of loadfiles with a thread pool versus a process pool.
+
+Creates nfiles compressed netCDF files in directory and times loadfiles
+over them, serially and with workers threads or processes, both for plain
+reads and with a cdostr. netCDF4 is not thread safe, so the threads take
+turns to read, and only the cdo subprocesses of a cdostr overlap. Requires
+cdo and netCDF4.
+
+    python bench_loadfiles.py /tmp/bench 48 4
+
+"""
+import os
+import sys
+import time
+import shutil
+import numpy as np
+from netCDF4 import Dataset
+import cmipdata as cd
+
+
+def make_files(directory, nfiles):
+    """ Write nfiles compressed monthly files, with 120 time steps on a 96x192 grid."""
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    os.chdir(directory)
+    for i in range(nfiles):
+        name = 'ts_Amon_MODEL%d_historical_r%di1p1_200001-200912.nc' % (i // 4, i % 4 + 1)
+        nc = Dataset(name, 'w')
+        nc.createDimension('time', None)
+        nc.createDimension('lat', 96)
+        nc.createDimension('lon', 192)
+        t = nc.createVariable('time', 'f8', ('time',))
+        t.units = 'days since 2000-01-01'
+        t.calendar = '365_day'
+        t[:] = np.arange(120) * 30 + 15
+        lat = nc.createVariable('lat', 'f8', ('lat',))
+        lat.units = 'degrees_north'
+        lat[:] = np.linspace(-89, 89, 96)
+        lon = nc.createVariable('lon', 'f8', ('lon',))
+        lon.units = 'degrees_east'
+        lon[:] = np.arange(192) * 1.875
+        v = nc.createVariable('ts', 'f4', ('time', 'lat', 'lon'), zlib=True)
+        v[:] = np.random.rand(120, 96, 192)
+        nc.close()
+
+
+def bench(nfiles, workers, parallel, **kwargs):
+    """ The best of three timings, after a first call warming the caches."""
+    ens = cd.mkensemble('ts_*.nc')
+    times = []
+    for i in range(4):
+        t0 = time.time()
+        cd.loadfiles(ens, 'ts', workers=workers, parallel=parallel, **kwargs)
+        times.append(time.time() - t0)
+    elapsed = min(times[1:])
+    print('%-8s workers=%2d %-16s: %8.2f s for %d files' %
+          (parallel, workers, kwargs.get('cdostr', 'plain read'), elapsed, nfiles))
+    return elapsed
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else '/tmp/cmipdata_bench'
+    nfiles = int(sys.argv[2]) if len(sys.argv) > 2 else 48
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count() or 1
+    make_files(directory, nfiles)
+    for kwargs in ({}, {'cdostr': 'cdo -fldmean'}):
+        serial = bench(nfiles, 1, 'process', **kwargs)
+        thread = bench(nfiles, workers, 'thread', **kwargs)
+        process = bench(nfiles, workers, 'process', **kwargs)
+        print('speedup threads: %.2fx, processes: %.2fx' % (serial / thread, serial / process))
@@ -0,0 +1,91 @@
+"""
+Tests of async_tools on small netCDF files written on the fly.
+
+    python -m pytest test_async_tools.py
+
+"""
+import asyncio
+import shutil
+import sys
+import numpy as np
+import pytest
+
+lt = pytest.importorskip('cmipdata.loading_tools')
+at = pytest.importorskip('cmipdata.async_tools')
+import cmipdata as cd
+from test_loading_tools import make_file, assert_same
+
+
+@pytest.fixture
+def ensemble(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for i, model in enumerate('ABCDEFGH'):
+        for experiment in ('historical', 'rcp45'):
+            make_file('ts_Amon_%s_%s_r1i1p1_185001-185112.nc' % (model, experiment), seed=i)
+    yield cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    lt.close_files()
+
+
+@pytest.mark.parametrize('masked', [True, False])
+def test_aloadfiles(ensemble, masked):
+    expected = lt.loadfiles(ensemble, 'ts', masked=masked)
+    result = asyncio.run(at.aloadfiles(ensemble, 'ts', masked=masked, max_concurrent=8))
+    assert isinstance(result, lt.EnsembleArray)
+    assert result['data'].dtype == expected['data'].dtype == np.float32
+    if masked:
+        assert_same(result['data'], expected['data'])
+    else:
+        np.testing.assert_array_equal(result['data'], expected['data'])
+    for key in ('models', 'realizations', 'experiments'):
+        assert result['dimensions'][key] == expected['dimensions'][key]
+    np.testing.assert_array_equal(result['dimensions']['time'],
+                                  expected['dimensions']['time'])
+
+
+def test_aloadfiles_dtype(ensemble):
+    result = asyncio.run(at.aloadfiles(ensemble, 'ts', dtype='f8'))
+    assert result['data'].dtype == np.float64
+
+
+@pytest.mark.skipif(shutil.which('cdo') is None, reason='needs cdo')
+def test_aloadfiles_cdostr(ensemble):
+    expected = lt.loadfiles(ensemble, 'ts')
+    result = asyncio.run(at.aloadfiles(ensemble, 'ts', cdostr='-copy', max_concurrent=8))
+    assert_same(result['data'], expected['data'])
+
+
+def test_run_cdo_profile():
+    prof = pytest.importorskip('cmipdata.profiling')
+    prof.clear_profile()
+    prof.enable_profiling()
+    try:
+        # a command which burns CPU in a child, while the loop idles
+        busy = 'cdo -O -f nc -remapdis,r360x180 in.nc out.nc 2>/dev/null; ' \
+               '%s -c "sum(range(3 * 10 ** 7))"' % sys.executable
+
+        async def main():
+            return await asyncio.gather(at.run_cdo(busy), asyncio.sleep(0.1))
+
+        ex = asyncio.run(main())[0]
+    finally:
+        prof.disable_profiling()
+    rec = prof.profile_records()[-1]
+    prof.clear_profile()
+    assert ex == 0
+    assert rec['name'] == 'remapdis'
+    assert rec['cpu_time'] > 0.2
+    assert rec['peak_rss'] > 0
+
+
+def test_run_cdo_status(tmp_path):
+    outfile = str(tmp_path / 'out.nc')
+    open(outfile, 'w').close()
+    prof = pytest.importorskip('cmipdata.profiling')
+    prof.enable_profiling()
+    try:
+        ex = asyncio.run(at.run_cdo('exit 3', [outfile]))
+    finally:
+        prof.disable_profiling()
+        prof.clear_profile()
+    assert ex == 3
+    assert not (tmp_path / 'out.nc').exists()
@@ -0,0 +1,58 @@
+"""
+Tests of derived_tools on small netCDF files written on the fly.
+
+    python -m pytest test_derived_tools.py
+
+"""
+import numpy as np
+import pytest
+
+lt = pytest.importorskip('cmipdata.loading_tools')
+dt = pytest.importorskip('cmipdata.derived_tools')
+import cmipdata as cd
+from test_loading_tools import make_file
+
+
+def test_derive_360_day(tmp_path, monkeypatch):
+    # daily data on a 360_day calendar, which has 29 and 30 February; vas is
+    # split over two files
+    monkeypatch.chdir(tmp_path)
+    make_file('uas_day_A_historical_r1i1p1_18500101-18500330.nc', var='uas', nt=90,
+              calendar='360_day', t0=-15, step=1, seed=1)
+    make_file('vas_day_A_historical_r1i1p1_18500101-18500214.nc', var='vas', nt=45,
+              calendar='360_day', t0=-15, step=1, seed=2)
+    make_file('vas_day_A_historical_r1i1p1_18500215-18500330.nc', var='vas', nt=45,
+              calendar='360_day', t0=30, step=1, seed=3)
+    uas = cd.mkensemble('uas_*', prefix=str(tmp_path) + '/')
+    vas = cd.mkensemble('vas_*', prefix=str(tmp_path) + '/')
+    ens = dt.derive({'uas': uas, 'vas': vas}, 'vas - uas', 'dif', output_prefix='out_')
+
+    outfile = ens.objects('ncfile')[0].name
+    result = lt.loadvar(outfile, 'dif')
+    u = lt.loadvar('uas_day_A_historical_r1i1p1_18500101-18500330.nc', 'uas')
+    v = np.ma.concatenate([lt.loadvar('vas_day_A_historical_r1i1p1_18500101-18500214.nc', 'vas'),
+                           lt.loadvar('vas_day_A_historical_r1i1p1_18500215-18500330.nc', 'vas')])
+    assert result.shape == (90, 6, 8)
+    np.testing.assert_allclose(result, v - u, rtol=1e-6)
+    lt.close_files()
+
+
+@pytest.mark.parametrize('dtype', ['f4', 'f8'])
+def test_derive_dtype(tmp_path, monkeypatch, capsys, dtype):
+    monkeypatch.chdir(tmp_path)
+    for i, var in enumerate(('uas', 'vas')):
+        make_file('%s_Amon_A_historical_r1i1p1_185001-185112.nc' % var, var=var, seed=i,
+                  dtype=dtype)
+    uas = cd.mkensemble('uas_*', prefix=str(tmp_path) + '/')
+    vas = cd.mkensemble('vas_*', prefix=str(tmp_path) + '/')
+    capsys.readouterr()
+    ens = dt.derive({'uas': uas, 'vas': vas}, 'hypot(uas, vas)', 'speed')
+    assert capsys.readouterr().out == ''
+    outfile = ens.objects('ncfile')[0].name
+    u = lt.loadvar('uas_Amon_A_historical_r1i1p1_185001-185112.nc', 'uas')
+    v = lt.loadvar('vas_Amon_A_historical_r1i1p1_185001-185112.nc', 'vas')
+    result = lt.loadvar(outfile, 'speed')
+    assert result.dtype == np.dtype(dtype)
+    assert result.mask[:, 0, 0].all() and result.mask.sum() == 24
+    np.testing.assert_array_equal(result, np.ma.hypot(u, v).astype(dtype))
+    lt.close_files()
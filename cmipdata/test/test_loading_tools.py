@@ -0,0 +1,553 @@
+"""
+Tests of loading_tools on small netCDF files written on the fly.
+
+    python -m pytest test_loading_tools.py
+
+"""
+import os
+import pickle
+import shutil
+import subprocess
+import time
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+lt = pytest.importorskip('cmipdata.loading_tools')
+import cmipdata as cd
+
+
+def make_file(name, var='ts', nt=24, lat=None, lon=None, calendar='365_day', seed=0,
+              t0=0, step=30, dtype='f4', levels=None):
+    """ Write a monthly [time, lat, lon] file (or [time, plev, lat, lon] if
+    levels are given), with one missing point."""
+    lat = np.linspace(-75, 75, 6) if lat is None else np.asarray(lat, dtype='f8')
+    lon = np.arange(8) * 45. if lon is None else np.asarray(lon, dtype='f8')
+    nc = Dataset(name, 'w')
+    nc.createDimension('time', None)
+    dims = ('time', 'lat', 'lon')
+    if levels is not None:
+        nc.createDimension('plev', len(levels))
+        plev = nc.createVariable('plev', 'f8', ('plev',))
+        plev.units = 'hPa'
+        plev[:] = levels
+        dims = ('time', 'plev', 'lat', 'lon')
+    nc.createDimension('lat', len(lat))
+    nc.createDimension('lon', len(lon))
+    t = nc.createVariable('time', 'f8', ('time',))
+    t.units = 'days since 1850-01-01'
+    t.calendar = calendar
+    t[:] = t0 + np.arange(nt) * step + 15
+    la = nc.createVariable('lat', 'f8', ('lat',))
+    la.units = 'degrees_north'
+    la[:] = lat
+    lo = nc.createVariable('lon', 'f8', ('lon',))
+    lo.units = 'degrees_east'
+    lo[:] = lon
+    v = nc.createVariable(var, dtype, dims, fill_value=1e20)
+    shape = (nt,) + ((len(levels),) if levels is not None else ()) + (len(lat), len(lon))
+    data = np.ma.masked_array(np.random.RandomState(seed).rand(*shape))
+    data[..., 0, 0] = np.ma.masked
+    v[:] = data
+    nc.close()
+
+
+def has_cdo():
+    """ True if a cdo binary which runs is on the PATH."""
+    if shutil.which('cdo') is None:
+        return False
+    return subprocess.call(['cdo', '-V'], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) == 0
+
+
+@pytest.fixture
+def ensemble(tmp_path, monkeypatch):
+    """ 24 files: 4 models, 2 experiments and 3 realizations."""
+    monkeypatch.chdir(tmp_path)
+    seed = 0
+    for model in ('A', 'B', 'C', 'D'):
+        for experiment in ('historical', 'rcp45'):
+            for r in (1, 2, 3):
+                make_file('ts_Amon_%s_%s_r%di1p1_185001-185112.nc' % (model, experiment, r),
+                          seed=seed)
+                seed += 1
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    yield ens
+    lt.close_files()
+
+
+def assert_same(a, b):
+    np.testing.assert_array_equal(np.ma.getmaskarray(a), np.ma.getmaskarray(b))
+    np.testing.assert_array_equal(np.ma.filled(a, 0), np.ma.filled(b, 0))
+
+
+@pytest.mark.parametrize('parallel', ['thread', 'process'])
+def test_loadfiles_workers(ensemble, parallel):
+    serial = lt.loadfiles(ensemble, 'ts')
+    for repeat in range(5):
+        lt.close_files()
+        concurrent = lt.loadfiles(ensemble, 'ts', workers=8, parallel=parallel)
+        assert_same(concurrent['data'], serial['data'])
+
+
+def test_loadfiles_align_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for i, model in enumerate('ABCDEFGH'):
+        # the files start 0 to 7 months apart
+        make_file('ts_Amon_%s_historical_r1i1p1_185001-185112.nc' % model, seed=i,
+                  t0=30 * i)
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    for align, masked in (('union', True), ('union', False), ('intersection', True)):
+        serial = lt.loadfiles(ens, 'ts', align=align, masked=masked)
+        for repeat in range(3):
+            lt.close_files()
+            concurrent = lt.loadfiles(ens, 'ts', align=align, masked=masked, workers=8)
+            assert_same(concurrent['data'], serial['data'])
+    lt.close_files()
+
+
+@pytest.mark.parametrize('align', ['union', 'intersection'])
+def test_loadfiles_align_shape(tmp_path, monkeypatch, align):
+    monkeypatch.chdir(tmp_path)
+    make_file('ts_Amon_A_historical_r1i1p1_185001-185112.nc')
+    # a different grid, whose dates do not overlap those of the first file
+    make_file('ts_Amon_B_historical_r1i1p1_190001-190112.nc', lat=np.linspace(-75, 75, 12),
+              t0=365 * 50)
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    with pytest.raises(ValueError, match='ts_Amon_B_historical_r1i1p1_190001-190112.nc'):
+        lt.loadfiles(ens, 'ts', align=align)
+    lt.close_files()
+def test_loadvariables_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for i, model in enumerate('ABCDEFGH'):
+        for j, var in enumerate(('uas', 'vas')):
+            make_file('%s_Amon_%s_historical_r1i1p1_185001-185112.nc' % (var, model),
+                      var=var, seed=2 * i + j)
+    ens = cd.mkensemble('*_Amon_*', prefix=str(tmp_path) + '/')
+    for masked in (True, False):
+        serial = lt.loadvariables(ens, ['uas', 'vas'], masked=masked)
+        for repeat in range(3):
+            lt.close_files()
+            concurrent = lt.loadvariables(ens, ['uas', 'vas'], masked=masked, workers=8)
+            for var in ('uas', 'vas'):
+                assert_same(concurrent[var]['data'], serial[var]['data'])
+    lt.close_files()
+
+
+def test_loadregions_workers(ensemble):
+    regions = {'box': {'lat': (-50, 50), 'lon': (40, 200)},
+               'mask': np.arange(48).reshape(6, 8) % 3 == 0}
+    for mean in (True, False):
+        serial = lt.loadregions(ensemble, 'ts', regions, mean=mean)
+        for repeat in range(3):
+            lt.close_files()
+            concurrent = lt.loadregions(ensemble, 'ts', regions, mean=mean, workers=8)
+            for name in regions:
+                assert_same(concurrent[name]['data'], serial[name]['data'])
+
+
+def test_loadregions_workers_shape(ensemble, tmp_path):
+    # the shape check of a forked worker reaches the caller
+    name = 'ts_Amon_D_rcp45_r3i1p1_185001-185112.nc'
+    make_file(name, lat=np.linspace(-75, 75, 12))
+    regions = {'box': {'lat': (-50, 50), 'lon': (40, 200)}}
+    with pytest.raises(ValueError, match=name):
+        lt.loadregions(ensemble, 'ts', regions, mean=False, workers=4)
+
+
+def test_loadpoints_workers(ensemble):
+    lats = [-60., -10., 0., 33.3, 70.]
+    lons = [10., 100., 181., 290., 359.]
+    for method in ('nearest', 'idw'):
+        serial = lt.loadpoints(ensemble, 'ts', lats, lons, method=method)
+        for repeat in range(3):
+            lt.close_files()
+            concurrent = lt.loadpoints(ensemble, 'ts', lats, lons, method=method, workers=8)
+            assert_same(concurrent['data'], serial['data'])
+
+
+def test_loadpoints_workers_shape(ensemble):
+    name = 'ts_Amon_C_historical_r2i1p1_185001-185112.nc'
+    make_file(name, nt=12)
+    with pytest.raises(ValueError, match=name):
+        lt.loadpoints(ensemble, 'ts', [0.], [100.], workers=4)
+
+
+def test_read_into_shape_mismatch(tmp_path):
+    name = str(tmp_path / 'ts.nc')
+    make_file(name, nt=2, lat=np.linspace(-75, 75, 8), lon=np.arange(6) * 60.)
+    out = np.empty((2, 6, 8), dtype='f4')
+    with pytest.raises(ValueError):
+        lt._read_into(name, 'ts', out, np.zeros(out.shape, dtype=bool))
+    # unit axes may be dropped or added
+    out = np.empty((2, 1, 8, 6), dtype='f4')
+    lt._read_into(name, 'ts', out)
+    data = lt.loadvar(name, 'ts')
+    np.testing.assert_array_equal(out[:, 0], np.ma.filled(data.astype('f4'), np.nan))
+    lt.close_files()
+
+
+def test_coordinate_same_endpoints(tmp_path):
+    # two latitude grids with the same length and end points
+    regular = np.linspace(-75, 75, 6)
+    gaussian = np.array([-75., -40., -8., 8., 40., 75.])
+    make_file(str(tmp_path / 'a.nc'), lat=regular)
+    make_file(str(tmp_path / 'b.nc'), lat=gaussian)
+    make_file(str(tmp_path / 'c.nc'), lat=regular)
+    lats = [lt.get_dimensions(str(tmp_path / f), 'ts')['lat'] for f in ('a.nc', 'b.nc', 'c.nc')]
+    np.testing.assert_array_equal(lats[0], regular)
+    np.testing.assert_array_equal(lats[1], gaussian)
+    np.testing.assert_array_equal(lats[2], regular)
+    lt.close_files()
+
+
+def test_model_mean_by_experiment():
+    data = np.arange(6, dtype='f4')[:, None] * np.ones((1, 3), dtype='f4')
+    dimensions = {'models': ['A', 'B', 'A', 'A', 'B', 'A'],
+                  'experiments': ['rcp45', 'rcp45', 'rcp45', 'historical', 'historical',
+                                  'historical'],
+                  'realizations': ['r1', 'r1', 'r2', 'r1', 'r1', 'r2']}
+    means = lt.EnsembleArray(data, dimensions).model_mean()
+    assert means['dimensions']['models'] == ['A', 'B', 'A', 'B']
+    assert means['dimensions']['experiments'] == ['rcp45', 'rcp45', 'historical', 'historical']
+    np.testing.assert_array_equal(means['data'][:, 0], [1, 1, 4, 4])
+    # without experiments, the models are grouped by name alone
+    del dimensions['experiments']
+    means = lt.EnsembleArray(data, dimensions).model_mean()
+    assert means['dimensions']['models'] == ['A', 'B']
+    np.testing.assert_array_equal(means['data'][:, 0], [2.5, 2.5])
+
+
+def test_loadpoints_idw_on_missing_point(tmp_path, monkeypatch):
+    # the grid point at (-75, 0) is missing
+    monkeypatch.chdir(tmp_path)
+    make_file('ts_Amon_A_historical_r1i1p1_185001-185112.nc')
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    grid = lt.loadvar('ts_Amon_A_historical_r1i1p1_185001-185112.nc', 'ts')
+    points = lt.loadpoints(ens, 'ts', [-75., -45.], [0., 90.], method='idw', k=3)['data'][0]
+    # a station on a missing point takes the mean of its valid neighbours,
+    # here the equally distant points at 45 and 315 degrees
+    assert not np.ma.is_masked(points[:, 0])
+    np.testing.assert_allclose(points[:, 0], (grid[:, 0, 1] + grid[:, 0, 7]) / 2., rtol=1e-5)
+    # and a station on a valid point takes its value
+    np.testing.assert_allclose(points[:, 1], grid[:, 1, 2], rtol=1e-6)
+    lt.close_files()
+
+
+def cache_entries(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if not name.startswith('.'))
+
+
+def test_loadfiles_cache_dir(ensemble, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    first = lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir)
+    cached = lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir)
+    assert isinstance(np.ma.getdata(cached['data']), np.memmap)
+    assert_same(cached['data'], first['data'])
+    assert len(cache_entries(cache_dir)) == 1
+    with pytest.raises(ValueError):
+        lt.loadfiles(ensemble, 'ts', lazy=True, cache_dir=cache_dir)
+
+
+def test_loadfiles_cache_invalidation(ensemble, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir)
+
+    # a selection or a cdostr is another entry
+    box = lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir, lat=(-50, 50))
+    assert box['data'].shape == (24, 24, 4, 8)
+    assert len(cache_entries(cache_dir)) == 2
+    if shutil.which('cdo') is not None:
+        lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir, cdostr='-copy')
+        assert len(cache_entries(cache_dir)) == 3
+
+    # a file rewritten with new data (and so a new modification time)
+    name = ensemble.objects('ncfile')[0].name
+    lt.close_files()
+    make_file(name, seed=1000)
+    os.utime(name, (time.time() + 10, time.time() + 10))
+    reloaded = lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir)
+    assert_same(reloaded['data'][0], lt.loadvar(name, 'ts'))
+
+
+@pytest.mark.parametrize('damage', ['truncate data', 'corrupt dimensions', 'remove data',
+                                    'truncate mask', 'wrong dimensions', 'wrong mask'])
+def test_loadfiles_cache_damaged(ensemble, tmp_path, damage):
+    cache_dir = str(tmp_path / 'cache')
+    first = lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir)
+    entry = os.path.join(cache_dir, cache_entries(cache_dir)[0])
+    if damage == 'truncate data':
+        os.truncate(os.path.join(entry, 'data.npy'), 200)
+    elif damage == 'truncate mask':
+        os.truncate(os.path.join(entry, 'mask.npy'), 100)
+    elif damage == 'corrupt dimensions':
+        with open(os.path.join(entry, 'dimensions.pkl'), 'wb') as f:
+            f.write(b'\x80\x05garbage')
+    elif damage == 'wrong dimensions':
+        with open(os.path.join(entry, 'dimensions.pkl'), 'wb') as f:
+            pickle.dump(['time', 'lat'], f)
+    elif damage == 'wrong mask':
+        np.save(os.path.join(entry, 'mask.npy'), np.zeros(3, dtype=bool))
+    else:
+        os.remove(os.path.join(entry, 'data.npy'))
+    again = lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir)
+    assert_same(again['data'], first['data'])
+    # and the entry is stored again
+    assert_same(lt.loadfiles(ensemble, 'ts', cache_dir=cache_dir)['data'], first['data'])
+
+
+@pytest.mark.parametrize('lon, expected', [((0, 360), [0, 45, 90, 135, 180, 225, 270, 315]),
+                                           ((-180, 180), [180, 225, 270, 315, 0, 45, 90, 135]),
+                                           ((-180, 540), [180, 225, 270, 315, 0, 45, 90, 135]),
+                                           ((170, -100), [180, 225]),
+                                           ((-50, 50), [315, 0, 45])])
+def test_loadvar_lon_boxes(tmp_path, lon, expected):
+    name = str(tmp_path / 'ts.nc')
+    make_file(name, nt=2)
+    full = lt.loadvar(name, 'ts')
+    box = lt.loadvar(name, 'ts', lon=lon)
+    assert list(lt.get_dimensions(name, 'ts', lon=lon)['lon']) == expected
+    assert_same(box, full[..., [c // 45 for c in expected]])
+    lt.close_files()
+
+
+@pytest.mark.parametrize('masked', [True, False])
+def test_group_mean_missing(tmp_path, monkeypatch, masked):
+    # model A has members 2 and 4, the second missing at one point; model B is 6
+    from netCDF4 import Dataset
+    monkeypatch.chdir(tmp_path)
+    for model, r, value in (('A', 1, 2.), ('A', 2, 4.), ('B', 1, 6.)):
+        name = 'ts_Amon_%s_historical_r%di1p1_185001-185112.nc' % (model, r)
+        make_file(name, nt=2)
+        nc = Dataset(name, 'a')
+        data = np.ma.masked_array(np.full((2, 6, 8), value))
+        data[:, 0, 0] = np.ma.masked
+        if r == 2:
+            data[:, 1, 1] = np.ma.masked
+        nc.variables['ts'][:] = data
+        nc.close()
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    d = lt.loadfiles(ens, 'ts', masked=masked)
+    means = d.model_mean()['data']
+    assert np.ma.isMaskedArray(means) == masked
+    means = np.ma.filled(means, np.nan)
+    np.testing.assert_array_equal(means[:, 0, 0, 0], [np.nan, np.nan])
+    np.testing.assert_array_equal(means[:, 0, 1, 1], [2., 6.])
+    np.testing.assert_array_equal(means[:, 0, 2, 2], [3., 6.])
+
+    for weighting, expected in (('model', (4., 4.5)), ('realization', (4., 4.))):
+        mean = d.ensemble_mean(weighting=weighting)
+        assert np.ma.isMaskedArray(mean) == masked
+        mean = np.ma.filled(mean, np.nan)
+        assert np.isnan(mean[0, 0, 0])
+        np.testing.assert_allclose([mean[0, 1, 1], mean[0, 2, 2]], expected)
+    lt.close_files()
+
+
+def _data_dimensions(d):
+    return dict((k, v) for k, v in d['dimensions'].items()
+                if k not in ('models', 'realizations', 'experiments'))
+
+
+@pytest.mark.skipif(not has_cdo(), reason='needs cdo')
+@pytest.mark.parametrize('cdostr', ['-timmean', '-yearmean', '-seasmean', '-monmean',
+                                    '-zonmean', '-fldmean', '-selyear,1851', '-selmon,1,2,3',
+                                    '-seldate,1850-03-01,1851-02-28', '-yearmean -fldmean',
+                                    '-timmean -selvar,ts'])
+def test_infer_dimensions_matches_cdo(tmp_path, cdostr):
+    name = str(tmp_path / 'ts.nc')
+    make_file(name)
+    inferred = lt._infer_dimensions(name, 'ts', cdostr)
+    dimensions, data = lt._materialize(name, 'ts', cdostr)
+    assert inferred is not None
+    assert list(inferred) == list(dimensions)
+    for k in dimensions:
+        assert len(inferred[k]) == len(dimensions[k]), k
+    assert lt._dimensions_shape(inferred) == tuple(n for n in data.shape if n != 1)
+    lt.close_files()
+
+
+@pytest.mark.skipif(shutil.which('cdo') is None, reason='needs cdo')
+@pytest.mark.parametrize('cdostr', ['-timmean', '-fldmean', '-selyear,1851', '-selvar,ts'])
+def test_loadfiles_cdostr_dimensions(ensemble, cdostr):
+    d = lt.loadfiles(ensemble, 'ts', cdostr=cdostr)
+    assert lt._dimensions_shape(_data_dimensions(d)) == \
+        tuple(n for n in d['data'].shape[1:] if n != 1)
+
+
+@pytest.mark.skipif(shutil.which('cdo') is None, reason='needs cdo')
+def test_loadfiles_cdostr_wrong_inference(ensemble, monkeypatch):
+    # dimensions inferred wrongly are caught by the shape of the first file
+    infer = lt._infer_dimensions
+
+    def wrong(*args, **kwargs):
+        dimensions = infer(*args, **kwargs)
+        dimensions['time'] = dimensions['time'][:3]
+        return dimensions
+
+    monkeypatch.setattr(lt, '_infer_dimensions', wrong)
+    d = lt.loadfiles(ensemble, 'ts', cdostr='-selvar,ts')
+    assert len(d['dimensions']['time']) == d['data'].shape[1] == 24
+    expected = lt.loadfiles(ensemble, 'ts')
+    assert_same(d['data'], expected['data'])
+
+
+# selections of the default file, and the numpy index of each: the time
+# steps are at days 15, 45, ..., the latitudes -75 to 75 by 30 and the
+# longitudes 0 to 315 by 45
+SELECTIONS = [({'dates': ('1850-03-01', '1850-12-31')}, np.s_[2:12]),
+              ({'lat': (-30, 45)}, np.s_[:, 2:5]),
+              ({'lon': (90, 225)}, np.s_[:, :, 2:6]),
+              ({'stride': {'time': 5}}, np.s_[::5]),
+              ({'dates': ('1850-03-01', '1850-12-31'), 'lat': (-30, 45), 'lon': (90, 225),
+                'stride': {'time': 2, 'lat': 2}}, np.s_[2:12:2, 2:5:2, 2:6])]
+
+
+@pytest.mark.parametrize('selection, index', SELECTIONS)
+def test_loadvar_selection(tmp_path, selection, index):
+    name = str(tmp_path / 'ts.nc')
+    make_file(name)
+    full = lt.loadvar(name, 'ts')
+    assert_same(lt.loadvar(name, 'ts', **selection), full[index])
+    index = index if isinstance(index, tuple) else (index,)
+    index += (slice(None),) * (3 - len(index))
+    dimensions = lt.get_dimensions(name, 'ts', **selection)
+    full_dimensions = lt.get_dimensions(name, 'ts')
+    for key, idx in zip(('time', 'lat', 'lon'), index):
+        np.testing.assert_array_equal(dimensions[key], full_dimensions[key][idx])
+    lt.close_files()
+
+
+@pytest.mark.parametrize('selection, index', [({'level': [850., 260.]}, np.s_[:, [1, 3]]),
+                                              ({'stride': {'level': 2}}, np.s_[:, ::2]),
+                                              ({'level': [500.], 'lat': (-30, 45)},
+                                               np.s_[:, 2, 2:5])])
+def test_loadvar_level_selection(tmp_path, selection, index):
+    name = str(tmp_path / 'ta.nc')
+    make_file(name, var='ta', levels=[1000., 850., 500., 250.])
+    full = lt.loadvar(name, 'ta')
+    assert_same(lt.loadvar(name, 'ta', **selection), full[index])
+    lt.close_files()
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+@pytest.mark.parametrize('selection, index', SELECTIONS)
+def test_loadfiles_selection(ensemble, selection, index, workers):
+    full = lt.loadfiles(ensemble, 'ts')
+    index = index if isinstance(index, tuple) else (index,)
+    d = lt.loadfiles(ensemble, 'ts', workers=workers, **selection)
+    assert_same(d['data'], full['data'][(slice(None),) + index])
+
+
+def _numpy_reduce(data, time, reduce, lat):
+    """ The reductions of reduce applied to the masked array data [time, lat,
+    lon] with numpy, and the time values of the reduced steps."""
+    for op in reversed(reduce.split()):
+        op = op.lstrip('-')
+        if op == 'zonmean':
+            data = data.mean(axis=-1)
+        elif op == 'fldmean':
+            w = np.broadcast_to(np.cos(np.deg2rad(lat))[:, None], data.shape[-2:])
+            w = np.ma.masked_array(np.broadcast_to(w, data.shape), mask=np.ma.getmaskarray(data))
+            data = (data * w).sum(axis=(-2, -1)) / w.sum(axis=(-2, -1))
+        else:
+            dates = lt.decode_times(time, 'days since 1850-01-01', '365_day', form='int')
+            years, months = dates // 10000, dates // 100 % 100
+            labels = {'timmean': np.zeros(len(time)), 'yearmean': years,
+                      'seasmean': (years + (months == 12)) * 4 + (months % 12) // 3}[op]
+            starts = np.concatenate([[0], np.nonzero(np.diff(labels))[0] + 1, [len(time)]])
+            data = np.ma.stack([data[a:b].mean(axis=0) for a, b in zip(starts[:-1], starts[1:])])
+            time = time[(starts[:-1] + starts[1:] - 1) // 2]
+    return data, time
+
+
+@pytest.mark.parametrize('reduce', ['timmean', 'yearmean', 'seasmean', 'zonmean', 'fldmean',
+                                    '-yearmean -fldmean', '-seasmean -zonmean'])
+def test_loadfiles_reduce(ensemble, reduce):
+    full = lt.loadfiles(ensemble, 'ts')
+    time = np.asarray(full['dimensions']['time'])
+    expected = [_numpy_reduce(row, time, reduce, full['dimensions']['lat'])
+                for row in full['data'].astype('f8')]
+    data = np.ma.stack([np.ma.squeeze(e[0]) for e in expected])
+    for workers in (1, 4):
+        d = lt.loadfiles(ensemble, 'ts', reduce=reduce, workers=workers)
+        assert d['data'].shape == data.shape
+        np.testing.assert_array_equal(np.ma.getmaskarray(d['data']), np.ma.getmaskarray(data))
+        np.testing.assert_allclose(np.ma.filled(d['data'], 0), np.ma.filled(data, 0), rtol=1e-5)
+    if reduce == 'timmean':
+        assert 'time' not in d['dimensions']
+    else:
+        np.testing.assert_array_equal(d['dimensions']['time'], expected[0][1])
+    assert ('lon' in d['dimensions']) != ('zonmean' in reduce or 'fldmean' in reduce)
+    name = ensemble.objects('ncfile')[5].name
+    var = lt.loadvar(name, 'ts', reduce=reduce)
+    np.testing.assert_allclose(np.ma.filled(var, 0), np.ma.filled(data[5], 0), rtol=1e-5)
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+@pytest.mark.parametrize('kwargs', [{}, {'lat': (-30, 45), 'stride': {'time': 2}},
+                                    {'reduce': '-yearmean -zonmean'}])
+def test_iterfiles(ensemble, prefetch, kwargs):
+    expected = lt.loadfiles(ensemble, 'ts', **kwargs)
+    items = list(lt.iterfiles(ensemble, 'ts', prefetch=prefetch, **kwargs))
+    files = ensemble.objects('ncfile')
+    assert [item['dimensions']['file'] for item in items] == [f.name for f in files]
+    for i, item in enumerate(items):
+        assert item['dimensions']['models'] == [expected['dimensions']['models'][i]]
+        np.testing.assert_array_equal(item['dimensions']['time'], expected['dimensions']['time'])
+        if 'reduce' in kwargs:
+            np.testing.assert_allclose(np.ma.filled(item['data'], 0),
+                                       np.ma.filled(expected['data'][i], 0), rtol=1e-6)
+        else:
+            assert_same(item['data'], expected['data'][i])
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+@pytest.mark.parametrize('block', [1, 5, 24, 30])
+def test_iterfiles_blocks(ensemble, prefetch, block):
+    expected = lt.loadfiles(ensemble, 'ts', dates=('1850-01-01', '1851-10-31'))
+    items = list(lt.iterfiles(ensemble, 'ts', block=block, prefetch=prefetch,
+                              dates=('1850-01-01', '1851-10-31')))
+    ntime = expected['data'].shape[1]
+    assert len(items) == -(-ntime // block)
+    time = np.concatenate([np.atleast_1d(item['dimensions']['time']) for item in items])
+    np.testing.assert_array_equal(time, expected['dimensions']['time'])
+    for k, item in enumerate(items):
+        rows = expected['data'][:, k * block:(k + 1) * block]
+        assert_same(item['data'], rows[:, 0] if block == 1 else rows)
+
+
+def test_iterfiles_error(ensemble):
+    # an error on the prefetching thread reaches the consumer
+    with pytest.raises(KeyError):
+        list(lt.iterfiles(ensemble, 'pr', prefetch=2))
+
+
+LAZY_KEYS = [0, -1, slice(2, 10, 3), [3, 1, 7], (slice(None), 5), (slice(None), slice(3, 20, 4), 2),
+             (5, slice(None), slice(None), 3), (Ellipsis, 2), (slice(4, 6), [13, 2, 7]),
+             (1, -1), (slice(None), slice(None, None, -5))]
+
+
+@pytest.mark.parametrize('cache_size', [1024 ** 3, 1])
+@pytest.mark.parametrize('kwargs', [{}, {'masked': False}, {'lat': (-30, 45)},
+                                    {'reduce': 'yearmean'}])
+def test_lazy_loadfiles(ensemble, monkeypatch, cache_size, kwargs):
+    # blocks of 5 time steps, so that most keys touch several blocks
+    monkeypatch.setattr(lt, '_READ_BLOCK', 5 * 6 * 8 * 4)
+    expected = lt.loadfiles(ensemble, 'ts', **kwargs)
+    d = lt.loadfiles(ensemble, 'ts', lazy=True, cache_size=cache_size, **kwargs)
+    data = d['data']
+    assert isinstance(data, lt.LazyEnsembleArray)
+    assert data.shape == expected['data'].shape and data.dtype == expected['data'].dtype
+    assert d['dimensions'].keys() == expected['dimensions'].keys()
+    keys = LAZY_KEYS if 'reduce' not in kwargs else LAZY_KEYS[:4] + [(slice(None), 1), (1, -1)]
+    for repeat in range(2):
+        for key in keys:
+            assert_same(data[key], expected['data'][key])
+        models = np.array(d['dimensions']['models'])
+        assert_same(data[models == 'B', :, 2:4], expected['data'][models == 'B', :, 2:4])
+    if cache_size == 1:
+        # only the last block read is kept
+        assert len(data._cache) == 1
+    whole = np.asarray(data)
+    np.testing.assert_array_equal(whole, np.ma.filled(expected['data'].astype('f8'), np.nan))
@@ -0,0 +1,66 @@
+"""
+Tests of preprocessing_tools on small netCDF files written on the fly.
+
+    python -m pytest test_preprocessing_tools.py
+
+"""
+import collections
+import os
+import shutil
+import numpy as np
+import pytest
+
+pt = pytest.importorskip('cmipdata.preprocessing_tools')
+import cmipdata as cd
+
+File = collections.namedtuple('File', 'name')
+
+
+@pytest.mark.parametrize('batch_size, workers', [(6000, 1), (1000, 3), (1, 4)])
+def test_run_cmds_many(tmp_path, batch_size, workers):
+    # long commands, whose statuses overflow a pipe if written all at once
+    padding = '/' + 'x' * 200
+    jobs = [('test -n %s%d && exit %d' % (padding, i, i % 3), str(tmp_path / str(i)))
+            for i in range(6000)]
+    files = [File(str(tmp_path / 'in')) for job in jobs]
+    statuses = pt._run_cmds(files, jobs, 'test', batch_size=batch_size, workers=workers)
+    assert statuses == [i % 3 for i in range(6000)]
+
+
+def test_run_cmds_matches_serial(tmp_path):
+    jobs = [('echo %d > %s; exit %d' % (i, tmp_path / ('out%d' % i), i % 2),
+             str(tmp_path / ('out%d' % i))) for i in range(50)]
+    files = [File(str(tmp_path / 'in')) for job in jobs]
+    serial = pt._run_cmds(files, jobs, 'echo')
+    assert serial == [i % 2 for i in range(50)]
+    for batch_size, workers in ((7, 1), (7, 3), (100, 2)):
+        assert pt._run_cmds(files, jobs, 'echo', batch_size, workers) == serial
+    for i in range(50):
+        with open(str(tmp_path / ('out%d' % i))) as f:
+            assert f.read().strip() == str(i)
+
+
+@pytest.fixture
+def ensemble(tmp_path, monkeypatch):
+    from test_loading_tools import make_file
+    monkeypatch.chdir(tmp_path)
+    for i, model in enumerate('ABCDEF'):
+        for r in (1, 2):
+            make_file('ts_Amon_%s_historical_r%di1p1_185001-185112.nc' % (model, r),
+                      seed=2 * i + r)
+    return cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+
+
+@pytest.mark.skipif(shutil.which('cdo') is None, reason='needs cdo')
+@pytest.mark.parametrize('operator', ['areamean', 'zonmean', 'climatology'])
+def test_batched_operators(ensemble, operator):
+    lt = pytest.importorskip('cmipdata.loading_tools')
+    serial = getattr(cd, operator)(ensemble, delete=False, output_prefix='serial_')
+    batched = getattr(cd, operator)(ensemble, delete=False, output_prefix='batched_',
+                                    batch_size=4, workers=3)
+    names = [os.path.basename(f.name) for f in serial.objects('ncfile')]
+    assert [os.path.basename(f.name) for f in batched.objects('ncfile')] == \
+        ['batched_' + n[len('serial_'):] for n in names]
+    for s, b in zip(serial.objects('ncfile'), batched.objects('ncfile')):
+        np.testing.assert_array_equal(lt.loadvar(s.name, 'ts'), lt.loadvar(b.name, 'ts'))
+    lt.close_files()
@@ -0,0 +1,75 @@
+"""
+Tests of the profiling records of cdo commands.
+
+    python -m pytest test_profiling.py
+
+"""
+import sys
+import numpy as np
+import pytest
+
+prof = pytest.importorskip('cmipdata.profiling')
+pt = pytest.importorskip('cmipdata.preprocessing_tools')
+import cmipdata as cd
+
+
+@pytest.fixture
+def profiling():
+    prof.clear_profile()
+    prof.enable_profiling()
+    yield prof
+    prof.disable_profiling()
+    prof.clear_profile()
+
+
+@pytest.mark.parametrize('cmd, expected', [('true', 0), ('exit 3', 3), ('kill -9 $$', 137)])
+def test_system_status(cmd, expected):
+    assert prof.system(cmd) == expected
+    prof.enable_profiling()
+    try:
+        assert prof.system(cmd) == expected
+    finally:
+        prof.disable_profiling()
+    rec = prof.profile_records()[-1]
+    prof.clear_profile()
+    assert rec['outcome'] == ('ok' if expected == 0 else 'exit status %d' % expected)
+
+
+def test_system_usage(profiling):
+    # the parent's image must not count towards the command's peak
+    big = np.ones(400 * 10 ** 6 // 8)
+    prof.system('true')
+    busy = '%s -c "x = bytearray(200 * 10 ** 6); sum(range(10 ** 7))"' % sys.executable
+    prof.system(busy, 'busy')
+    del big
+    idle, busy = [rec for rec in prof.profile_records() if rec['category'] == 'cdo']
+    assert idle['peak_rss'] < 100e6
+    assert 200e6 < busy['peak_rss'] < 300e6
+    assert busy['cpu_time'] > 0.1
+
+
+@pytest.fixture
+def ensemble(tmp_path, monkeypatch):
+    from test_loading_tools import make_file
+    monkeypatch.chdir(tmp_path)
+    for model in 'ABC':
+        for r in (1, 2):
+            make_file('ts_Amon_%s_historical_r%di1p1_185001-185112.nc' % (model, r))
+    return cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+
+
+@pytest.mark.parametrize('batch_size, workers', [(1, 1), (4, 2)])
+def test_records_per_file(ensemble, profiling, batch_size, workers):
+    files = ensemble.objects('ncfile')
+    busy = '%s -c "sum(range(10 ** 7))"; exit {n}' % sys.executable
+    jobs = [(busy.format(n=i % 2), f.name) for i, f in enumerate(files)]
+    statuses = pt._run_cmds(files, jobs, 'busy', batch_size, workers)
+    assert statuses == [i % 2 for i in range(6)]
+    records = [rec for rec in prof.profile_records() if rec['category'] == 'cdo']
+    assert sorted(rec['inputs'][0] for rec in records) == sorted(f.name for f in files)
+    for rec in records:
+        assert rec['cpu_time'] > 0.1
+    summary = prof.profile_summary(by='model', show=False)
+    assert sorted(summary) == ['A', 'B', 'C']
+    for s in summary.values():
+        assert s['count'] == 2 and s['failed'] == 1
@@ -0,0 +1,134 @@
+"""
+Tests of slice_nc.find_index against the argmin it replaced.
+
+    python -m pytest test_slice_nc.py
+
+"""
+import collections
+import datetime
+import numpy as np
+import pytest
+
+sn = pytest.importorskip('cmipdata.slice_nc')
+
+
+def argmin_index(vec_vals, target):
+    """The original find_index: one argmin over the whole axis per target."""
+    vec_vals = np.array(vec_vals)
+    return [int(np.argmin(np.abs(vec_vals - item))) for item in np.atleast_1d(target)]
+
+
+def cyclic_argmin_index(vec_vals, target, period):
+    vec_vals = np.mod(np.array(vec_vals, dtype='f8'), period)
+    index = []
+    for item in np.mod(np.atleast_1d(target), period):
+        distance = np.abs(vec_vals - item)
+        index.append(int(np.argmin(np.minimum(distance, period - distance))))
+    return index
+
+
+AXES = {'increasing': np.arange(0, 360, 2.5),
+        'decreasing': np.linspace(90, -90, 73),
+        'gaussian': np.sort(np.random.RandomState(0).uniform(-90, 90, 64)),
+        'unsorted': np.random.RandomState(1).uniform(0, 100, 50),
+        'ties': np.array([0., 1., 1., 1., 2., 4., 4., 7.]),
+        'descending ties': np.array([7., 4., 4., 2., 1., 1., 1., 0.]),
+        'unsorted ties': np.array([3., 1., 3., 0., 1., 5., 0.]),
+        'single': np.array([5.])}
+
+
+@pytest.mark.parametrize('name', sorted(AXES))
+def test_find_index(name):
+    values = AXES[name]
+    low, high = values.min(), values.max()
+    targets = np.concatenate([
+        # the values themselves, and the midpoints between them (ties)
+        values, (values[:-1] + values[1:]) / 2.,
+        # out of range on both sides
+        [low - 1000., low - 0.5, high + 0.5, high + 1000.],
+        np.random.RandomState(2).uniform(low - 10, high + 10, 500)])
+    assert sn.find_index(values, targets) == argmin_index(values, targets)
+
+
+@pytest.mark.parametrize('name', sorted(AXES))
+def test_find_index_scalar_and_list(name):
+    values = list(AXES[name])
+    assert sn.find_index(values, values[0] + 0.1) == argmin_index(values, values[0] + 0.1)
+    assert sn.find_index(values, [values[-1]]) == argmin_index(values, [values[-1]])
+
+
+def test_find_index_integers():
+    # exact ties between integers
+    values = [10, 20, 30, 40]
+    targets = [5, 15, 25, 35, 45, 20]
+    assert sn.find_index(values, targets) == argmin_index(values, targets) == [0, 0, 1, 2, 3, 1]
+
+
+@pytest.mark.parametrize('values', [np.arange(0, 360, 2.5), np.arange(-180, 180, 3.75),
+                                    np.arange(357.5, -2.5, -2.5)])
+def test_find_index_period(values):
+    targets = np.concatenate([np.arange(-540, 540, 0.625), [359.9, -0.1, 720.]])
+    assert sn.find_index(values, targets, period=360) == \
+        cyclic_argmin_index(values, targets, 360)
+
+
+def test_find_index_datetimes():
+    start = datetime.datetime(2000, 1, 1)
+    values = [start + datetime.timedelta(days=30 * i) for i in range(24)]
+    targets = [start - datetime.timedelta(days=400), start + datetime.timedelta(days=44),
+               start + datetime.timedelta(days=46), start + datetime.timedelta(days=4000)]
+    expected = [0, 1, 2, 23]
+    assert sn.find_index(values, targets) == expected
+    assert sn.find_index(np.array(values, dtype='datetime64[s]'),
+                         np.array(targets, dtype='datetime64[s]')) == expected
+
+
+def test_find_index_empty():
+    with pytest.raises(ValueError):
+        sn.find_index([], [1.])
+
+
+Point = collections.namedtuple('Point', 'lat lon')
+Box = collections.namedtuple('Box', 'll ur')
+
+
+@pytest.fixture
+def grid_file(tmp_path):
+    from test_loading_tools import make_file
+    name = str(tmp_path / 'tos.nc')
+    make_file(name, var='tos', nt=3, lat=np.arange(-88.75, 90, 2.5), lon=np.arange(0, 360, 2.5))
+    return name
+
+
+@pytest.mark.parametrize('west, east, expected', [
+    # whole globe boxes
+    (0., 360., np.arange(0, 360, 2.5)),
+    (0., 359.9, np.arange(0, 360, 2.5)),
+    (-180., 180., np.mod(np.arange(-180, 180, 2.5), 360)),
+    (-180., 540., np.mod(np.arange(-180, 180, 2.5), 360)),
+    # across the dateline, and across the seam of the grid
+    (170., -170., np.arange(170, 190.1, 2.5)),
+    (-10., 10., np.mod(np.arange(-10, 10.1, 2.5), 360)),
+    (351., 9., np.mod(np.arange(-7.5, 7.6, 2.5), 360)),
+    # an ordinary box, with ends between the grid points
+    (101., 119., np.arange(102.5, 119, 2.5))])
+def test_get_var_2D_boxes(grid_file, west, east, expected):
+    corners = Box(Point(-10., west), Point(10., east))
+    data_nc, var_nc, times, lats, lons, sst = sn.get_var_2D(grid_file, 'tos', corners=corners)
+    try:
+        np.testing.assert_array_equal(lats, np.arange(-8.75, 10, 2.5))
+        np.testing.assert_array_equal(lons, expected)
+        columns = np.round(expected / 2.5).astype(int)
+        rows = np.round((lats + 88.75) / 2.5).astype(int)
+        full = var_nc[:]
+        np.testing.assert_array_equal(sst, full[:, rows][:, :, columns])
+    finally:
+        data_nc.close()
+
+
+def test_slicer_boxes(grid_file):
+    corners = Box(Point(-90., -180.), Point(90., 180.))
+    with sn.Slicer() as slicer:
+        times, lats, lons, sst = slicer.get_var_2D(grid_file, 'tos', corners=corners)
+    assert sst.shape == (3, 72, 144)
+    assert lons[0] == 180.
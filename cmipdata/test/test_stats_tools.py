@@ -0,0 +1,127 @@
+"""
+Tests of stats_tools on small netCDF files written on the fly, against
+numpy statistics of the ensemble loaded with loadfiles.
+
+    python -m pytest test_stats_tools.py
+
+"""
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+lt = pytest.importorskip('cmipdata.loading_tools')
+st = pytest.importorskip('cmipdata.stats_tools')
+import cmipdata as cd
+from test_loading_tools import make_file
+
+
+@pytest.fixture
+def ensemble(tmp_path, monkeypatch):
+    """ 3 models with 1 to 3 realizations, in 2 experiments. Every file is
+    missing the point [0, 0], and also a point of its own."""
+    monkeypatch.chdir(tmp_path)
+    seed = 0
+    for experiment in ('historical', 'rcp45'):
+        for model, nr in (('A', 1), ('B', 2), ('C', 3)):
+            for r in range(1, nr + 1):
+                name = 'ts_Amon_%s_%s_r%di1p1_185001-185112.nc' % (model, experiment, r)
+                make_file(name, nt=12, seed=seed)
+                nc = Dataset(name, 'a')
+                nc.variables['ts'][:, 1 + seed % 3, 1 + seed % 5] = np.ma.masked
+                nc.close()
+                seed += 1
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    yield ens
+    lt.close_files()
+
+
+def members(ensemble, weighting, **kwargs):
+    """ The members of each experiment, as a masked array [member, ...]:
+    the files, or the means of the realizations of each model."""
+    d = lt.loadfiles(ensemble, 'ts', **kwargs)
+    data = d['data'].astype('f8')
+    models = np.array(d['dimensions']['models'])
+    experiments = np.array(d['dimensions']['experiments'])
+    result = {}
+    for e in ('historical', 'rcp45'):
+        rows = experiments == e
+        if weighting == 'realization':
+            result[e] = data[rows]
+        else:
+            result[e] = np.ma.stack([data[rows & (models == m)].mean(axis=0)
+                                     for m in ('A', 'B', 'C')])
+    return result
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+@pytest.mark.parametrize('weighting', ['model', 'realization'])
+@pytest.mark.parametrize('kwargs', [{}, {'reduce': 'fldmean'}, {'lat': (-30, 45)}])
+def test_ensemble_statistics(ensemble, weighting, prefetch, kwargs):
+    expected = members(ensemble, weighting, **kwargs)
+    for ddof in (0, 1):
+        result = st.ensemble_statistics(ensemble, 'ts', stats=st._STATISTICS,
+                                        weighting=weighting, ddof=ddof, prefetch=prefetch,
+                                        **kwargs)
+        for stat in st._STATISTICS:
+            assert result[stat]['dimensions']['experiments'] == ['historical', 'rcp45']
+            for j, e in enumerate(('historical', 'rcp45')):
+                m = expected[e]
+                value = {'mean': m.mean(axis=0), 'std': m.std(axis=0, ddof=ddof),
+                         'min': m.min(axis=0), 'max': m.max(axis=0),
+                         'count': m.count(axis=0)}[stat]
+                got = result[stat]['data'][j]
+                np.testing.assert_array_equal(np.ma.getmaskarray(got),
+                                              np.ma.getmaskarray(value) & (stat != 'count'))
+                np.testing.assert_allclose(np.ma.filled(got, 0), np.ma.filled(value, 0),
+                                           rtol=1e-5, atol=1e-6)
+
+
+def test_ensemble_statistics_unmasked(ensemble):
+    masked = st.ensemble_statistics(ensemble, 'ts', stats=['mean', 'count'])
+    plain = st.ensemble_statistics(ensemble, 'ts', stats=['mean', 'count'], masked=False)
+    assert not np.ma.isMaskedArray(plain['mean']['data'])
+    np.testing.assert_array_equal(plain['mean']['data'], np.ma.filled(masked['mean']['data'],
+                                                                      np.nan))
+    np.testing.assert_array_equal(plain['count']['data'], masked['count']['data'])
+
+
+def nanpercentiles(expected, percentiles):
+    return dict((e, np.nanpercentile(np.ma.filled(m, np.nan), percentiles, axis=0))
+                for e, m in expected.items())
+
+
+@pytest.mark.filterwarnings('ignore:All-NaN slice')
+@pytest.mark.parametrize('weighting', ['model', 'realization'])
+@pytest.mark.parametrize('tile, max_memory', [('time', 512 * 1024 ** 2), ('time', 4000),
+                                              ('lat', 4000)])
+def test_ensemble_percentiles_exact(ensemble, tmp_path, weighting, tile, max_memory):
+    percentiles = [0, 5, 50, 95, 100]
+    expected = nanpercentiles(members(ensemble, weighting), percentiles)
+    for output_dir in (None, str(tmp_path / 'p')):
+        result = st.ensemble_percentiles(ensemble, 'ts', percentiles, weighting=weighting,
+                                         tile=tile, max_memory=max_memory,
+                                         output_dir=output_dir)
+        for k, p in enumerate(percentiles):
+            data = np.ma.filled(result[p]['data'], np.nan)
+            assert result[p]['dimensions']['experiments'] == ['historical', 'rcp45']
+            for j, e in enumerate(('historical', 'rcp45')):
+                np.testing.assert_allclose(data[j], expected[e][k], rtol=1e-5)
+
+
+@pytest.mark.filterwarnings('ignore:All-NaN slice')
+@pytest.mark.parametrize('weighting', ['model', 'realization'])
+def test_ensemble_percentiles_histogram(ensemble, weighting):
+    # each percentile is within half a bin of the exact one
+    percentiles, bins = [5, 50, 95], 40
+    m = members(ensemble, weighting)
+    expected = nanpercentiles(m, percentiles)
+    result = st.ensemble_percentiles(ensemble, 'ts', percentiles, weighting=weighting,
+                                     method='histogram', bins=bins, max_memory=4000)
+    for k, p in enumerate(percentiles):
+        for j, e in enumerate(('historical', 'rcp45')):
+            values = np.ma.filled(m[e], np.nan)
+            half_bin = (np.nanmax(values, axis=0) - np.nanmin(values, axis=0)) / bins / 2
+            got = np.ma.filled(result[p]['data'][j], np.nan)
+            np.testing.assert_array_equal(np.isnan(got), np.isnan(expected[e][k]))
+            valid = ~np.isnan(got)
+            assert np.all(np.abs(got - expected[e][k])[valid] <= half_bin[valid] + 1e-6)
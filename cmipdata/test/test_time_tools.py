@@ -0,0 +1,76 @@
+"""
+Tests of time_tools against cftime.num2date.
+
+    python -m pytest test_time_tools.py
+
+"""
+import numpy as np
+import pytest
+
+cftime = pytest.importorskip('cftime')
+tt = pytest.importorskip('cmipdata.time_tools')
+
+CALENDARS = ['standard', 'noleap', '360_day', 'julian']
+
+# daily and sub-daily axes, from before and after the gregorian reform and
+# across the leap days of each calendar
+AXES = [(np.arange(0, 3 * 366, 1.), 'days since 1899-01-01'),
+        (np.arange(0, 3 * 365 * 24, 6.), 'hours since 2000-01-01 06:00:00'),
+        (np.arange(-400, 400) * 30.5 + 15, 'days since 1850-01-01'),
+        (np.arange(0, 800, 1.), 'days since 1582-01-01'),
+        (np.arange(0, 86400 * 70, 3 * 3600.), 'seconds since 1999-12-30')]
+
+
+def expected_fields(values, units, calendar):
+    dates = cftime.num2date(values, units, calendar)
+    return (np.array([d.year for d in dates]), np.array([d.month for d in dates]),
+            np.array([d.day for d in dates]),
+            np.array([d.hour * 3600 + d.minute * 60 + d.second for d in dates]))
+
+
+def clamped(year, month, day, seconds):
+    """datetime64 of the fields, with days past the end of a (gregorian)
+    month moved to its last day."""
+    months = np.array(['%04d-%02d' % ym for ym in zip(year, month)], dtype='datetime64[M]')
+    length = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(int)
+    days = months.astype('datetime64[D]') + (np.minimum(day, length) - 1)
+    return days.astype('datetime64[s]') + seconds.astype('timedelta64[s]')
+
+
+@pytest.mark.parametrize('calendar', CALENDARS)
+@pytest.mark.parametrize('values, units', AXES)
+def test_decode_times_int(values, units, calendar):
+    year, month, day, seconds = expected_fields(values, units, calendar)
+    dates = tt.decode_times(values, units, calendar, form='int')
+    np.testing.assert_array_equal(dates, year * 10000 + month * 100 + day)
+
+
+@pytest.mark.parametrize('calendar', CALENDARS)
+@pytest.mark.parametrize('values, units', AXES)
+def test_decode_times_datetime64(values, units, calendar):
+    fields = expected_fields(values, units, calendar)
+    dates = tt.decode_times(values, units, calendar)
+    assert dates.dtype == np.dtype('datetime64[s]')
+    np.testing.assert_array_equal(dates, clamped(*fields))
+    python = tt.decode_times(values, units, calendar, form='datetime')
+    np.testing.assert_array_equal(np.array(python, dtype='datetime64[s]'), clamped(*fields))
+
+
+@pytest.mark.parametrize('calendar', CALENDARS)
+@pytest.mark.parametrize('values, units', AXES)
+def test_from_int_dates(values, units, calendar):
+    year, month, day, seconds = expected_fields(values, units, calendar)
+    dates = tt.from_int_dates(tt.decode_times(values, units, calendar, form='int'))
+    np.testing.assert_array_equal(dates, clamped(year, month, day, 0 * seconds))
+    python = tt.from_int_dates(year * 10000 + month * 100 + day, form='datetime')
+    np.testing.assert_array_equal(np.array(python, dtype='datetime64[s]'),
+                                  clamped(year, month, day, 0 * seconds))
+
+
+def test_standard_calendar_matches_cftime_exactly():
+    # in the standard calendar every date exists, so nothing is clamped
+    values, units = np.arange(-1000, 1000) * 0.25, 'days since 1850-01-01 12:00:00'
+    dates = tt.decode_times(values, units, 'standard')
+    expected = cftime.num2date(values, units, 'standard', only_use_cftime_datetimes=False,
+                               only_use_python_datetimes=True)
+    np.testing.assert_array_equal(dates, np.array(expected, dtype='datetime64[s]'))
@@ -0,0 +1,129 @@
+"""
+Tests of the preflight checks of validation_tools on small netCDF files
+written on the fly, against what the operators and loaders then do.
+
+    python -m pytest test_validation_tools.py
+
+"""
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+lt = pytest.importorskip('cmipdata.loading_tools')
+vt = pytest.importorskip('cmipdata.validation_tools')
+import cmipdata as cd
+from test_loading_tools import make_file
+
+
+def build(tmp_path, files):
+    """ Write files, a dictionary mapping the model and experiment of each
+    file to the keyword arguments of make_file, and return their ensemble."""
+    for (model, experiment), kwargs in files.items():
+        make_file(str(tmp_path / ('ts_Amon_%s_%s_r1i1p1_185001-185112.nc' % (model, experiment))),
+                  **kwargs)
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    assert len(ens.objects('ncfile')) == len(files)
+    return ens
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+
+@pytest.fixture
+def ensemble(tmp_path):
+    ens = build(tmp_path, dict(((m, e), {}) for m in 'ABC' for e in ('historical', 'rcp45')))
+    yield ens
+    lt.close_files()
+
+
+@pytest.mark.parametrize('operator, kwargs', [
+    ('areamean', {}), ('zonmean', {}), ('remap', {}), ('climatology', {}), ('ens_stats', {}),
+    ('loadfiles', {}), ('cat_experiments', {}),
+    ('time_slice', {'start_date': '1850-01-01', 'end_date': '1851-12-31'}),
+    ('my_operator', {'my_cdo_str': 'cdo -seldate,1850-06-01,1851-06-30 {infile} {outfile}'})])
+def test_preflight_passes(ensemble, operator, kwargs):
+    assert vt.preflight(ensemble, operator, show=False, **kwargs) == {}
+
+
+def test_preflight_dates(ensemble):
+    report = vt.preflight(ensemble, 'time_anomaly', start_date='1849-01-01',
+                          end_date='1851-12-31', show=False)
+    assert sorted(report) == sorted(f.name for f in ensemble.objects('ncfile'))
+    for problems in report.values():
+        assert len(problems) == 1 and 'does not span 1849-01-01' in problems[0]
+    report = vt.preflight(ensemble, 'my_operator', show=False,
+                          my_cdo_str='cdo -seldate,1850-01-01,1852-06-30 {infile} {outfile}')
+    assert len(report) == 6
+
+
+def test_preflight_variables(ensemble):
+    report = vt.preflight(ensemble, 'areamean', variable_name='pr', show=False)
+    assert len(report) == 6
+    assert all(problems == ['variable pr not found'] for problems in report.values())
+    report = vt.preflight(ensemble, 'my_operator', show=False,
+                          my_cdo_str='cdo -selvar,ts,uas {infile} {outfile}')
+    assert all(problems == ['variable uas not found'] for problems in report.values())
+
+
+def test_preflight_broken_file(ensemble):
+    name = ensemble.objects('ncfile')[2].name
+    with open(name, 'w') as f:
+        f.write('not a netCDF file')
+    with pytest.raises(Exception):
+        lt.loadvar(name, 'ts')
+    report = vt.preflight(ensemble, 'areamean', show=False)
+    assert list(report) == [name]
+    assert report[name][0].startswith('cannot be opened')
+
+
+def test_preflight_no_grid(tmp_path):
+    name = str(tmp_path / 'ts_Amon_A_historical_r1i1p1_185001-185112.nc')
+    nc = Dataset(name, 'w')
+    nc.createDimension('time', None)
+    nc.createVariable('time', 'f8', ('time',)).units = 'days since 1850-01-01'
+    nc.createVariable('ts', 'f4', ('time',))[:] = np.arange(12.)
+    nc.close()
+    ens = cd.mkensemble('ts_Amon_*', prefix=str(tmp_path) + '/')
+    report = vt.preflight(ens, 'zonmean', show=False)
+    assert report == {name: ['no latitude/longitude dimensions for ts']}
+    assert vt.preflight(ens, 'climatology', show=False) == {}
+
+
+def test_preflight_grids_across_experiments(tmp_path):
+    # each experiment has a single grid, but the rcp45 grid differs from the
+    # historical one: ens_stats works within experiments, loadfiles does not
+    fine = {'lat': np.linspace(-75, 75, 12)}
+    ens = build(tmp_path, {('A', 'historical'): {}, ('B', 'historical'): {},
+                           ('C', 'historical'): {}, ('A', 'rcp45'): fine, ('B', 'rcp45'): fine})
+    assert vt.preflight(ens, 'ens_stats', show=False) == {}
+    with pytest.raises(ValueError):
+        lt.loadfiles(ens, 'ts')
+    report = vt.preflight(ens, 'loadfiles', show=False)
+    assert sorted(report) == sorted(f.name for f in ens.objects('ncfile')
+                                    if f.parentobject('experiment').name == 'rcp45')
+    for problems in report.values():
+        assert problems == ["grid ('time', 'lat', 'lon') (24, 12, 8) differs from "
+                            "('time', 'lat', 'lon') (24, 6, 8) used by most files of the ensemble"]
+    lt.close_files()
+
+
+def test_preflight_grids_within_experiment(tmp_path):
+    ens = build(tmp_path, {('A', 'historical'): {}, ('B', 'historical'): {},
+                           ('C', 'historical'): {'nt': 12}, ('A', 'rcp45'): {'nt': 12}})
+    # ens_stats compares the historical files only, loadfiles all four
+    assert list(vt.preflight(ens, 'ens_stats', show=False)) == [
+        f.name for f in ens.objects('ncfile') if f.parentobject('model').name == 'C']
+    report = vt.preflight(ens, 'loadfiles', show=False)
+    assert sorted(report) == sorted(f.name for f in ens.objects('ncfile')
+                                    if f.parentobject('model').name == 'C' or
+                                    f.parentobject('experiment').name == 'rcp45')
+    lt.close_files()
+
+
+def test_preflight_arguments(ensemble):
+    with pytest.raises(ValueError):
+        vt.preflight(ensemble, 'timmean', show=False)
+    with pytest.raises(ValueError):
+        vt.preflight(ensemble, 'time_slice', start_date='1850-01-01', show=False)
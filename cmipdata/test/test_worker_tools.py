@@ -0,0 +1,94 @@
+"""
+Tests of worker_tools, with a worker serving from a thread.
+
+    python -m pytest test_worker_tools.py
+
+"""
+import os
+import stat
+import threading
+import time
+import numpy as np
+import pytest
+
+w = pytest.importorskip('cmipdata.worker_tools')
+pytest.importorskip('cmipdata.loading_tools')
+from test_loading_tools import make_file
+
+
+def test_default_address(tmp_path, monkeypatch):
+    runtime = tmp_path / 'runtime'
+    runtime.mkdir(mode=0o700)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(runtime))
+    assert os.path.dirname(w.default_address()) == str(runtime)
+
+    # a runtime directory others can open is not used
+    runtime.chmod(0o755)
+    monkeypatch.setattr(w.tempfile, 'gettempdir', lambda: str(tmp_path))
+    address = w.default_address()
+    directory = os.path.dirname(address)
+    assert directory == str(tmp_path / ('cmipdata-%d' % os.getuid()))
+    assert stat.S_IMODE(os.lstat(directory).st_mode) == 0o700
+
+    # nor is a directory which is not private
+    os.chmod(directory, 0o777)
+    with pytest.raises(PermissionError):
+        w.default_address()
+
+
+def test_serve(tmp_path):
+    name = str(tmp_path / 'ts.nc')
+    make_file(name)
+    address = str(tmp_path / 'worker.sock')
+    thread = threading.Thread(target=w.serve, args=(address,))
+    thread.start()
+    for attempt in range(100):
+        try:
+            client = w.WorkerClient(address)
+            break
+        except OSError:
+            time.sleep(0.1)
+    try:
+        assert stat.S_IMODE(os.stat(address).st_mode) == 0o600
+        assert client.ping() == os.getpid()
+        zonal = client.reduce(name, 'ts', ['timmean', 'zonmean'])
+        assert zonal.shape == (6,)
+        field = client.reduce(name, 'ts', ['timmean', 'fldmean'])
+        assert np.ndim(field) == 0
+    finally:
+        client.shutdown()
+        thread.join(10)
+    assert not os.path.exists(address)
+
+
+def test_reduce_without_lat(tmp_path):
+    # a time series has no latitudes, which only fldmean needs
+    from netCDF4 import Dataset
+    name = str(tmp_path / 'series.nc')
+    nc = Dataset(name, 'w')
+    nc.createDimension('time', 12)
+    nc.createVariable('time', 'f8', ('time',))[:] = np.arange(12)
+    nc.createVariable('ts', 'f4', ('time',))[:] = np.arange(12)
+    nc.close()
+    worker = w._Worker()
+    assert worker.reduce(name, 'ts', ['timmean']) == pytest.approx(5.5)
+    with pytest.raises(ValueError):
+        worker.reduce(name, 'ts', ['fldmean'])
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'lat': (-30, 45), 'lon': (-100, 100)},
+                                    {'dates': ('1850-03-01', '1851-06-30')}])
+def test_worker_matches_loadvar(tmp_path, kwargs):
+    # the worker selects and reduces exactly as loadvar does
+    import cmipdata.loading_tools as lt
+    name = str(tmp_path / 'ts.nc')
+    make_file(name)
+    worker = w._Worker()
+    np.testing.assert_array_equal(worker.loadvar(name, 'ts', **kwargs),
+                                  lt.loadvar(name, 'ts', **kwargs))
+    for ops in (['timmean'], ['fldmean'], ['yearmean', 'zonmean']):
+        got = worker.reduce(name, 'ts', ops, **kwargs)
+        expected = lt.loadvar(name, 'ts', reduce=ops, **kwargs)
+        np.testing.assert_array_equal(np.ma.getmaskarray(got), np.ma.getmaskarray(expected))
+        np.testing.assert_array_equal(got, expected)
+    lt.close_files()
@@ -0,0 +1,186 @@
+"""time_tools
+======================
+
+The time_tools module of cmipdata decodes netCDF time axes ("days since
+1850-01-01" etc.) to dates. The decoding is vectorized with numpy rather
+than done one time step at a time, and supports the standard, proleptic
+gregorian, noleap (365_day), all_leap (366_day) and 360_day calendars.
+Decoded axes are cached, so that identical time axes (e.g. of the
+realizations of a model) are decoded only once.
+
+Dates can be returned as numpy datetime64 values, as python datetimes, or
+as integers YYYYMMDD. The integer form is exact in every calendar; the
+datetime forms cannot represent dates such as 30 February, which only
+exist in the 360_day calendar, and these are moved to the last day of the
+month.
+
+  .. moduleauthor:: Neil Swart <neil.swart@ec.gc.ca>
+"""
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+_UNIT_SECONDS = {'day': 86400, 'days': 86400, 'd': 86400,
+                 'hour': 3600, 'hours': 3600, 'h': 3600, 'hr': 3600, 'hrs': 3600,
+                 'minute': 60, 'minutes': 60, 'min': 60, 'mins': 60,
+                 'second': 1, 'seconds': 1, 's': 1, 'sec': 1, 'secs': 1}
+
+# cumulative days at the start of each month, for calendars with fixed years
+_MONTH_STARTS = {'noleap': np.cumsum([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+                 'all_leap': np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+                 '360_day': np.arange(13) * 30}
+_CALENDARS = {'standard': 'standard', 'gregorian': 'standard',
+              'proleptic_gregorian': 'proleptic_gregorian',
+              'noleap': 'noleap', '365_day': 'noleap',
+              'all_leap': 'all_leap', '366_day': 'all_leap',
+              '360_day': '360_day'}
+
+_MAX_CACHED = 256
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def decode_times(values, units, calendar='standard', form='datetime64'):
+    """
+    Convert the values of a netCDF time axis to dates.
+
+    Parameters
+    ----------
+    values : array
+             The time values, e.g. nc.variables['time'][:].
+    units : str
+            The units of the time axis, e.g. 'days since 1850-01-01'.
+    calendar : str
+               The calendar of the time axis.
+    form : str
+           'datetime64' (default) for an array of numpy datetime64[s],
+           'datetime' for an array of python datetime.datetime, or 'int'
+           for integers YYYYMMDD.
+
+    Returns
+    -------
+    A read-only array of dates. Results are cached by units, calendar and
+    the values, so the array must not be modified.
+
+    Examples
+    --------
+
+    >>> decode_times([0, 59, 359], 'days since 2000-01-01', '360_day', form='int')
+    array([20000101, 20000230, 20001230])
+    """
+    values = np.ma.filled(np.asarray(values, dtype='f8') if not np.ma.isMaskedArray(values)
+                          else values.astype('f8'), np.nan)
+    calendar = (calendar or 'standard').lower()
+    if form not in ('datetime64', 'datetime', 'int'):
+        raise ValueError("form must be 'datetime64', 'datetime' or 'int'")
+    key = (units, calendar, form, values.shape, hashlib.sha1(values.tobytes()).hexdigest())
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    year, month, day, seconds = _fields(values, units, calendar)
+    if form == 'int':
+        dates = year * 10000 + month * 100 + day
+    else:
+        dates = _datetime64(year, month, day, seconds)
+        if form == 'datetime':
+            dates = dates.astype('datetime64[us]').astype(object)
+    dates.flags.writeable = False
+
+    with _lock:
+        _cache[key] = dates
+        while len(_cache) > _MAX_CACHED:
+            _cache.popitem(last=False)
+    return dates
+
+
+def _parse_units(units):
+    """Split units like 'days since 1850-1-1 00:00:00' into the length of the
+    unit in seconds and the reference (year, month, day, seconds of day), or
+    return None if they cannot be parsed."""
+    match = re.match(r'^\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)'
+                     r'(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?', units or '')
+    if not match or match.group(1).lower() not in _UNIT_SECONDS:
+        return None
+    unit = _UNIT_SECONDS[match.group(1).lower()]
+    year, month, day = int(match.group(2)), int(match.group(3)), int(match.group(4))
+    hour, minute = int(match.group(5) or 0), int(match.group(6) or 0)
+    second = float(match.group(7) or 0)
+    return unit, (year, month, day, hour * 3600 + minute * 60 + second)
+
+
+def _fields(values, units, calendar):
+    """The year, month, day and seconds of the day of each time value, as
+    integer arrays."""
+    parsed = _parse_units(units)
+    kind = _CALENDARS.get(calendar)
+    if parsed is None or kind is None or np.isnan(values).any() or parsed[1][0] < 1:
+        return _fields_cftime(values, units, calendar)
+    unit, (year0, month0, day0, seconds0) = parsed
+    offsets = np.round(values * unit + seconds0).astype('int64')
+
+    if kind in ('standard', 'proleptic_gregorian'):
+        ref = np.datetime64('%04d-%02d-%02d' % (year0, month0, day0), 's')
+        dates = ref + offsets.astype('timedelta64[s]')
+        # the standard calendar is julian before 15 October 1582
+        if kind == 'standard' and len(dates) and (
+                ref < np.datetime64('1582-10-15') or dates.min() < np.datetime64('1582-10-15')):
+            return _fields_cftime(values, units, calendar)
+        days = dates.astype('datetime64[D]')
+        months = days.astype('datetime64[M]')
+        years = months.astype('datetime64[Y]')
+        return (years.astype('int64') + 1970, (months - years).astype('int64') + 1,
+                (days - months).astype('int64') + 1, (dates - days).astype('int64'))
+
+    starts = _MONTH_STARTS[kind]
+    length = starts[-1]
+    days = np.floor_divide(offsets, 86400) + starts[month0 - 1] + day0 - 1
+    seconds = np.mod(offsets, 86400)
+    year = year0 + np.floor_divide(days, length)
+    doy = np.mod(days, length)
+    month = np.searchsorted(starts, doy, side='right')
+    day = doy - starts[month - 1] + 1
+    return year, month, day, seconds
+
+
+def _fields_cftime(values, units, calendar):
+    """The slow path, for calendars and units not handled above."""
+    import cftime
+    dates = cftime.num2date(values, units, calendar)
+    dates = np.atleast_1d(dates)
+    return (np.array([d.year for d in dates], dtype='int64'),
+            np.array([d.month for d in dates], dtype='int64'),
+            np.array([d.day for d in dates], dtype='int64'),
+            np.array([d.hour * 3600 + d.minute * 60 + d.second for d in dates], dtype='int64'))
+
+
+def _datetime64(year, month, day, seconds):
+    """Build datetime64[s] values, moving days which do not exist in the
+    gregorian calendar (e.g. 30 February) to the last day of the month."""
+    months = (np.asarray(year - 1970, dtype='int64').astype('datetime64[Y]').astype('datetime64[M]') +
+              np.asarray(month - 1, dtype='int64').astype('timedelta64[M]'))
+    first = months.astype('datetime64[D]')
+    length = ((months + np.timedelta64(1, 'M')).astype('datetime64[D]') - first).astype('int64')
+    day = np.minimum(day, length)
+    return (first + np.asarray(day - 1, dtype='int64').astype('timedelta64[D]')).astype('datetime64[s]') + \
+        np.asarray(seconds, dtype='int64').astype('timedelta64[s]')
+
+
+def from_int_dates(dates, form='datetime64'):
+    """Convert integer dates YYYYMMDD, as returned by decode_times with
+    form='int', to datetime64 (form='datetime64') or python datetimes
+    (form='datetime')."""
+    dates = np.asarray(dates, dtype='int64')
+    values = _datetime64(dates // 10000, dates // 100 % 100, dates % 100, np.zeros_like(dates))
+    if form == 'datetime':
+        return values.astype('datetime64[us]').astype(object)
+    return values
+
+
+def clear_time_cache():
+    """Empty the cache of decoded time axes."""
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,216 @@
+"""validation_tools
+======================
+
+The validation_tools module of cmipdata provides a pre-flight check of the
+files in an ensemble against the requirements of a :mod:`preprocessing_tools`
+operator, before any cdo processing is started. Only the file headers and the
+first and last time values are read, and the files are checked in parallel,
+so that doomed runs (missing variables, date-ranges outside of a file,
+corrupt headers or incompatible grids) are found in seconds rather than after
+hours of processing, and before any input file is deleted.
+
+  .. moduleauthor:: Neil Swart <neil.swart@ec.gc.ca>
+"""
+import re
+import concurrent.futures
+from netCDF4 import Dataset, num2date
+
+# What each operator needs from its input files:
+#   'grid'      : a variable with latitude and longitude dimensions
+#   'time'      : a variable with a time dimension
+#   'dates'     : a time axis spanning start_date to end_date
+#   'same_grid' : the same variable dimensions and shape (grid and number of
+#                 time steps) for all files of an experiment
+#   'same_grid_all' : the same, for all files of the ensemble
+_REQUIREMENTS = {'cat_exp_slices': ('time',),
+                 'cat_experiments': ('time',),
+                 'ens_stats': ('same_grid',),
+                 'areaint': ('grid',),
+                 'areamean': ('grid',),
+                 'zonmean': ('grid',),
+                 'climatology': ('time',),
+                 'remap': ('grid',),
+                 'time_slice': ('time', 'dates'),
+                 'time_anomaly': ('time', 'dates'),
+                 'my_operator': (),
+                 'trends': ('time', 'dates'),
+                 'loadfiles': ('same_grid_all',),
+                 }
+
+
+def _yyyymm(date):
+    """Convert a YYYY-MM-DD string, or a datetime-like object, to an integer
+    month count, used to compare dates across calendars."""
+    if isinstance(date, str):
+        year, month = date.split('-')[0:2]
+        return int(year) * 12 + int(month) - 1
+    return date.year * 12 + date.month - 1
+
+
+def _check_file(ifile, varname, requirements, start_date=None, end_date=None):
+    """Check one file. Returns a tuple of the list of problems found and the
+    signature (dimension names and shape of varname)."""
+    problems = []
+    try:
+        nc = Dataset(ifile, 'r')
+    except Exception as e:
+        return ['cannot be opened: ' + str(e)], None
+
+    try:
+        if varname not in nc.variables:
+            return ['variable ' + varname + ' not found'], None
+        ncvar = nc.variables[varname]
+        dims = [d.lower() for d in ncvar.dimensions]
+        signature = (tuple(ncvar.dimensions), ncvar.shape)
+
+        if 'grid' in requirements:
+            coords = getattr(ncvar, 'coordinates', '').lower()
+            has_lat = any(d.startswith('lat') for d in dims) or 'lat' in coords
+            has_lon = any(d.startswith('lon') for d in dims) or 'lon' in coords
+            if not (has_lat and has_lon):
+                problems.append('no latitude/longitude dimensions for ' + varname)
+
+        timedims = [d for d in ncvar.dimensions if d.lower().startswith('time')]
+        if ('time' in requirements or 'dates' in requirements) and not timedims:
+            problems.append('no time dimension for ' + varname)
+
+        if 'dates' in requirements and timedims and start_date is not None:
+            nc_time = nc.variables[timedims[0]]
+            if len(nc_time) == 0:
+                problems.append('empty time axis')
+            else:
+                calendar = getattr(nc_time, 'calendar', 'standard')
+                ends = num2date([nc_time[0], nc_time[-1]], nc_time.units, calendar)
+                if _yyyymm(ends[0]) > _yyyymm(start_date) or _yyyymm(ends[1]) < _yyyymm(end_date):
+                    problems.append('time axis %s to %s does not span %s to %s' %
+                                    (ends[0].strftime('%Y-%m-%d'), ends[1].strftime('%Y-%m-%d'),
+                                     start_date, end_date))
+    except Exception as e:
+        problems.append('unreadable header: ' + str(e))
+        signature = None
+    finally:
+        nc.close()
+    return problems, signature
+
+
+def preflight(ens, operator, variable_name=None, start_date=None, end_date=None,
+              my_cdo_str='', workers=8, show=True):
+    """
+    Check all files in ens against the requirements of operator, before
+    running it.
+
+    Only headers (and the first and last time values) are read. The checks
+    made depend on the operator: all operators require the files to open and
+    to contain the variable; operators working on fields require latitude and
+    longitude dimensions; time_slice, time_anomaly and trends require the
+    time axis to span start_date to end_date; ens_stats requires all files of
+    an experiment, and loadfiles all files of the ensemble, to have the same
+    grid and number of time steps. For my_operator, any -selvar or -seldate found in my_cdo_str is
+    also checked.
+
+    Parameters
+    ----------
+    ens : cmipdata Ensemble
+          The ensemble to check.
+
+    operator : str
+               The name of the operator to be applied, e.g. 'time_slice'.
+
+    variable_name : str
+                    The variable to check. Defaults to the variable of each
+                    file in ens.
+
+    start_date, end_date : str
+                           The date range, for time_slice, time_anomaly and
+                           trends, with format YYYY-MM-DD.
+
+    my_cdo_str : str
+                 The cdo string, for my_operator.
+
+    workers : int
+              The number of files checked in parallel.
+
+    show : boolean
+           If True, print the report.
+
+    Returns
+    -------
+    report : dictionary
+             Maps the name of each file with problems to a list of strings
+             describing the problems. An empty dictionary means all files
+             passed.
+
+    Examples
+    --------
+
+    1. Check that all files cover 1979 to 2013 before time slicing::
+
+        report = cd.preflight(ens, 'time_slice', start_date='1979-01-01',
+                              end_date='2013-12-31')
+        if not report:
+            ens = cd.time_slice(ens, start_date='1979-01-01', end_date='2013-12-31')
+
+    """
+    if operator not in _REQUIREMENTS:
+        raise ValueError('unknown operator ' + operator + ', expected one of ' +
+                         ', '.join(sorted(_REQUIREMENTS)))
+    requirements = _REQUIREMENTS[operator]
+
+    selvars = []
+    if operator == 'my_operator':
+        selvars = re.findall(r'selvar,([\w,]+)', my_cdo_str)
+        dates = re.findall(r'seldate,([\d-]+),([\d-]+)', my_cdo_str)
+        if dates:
+            requirements = requirements + ('time', 'dates')
+            start_date, end_date = dates[0]
+    if 'dates' in requirements and (start_date is None or end_date is None):
+        raise ValueError(operator + ' requires start_date and end_date')
+
+    files = ens.objects('ncfile')
+    jobs = []
+    for f in files:
+        names = [variable_name or f.parent.name]
+        for s in selvars:
+            names.extend(s.split(','))
+        for name in sorted(set(names)):
+            jobs.append((f, name))
+
+    report = {}
+    signatures = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_check_file, f.name, name, requirements,
+                                   start_date, end_date) for f, name in jobs]
+        for (f, name), future in zip(jobs, futures):
+            problems, signature = future.result()
+            for problem in problems:
+                if problem not in report.get(f.name, []):
+                    report.setdefault(f.name, []).append(problem)
+            if signature is not None and name == (variable_name or f.parent.name):
+                if 'same_grid' in requirements:
+                    group = f.parentobject('experiment').name
+                else:
+                    group = 'the ensemble'
+                signatures.setdefault(group, []).append((f.name, signature))
+
+    if 'same_grid' in requirements or 'same_grid_all' in requirements:
+        for group, sigs in signatures.items():
+            counts = {}
+            for fname, signature in sigs:
+                counts[signature] = counts.get(signature, 0) + 1
+            common = max(counts, key=counts.get)
+            for fname, signature in sigs:
+                if signature != common:
+                    report.setdefault(fname, []).append(
+                        'grid %s %s differs from %s %s used by most files of %s' %
+                        (signature + common + (group,)))
+
+    if show:
+        if report:
+            print('%d of %d files failed the checks for %s:' % (len(report), len(files), operator))
+            for fname in sorted(report):
+                print(fname)
+                for problem in report[fname]:
+                    print('\t' + problem)
+        else:
+            print('All %d files passed the checks for %s' % (len(files), operator))
+    return report
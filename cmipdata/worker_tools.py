@@ -0,0 +1,355 @@
+"""worker_tools
+======================
+
+The worker_tools module of cmipdata provides an optional long-lived local
+worker process, for interactive sessions which call :func:`loadvar` many
+times. Starting python, importing the cdo bindings and netCDF4, and opening
+files is paid once by the worker rather than on every call. The worker keeps
+the netCDF files it has read open, and their coordinates cached, and serves
+load and reduce requests over a Unix socket. Arrays are
+passed back through shared memory rather than through the socket. The
+socket is kept in a directory only its user can open, and both ends check
+that the other runs as the same user before anything is unpickled.
+
+Examples
+--------
+
+1. Start a worker and load a variable through it::
+
+    client = cd.start_worker()
+    ts = client.loadvar('ts_Amon_CanESM2_historical_r1i1p1_185001-200512.nc',
+                        'ts', cdostr='-yearmean')
+    gm = client.reduce('ts_Amon_CanESM2_historical_r1i1p1_185001-200512.nc',
+                       'ts', ['fldmean'])
+    client.shutdown()
+
+The worker can also be started from a shell with::
+
+    python -c "import cmipdata.worker_tools as w; w.serve()"
+
+  .. moduleauthor:: Neil Swart <neil.swart@ec.gc.ca>
+"""
+import os
+import sys
+import stat
+import time
+import pickle
+import socket
+import struct
+import tempfile
+import threading
+import subprocess
+import socketserver
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def default_address():
+    """The default socket address, one per user, in $XDG_RUNTIME_DIR or else
+    in a directory cmipdata-<uid> of the temporary directory which only the
+    user can open."""
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and _private(runtime):
+        return os.path.join(runtime, 'cmipdata-worker.sock')
+    directory = os.path.join(tempfile.gettempdir(), 'cmipdata-%d' % os.getuid())
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    if not _private(directory):
+        raise PermissionError(directory + ' is not a directory private to this user')
+    return os.path.join(directory, 'worker.sock')
+
+
+def _private(directory):
+    """Whether directory is a directory (not a link) owned by this user,
+    which no one else can open."""
+    try:
+        st = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def _check_peer(sock, address=None):
+    """Raise PermissionError unless the process at the other end of the Unix
+    socket sock runs as this user. Where the kernel does not give the peer's
+    credentials (SO_PEERCRED), a client checks the owner of the socket file
+    at address instead, and a server relies on the permissions of its
+    socket."""
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        uid = struct.unpack('3i', creds)[1]
+    elif address is not None:
+        uid = os.stat(address).st_uid
+    else:
+        return
+    if uid != os.getuid():
+        raise PermissionError('the worker socket peer runs as user %d, not %d' %
+                              (uid, os.getuid()))
+
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!Q', len(data)) + data)
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise EOFError('connection closed')
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv(sock):
+    n = struct.unpack('!Q', _recv_exactly(sock, 8))[0]
+    return pickle.loads(_recv_exactly(sock, n))
+
+
+def _to_shm(array, segments):
+    """Copy array into a new shared memory segment, and return a descriptor
+    (name, shape, dtype)."""
+    # ascontiguousarray would make a 0-d array 1-d
+    array = np.asarray(array, order='C')
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    segments[shm.name] = shm
+    return (shm.name, array.shape, array.dtype.str)
+
+
+def _from_shm(descriptor):
+    """Copy the array described by descriptor out of shared memory."""
+    name, shape, dtype = descriptor
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 registers attached segments with the resource tracker,
+        # which would unlink them when this process exits.
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        return np.array(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    finally:
+        shm.close()
+
+
+def _pack(value, segments):
+    """Replace arrays in value by shared memory descriptors."""
+    if isinstance(value, np.ma.MaskedArray):
+        return ('ma', _to_shm(value.data, segments),
+                _to_shm(np.ma.getmaskarray(value), segments))
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return ('nd', _to_shm(value, segments))
+    if isinstance(value, dict):
+        return ('dict', dict((k, _pack(v, segments)) for k, v in value.items()))
+    return ('obj', value)
+
+
+def _unpack(value):
+    kind = value[0]
+    if kind == 'ma':
+        return np.ma.masked_array(_from_shm(value[1]), mask=_from_shm(value[2]))
+    if kind == 'nd':
+        return _from_shm(value[1])
+    if kind == 'dict':
+        return dict((k, _unpack(v)) for k, v in value[1].items())
+    return value[1]
+
+
+class _Worker(object):
+    """The state kept warm by the worker: the netCDF files and coordinates
+    loading_tools keeps open and cached in this process. Loads and
+    reductions go through loading_tools, so that the worker selects and
+    reduces exactly as loadvar does."""
+
+    def __init__(self, max_open=64):
+        from . import loading_tools
+        self.lt = loading_tools
+        self.lt.set_max_open_files(max_open)
+        self.lock = threading.Lock()
+
+    def loadvar(self, ifile, varname, cdostr=None, **kwargs):
+        return self.lt.loadvar(ifile, varname, cdostr=cdostr, **kwargs)
+
+    def get_dimensions(self, ifile, varname, toDatetime=False):
+        return self.lt.get_dimensions(ifile, varname, toDatetime=toDatetime)
+
+    def reduce(self, ifile, varname, ops, **kwargs):
+        """Load varname, or the selection in kwargs, and apply the reductions
+        in ops, as loadvar(ifile, varname, reduce=ops, **kwargs)."""
+        return self.lt.loadvar(ifile, varname, reduce=list(ops), **kwargs)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            _check_peer(self.request)
+        except PermissionError:
+            return
+        segments = self.server.segments
+        while True:
+            try:
+                request = _recv(self.request)
+            except EOFError:
+                return
+            op = request['op']
+            if op == 'release':
+                for name in request['names']:
+                    shm = segments.pop(name, None)
+                    if shm is not None:
+                        shm.close()
+                        shm.unlink()
+                continue
+            if op == 'shutdown':
+                _send(self.request, {'ok': True, 'result': ('obj', None)})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            try:
+                if op == 'ping':
+                    result = os.getpid()
+                else:
+                    # netCDF and HDF5 are not thread safe
+                    with self.server.worker.lock:
+                        result = getattr(self.server.worker, op)(*request['args'],
+                                                                 **request['kwargs'])
+                _send(self.request, {'ok': True, 'result': _pack(result, segments)})
+            except Exception as e:
+                _send(self.request, {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)})
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(address=None, max_open=64):
+    """Run a worker serving requests on the Unix socket address, until a
+    client calls shutdown().
+
+    Parameters
+    ----------
+    address : str
+              Path of the Unix socket. Defaults to default_address().
+    max_open : int
+               The maximum number of netCDF files kept open.
+    """
+    address = address or default_address()
+    if os.path.lexists(address):
+        if not stat.S_ISSOCK(os.lstat(address).st_mode):
+            raise FileExistsError(address + ' exists and is not a socket')
+        os.remove(address)
+    # the socket is created readable and writable by its user only
+    umask = os.umask(0o177)
+    try:
+        server = _Server(address, _Handler)
+    finally:
+        os.umask(umask)
+    server.worker = _Worker(max_open=max_open)
+    server.segments = {}
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for shm in server.segments.values():
+            shm.close()
+            shm.unlink()
+        if os.path.exists(address):
+            os.remove(address)
+
+
+class WorkerClient(object):
+    """A connection to a worker started with serve() or start_worker().
+
+    The methods loadvar, get_dimensions and reduce take the same arguments
+    as the corresponding worker operations and return numpy (masked) arrays
+    or dictionaries of arrays.
+    """
+
+    def __init__(self, address=None):
+        self.address = address or default_address()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.address)
+        try:
+            _check_peer(self.sock, self.address)
+        except PermissionError:
+            self.sock.close()
+            raise
+
+    def _call(self, op, *args, **kwargs):
+        _send(self.sock, {'op': op, 'args': args, 'kwargs': kwargs})
+        response = _recv(self.sock)
+        if not response['ok']:
+            raise RuntimeError('worker: ' + response['error'])
+        try:
+            return _unpack(response['result'])
+        finally:
+            names = _segment_names(response['result'])
+            if names:
+                _send(self.sock, {'op': 'release', 'names': names})
+
+    def ping(self):
+        """Returns the process id of the worker."""
+        return self._call('ping')
+
+    def loadvar(self, ifile, varname, cdostr=None, **kwargs):
+        """As loading_tools.loadvar, but done by the worker."""
+        return self._call('loadvar', ifile, varname, cdostr=cdostr, **kwargs)
+
+    def get_dimensions(self, ifile, varname, toDatetime=False):
+        """As loading_tools.get_dimensions, but done by the worker."""
+        return self._call('get_dimensions', ifile, varname, toDatetime=toDatetime)
+
+    def reduce(self, ifile, varname, ops, **kwargs):
+        """Load varname from ifile, or a selection given as for loadvar, and
+        apply the reductions in ops, a list of 'timmean', 'yearmean',
+        'seasmean', 'zonmean' and 'fldmean'."""
+        return self._call('reduce', ifile, varname, list(ops), **kwargs)
+
+    def shutdown(self):
+        """Stop the worker."""
+        self._call('shutdown')
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+
+def _segment_names(value):
+    kind = value[0]
+    if kind == 'ma':
+        return [value[1][0], value[2][0]]
+    if kind == 'nd':
+        return [value[1][0]]
+    if kind == 'dict':
+        return [n for v in value[1].values() for n in _segment_names(v)]
+    return []
+
+
+def start_worker(address=None, max_open=64, timeout=60):
+    """Start a worker in the background, if one is not already listening on
+    address, and return a WorkerClient connected to it."""
+    address = address or default_address()
+    try:
+        client = WorkerClient(address)
+        client.ping()
+        return client
+    except (OSError, EOFError):
+        pass
+
+    code = 'import cmipdata.worker_tools as w; w.serve(%r, %d)' % (address, max_open)
+    subprocess.Popen([sys.executable, '-c', code], start_new_session=True)
+    t0 = time.time()
+    while True:
+        try:
+            client = WorkerClient(address)
+            client.ping()
+            return client
+        except (OSError, EOFError):
+            if time.time() - t0 > timeout:
+                raise RuntimeError('worker did not start on ' + address)
+            time.sleep(0.1)
+